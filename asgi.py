@@ -0,0 +1,423 @@
+"""
+ASGI serving mode for Vectora.
+
+/process runs on asyncio with async provider clients (httpx), so one process
+can hold hundreds of concurrent LLM streams instead of one per sync worker.
+Every other route is served by the Flask app in main.py through a WSGI bridge.
+
+Run: uvicorn asgi:app --host 0.0.0.0 --port 5001
+"""
+import asyncio
+import os
+import sys
+from contextlib import asynccontextmanager
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import main
+from main import (
+    CACHE_LOOKUPS, HTTP_CONNECT_TIMEOUT, HTTP_MAX_RETRIES, HTTP_READ_TIMEOUT, REQUEST_DEADLINE,
+    STREAM_FORMATS, UPLOAD_MAX_BYTES, AnswerRecord, Cancelled, Overloaded, ProviderError, RoutedCall,
+    SSEDecoder, StreamMeter, UnknownModel, UploadTooLarge, VerdictStreamParser, aacquire_slot, build_prompt,
+    cerebras_stream_request, current_deadline, decode_sse_payload, encode_event, end_production,
+    estimate_tokens, finish_trace, gemini_chunk_text, gemini_context, gemini_contexts, gemini_stream_request,
+    groq_stream_request, lookup_gemini_file, near_dup_probe, openai_chunk_text, parse_retry_after,
+    process_flights, remove_upload, replay_stream, resolve_model, save_upload, start_deadline, start_trace,
+    stream_claims, upload_display_name, upload_to_gemini, verdict_cache, verdict_key
+)
+
+# Connections per provider; async streams are cheap, so this is far larger
+# than the sync HTTP_POOL_SIZE.
+ASGI_POOL_SIZE = int(os.getenv("ASGI_POOL_SIZE", "200"))
+
+_clients = {}
+_producers = set() # running flight tasks (held so they are not garbage collected)
+
+def get_async_client(provider):
+    """Returns the pooled keep-alive AsyncClient for a provider."""
+    client = _clients.get(provider)
+    if client is None:
+        limits = httpx.Limits(max_connections=ASGI_POOL_SIZE, max_keepalive_connections=ASGI_POOL_SIZE)
+        # httpx transport retries cover connection failures only, like the sync Retry policy
+        transport = httpx.AsyncHTTPTransport(retries=HTTP_MAX_RETRIES, limits=limits)
+        client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+        _clients[provider] = client
+    return client
+
+async def _sse_json(resp, provider):
+    """Async twin of main.iter_sse_json, sharing the same SSEDecoder."""
+    if resp.status_code != 200:
+        body = (await resp.aread()).decode("utf-8", "replace")
+        raise ProviderError(provider, resp.status_code, body, parse_retry_after(resp.headers))
+    decoder = SSEDecoder()
+    async for chunk in resp.aiter_bytes():
+        for payload in decoder.feed(chunk):
+            done, obj = decode_sse_payload(payload, provider)
+            if done: return
+            if obj is not None: yield obj
+    for payload in decoder.close():
+        done, obj = decode_sse_payload(payload, provider)
+        if done: return
+        if obj is not None: yield obj
+
+# --- ASYNC PROVIDER STREAMS ---
+
+async def astream_gemini(prompt, model, file_uri=None, mime_type=None, web_search=False, cached_content=None):
+    url, params, headers, payload = gemini_stream_request(prompt, model, file_uri, mime_type, web_search, cached_content)
+    async with get_async_client("gemini").stream("POST", url, headers=headers, params=params, json=payload) as resp:
+        async for chunk in _sse_json(resp, "gemini"):
+            try:
+                pieces = list(gemini_chunk_text(chunk))
+            except (AttributeError, IndexError, KeyError, TypeError):
+                continue
+            for piece in pieces:
+                yield piece
+
+async def _astream_openai(provider, url, headers, data):
+    async with get_async_client(provider).stream("POST", url, headers=headers, json=data) as resp:
+        async for chunk in _sse_json(resp, provider):
+            try:
+                content = openai_chunk_text(chunk)
+            except (AttributeError, IndexError, KeyError, TypeError):
+                continue
+            if content: yield content
+
+async def astream_groq(prompt, model, file_path=None, mime_type=None, file_digest=None):
+    try:
+        # Image encoding / PDF rasterization are blocking; keep them off the loop
+        url, headers, data = await run_in_threadpool(groq_stream_request, prompt, model, file_path, mime_type, file_digest)
+    except Exception as e:
+        yield f"[System Error: {str(e)}]"
+        return
+    async for content in _astream_openai("groq", url, headers, data):
+        yield content
+
+async def astream_cerebras(prompt, model):
+    url, headers, data = cerebras_stream_request(prompt, model)
+    async for content in _astream_openai("cerebras", url, headers, data):
+        yield content
+
+async def astream_fact_check(provider, model, prompt, file_path=None, mime_type=None, file_digest=None, web_search=False, ticket=None):
+    """Async twin of main.stream_fact_check, including the scheduler slot."""
+    if ticket is None:
+        ticket = await aacquire_slot(provider, estimate_tokens(prompt, file_path))
+    meter = StreamMeter(provider, model)
+    chunks = _astream_provider(provider, model, prompt, file_path, mime_type, file_digest, web_search)
+    try:
+        async for chunk in chunks:
+            meter.chunk(chunk)
+            yield chunk
+    finally:
+        await chunks.aclose()
+        meter.close()
+        ticket.release()
+
+async def _astream_provider(provider, model, prompt, file_path, mime_type, file_digest, web_search):
+    if provider == "gemini":
+        file_uri = None
+        if file_path:
+            file_uri = lookup_gemini_file(file_digest)
+            if file_uri:
+                yield f"// {upload_display_name(file_path)} already in Google Vault. Skipping upload...\n"
+            else:
+                yield f"// Uploading {upload_display_name(file_path)} to Google Vault...\n"
+                file_uri = await run_in_threadpool(upload_to_gemini, file_path, mime_type, file_digest)
+        cached_content, delta = await run_in_threadpool(
+            gemini_context, prompt, model, file_uri, mime_type, file_digest, web_search, file_path
+        ) # sizing a new context reads the whole document
+        if cached_content:
+            try:
+                async for chunk in astream_gemini(delta, model, None, mime_type, web_search, cached_content):
+                    yield chunk
+                return
+            except ProviderError as e:
+                if e.status not in (400, 403, 404):
+                    raise
+                gemini_contexts.drop(model, file_digest)
+        async for chunk in astream_gemini(prompt, model, file_uri, mime_type, web_search):
+            yield chunk
+
+    elif provider == "groq":
+        if file_path:
+            yield f"// Processing Image Data for Groq...\n"
+        async for chunk in astream_groq(prompt, model, file_path, mime_type, file_digest):
+            yield chunk
+
+    elif provider == "cerebras":
+        # Cerebras is Text-Only currently for standard inference
+        if file_path:
+            yield f"// WARNING: Cerebras provider supports TEXT ONLY. File ignored.\n"
+        async for chunk in astream_cerebras(prompt, model):
+            yield chunk
+
+async def astream_routed(provider, model, prompt, file_path=None, mime_type=None, file_digest=None, web_search=False, hedge_ms=None, ticket=None):
+    """Async twin of main.stream_routed: the same RoutedCall decisions, with one
+    asyncio task per started candidate. Stopped tasks close their streams."""
+    out = asyncio.Queue()
+    tasks = {}
+
+    async def pump(index, prov, mdl, ticket):
+        try:
+            async for chunk in astream_fact_check(prov, mdl, prompt, file_path, mime_type, file_digest, web_search,
+                                                  ticket=ticket):
+                await out.put((index, "chunk", chunk))
+            await out.put((index, "done", None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await out.put((index, "error", e))
+
+    def start(index, prov, mdl, ticket):
+        tasks[index] = asyncio.create_task(pump(index, prov, mdl, ticket))
+
+    def stop(index):
+        if index in tasks:
+            tasks[index].cancel()
+
+    call = RoutedCall(provider, model, file_path, web_search, hedge_ms, ticket, start, stop)
+    try:
+        call.launch()
+        while call.active:
+            try:
+                event = await asyncio.wait_for(out.get(), call.hedge_timeout())
+            except asyncio.TimeoutError:
+                yield call.hedge()
+                continue
+            for chunk in call.handle(*event):
+                yield chunk
+    finally:
+        call.close()
+
+async def aproduce_answer(flight, cache_key, cache_kind, chunks, ticket, file_path=None, probe=None):
+    """Async twin of main.produce_answer. The deadline bounds the whole stream,
+    and the task is cancelled when the flight's last client disconnects."""
+    record = AnswerRecord()
+    deadline = current_deadline.get()
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    flight.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel))
+
+    async def publish():
+        async for chunk in chunks:
+            record.add(chunk)
+            flight.publish(chunk)
+
+    try:
+        await asyncio.wait_for(publish(), deadline.remaining() if deadline else None)
+    except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+        if deadline is not None:
+            # Also stops the threadpool side (claim mode, blocking provider calls)
+            deadline.cancel("deadline" if isinstance(e, asyncio.TimeoutError) else "disconnect")
+            flight.finish(error=Cancelled(deadline.reason()))
+        else:
+            flight.finish(error=Cancelled("Request cancelled"))
+    except Exception as e:
+        flight.finish(error=e)
+    else:
+        await run_in_threadpool(record.remember, cache_key, cache_kind, probe)
+        flight.finish()
+    finally:
+        await chunks.aclose()
+        end_production(flight, cache_key, ticket, file_path)
+
+async def aformat_stream(chunks, fmt="text"):
+    """Async twin of main.format_stream."""
+    if fmt not in ("ndjson", "sse"):
+        async for chunk in chunks:
+            yield chunk
+        return
+    parser = VerdictStreamParser()
+    try:
+        async for chunk in chunks:
+            for event in parser.feed(chunk):
+                yield encode_event(event, fmt)
+        for event in parser.close():
+            yield encode_event(event, fmt)
+    finally:
+        await chunks.aclose()
+
+async def afollow(flight):
+    """Async twin of Flight.follow; wakes on the flight's change listener."""
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    listener = lambda: loop.call_soon_threadsafe(changed.set)
+    flight.listeners.append(listener)
+    try:
+        index = 0
+        while True:
+            changed.clear()
+            chunks, done = flight.read(index, timeout=0)
+            index += len(chunks)
+            for chunk in chunks:
+                yield chunk
+            if done and index == len(flight.chunks):
+                if flight.error is not None:
+                    raise flight.error
+                return
+            if not chunks:
+                await changed.wait()
+    finally:
+        flight.listeners.remove(listener)
+
+# --- ROUTES ---
+
+class FlightResponse(StreamingResponse):
+    """Streams a flight to one subscriber and detaches it however the response
+    ends. Detaching in the body generator is not enough: if the client is gone
+    before iteration starts, the generator's finally never runs."""
+
+    def __init__(self, content, flight, **kwargs):
+        super().__init__(content, **kwargs)
+        self.flight = flight
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.flight.detach() # the last one out cancels upstream
+
+async def process(request):
+    """Same contract as the Flask /process: form in, text/plain stream out."""
+    trace = start_trace("/process")
+    start_deadline(REQUEST_DEADLINE)
+    file_path = None
+    if int(request.headers.get("content-length") or 0) > UPLOAD_MAX_BYTES + 1024 * 1024:
+        return JSONResponse({"reply": f"System Error: Upload exceeds the {UPLOAD_MAX_BYTES // (1024 * 1024)} MB limit"},
+                            status_code=413, background=BackgroundTask(finish_trace, trace, 413))
+    try:
+        form = await request.form()
+        user_input = (form.get("user_input") or "").strip()
+        provider = form.get("provider", "gemini")
+        try:
+            model = await run_in_threadpool(resolve_model, provider, form.get("model", ""))
+        except UnknownModel as e:
+            await form.close()
+            return JSONResponse({"reply": f"System Error: {e}"}, status_code=400,
+                                background=BackgroundTask(finish_trace, trace, 400))
+        web_search = form.get("web_search") == "true"
+        decompose = form.get("decompose") == "true"
+        fmt = form.get("format", "text")
+        if fmt not in STREAM_FORMATS:
+            fmt = "text"
+
+        # Files
+        upload = form.get("file")
+        mime_type = None
+        file_digest = None
+        if upload is not None and getattr(upload, "filename", None):
+            file_path, mime_type, file_digest = await run_in_threadpool(
+                save_upload, upload.file, upload.filename, upload.content_type
+            )
+        await form.close() # drops the multipart spool; the upload lives on in UPLOAD_FOLDER
+
+        prompt = build_prompt(user_input)
+
+        decompose = decompose and bool(user_input) and not file_path
+        cache_kind = "web_search" if web_search else "process"
+        cache_key = verdict_key(provider, model + ("#claims" if decompose else ""), web_search, user_input, file_digest=file_digest)
+    except UploadTooLarge as e:
+        remove_upload(file_path)
+        return JSONResponse({"reply": f"System Error: {e}"}, status_code=413,
+                            background=BackgroundTask(finish_trace, trace, 413))
+    except Exception as e:
+        remove_upload(file_path)
+        print("ASGI exception in /process:", e, file=sys.stderr)
+        return JSONResponse({"reply": f"System Error: {e}"}, status_code=500,
+                            background=BackgroundTask(finish_trace, trace, 500))
+
+    cached = await run_in_threadpool(verdict_cache.get, cache_key) # may read the SQLite tier
+    CACHE_LOOKUPS.inc(kind=cache_kind, result="miss" if cached is None else "hit")
+    if cached is not None:
+        remove_upload(file_path)
+        async def replay():
+            yield "// Cached verdict found. Replaying analysis...\n"
+            for chunk in replay_stream(cached):
+                yield chunk
+        return StreamingResponse(aformat_stream(replay(), fmt), media_type=STREAM_FORMATS[fmt],
+                                 background=BackgroundTask(finish_trace, trace, 200))
+
+    # Paraphrase or recompressed image of something already verified
+    probe = await run_in_threadpool(
+        near_dup_probe,
+        f"{cache_kind}{'#claims' if decompose else ''}:{provider}/{model}",
+        user_input if not file_path else None,
+        file_path if file_path and mime_type.startswith("image/") and not user_input else None
+    )
+    match = await run_in_threadpool(probe.match) if probe else None
+    if match:
+        remove_upload(file_path)
+        similarity, text = match
+        async def replay_match():
+            yield f"// Near-duplicate of an already verified item ({similarity:.0%} similar). Replaying its verdict...\n"
+            for chunk in replay_stream(text):
+                yield chunk
+        return StreamingResponse(aformat_stream(replay_match(), fmt), media_type=STREAM_FORMATS[fmt], headers={"X-Vectora-Match": f"{similarity:.2f}"},
+                                 background=BackgroundTask(finish_trace, trace, 200))
+
+    flight, leader = process_flights.join(cache_key)
+    if leader:
+        try:
+            ticket = await aacquire_slot(provider, estimate_tokens(prompt, file_path))
+        except Overloaded as e:
+            flight.finish(error=e)
+            process_flights.forget(cache_key, flight)
+            flight.detach()
+            remove_upload(file_path)
+            return JSONResponse({"reply": f"System Busy: {e}", "retry_after": e.retry_after}, status_code=429,
+                                headers={"Retry-After": str(e.retry_after)},
+                                background=BackgroundTask(finish_trace, trace, 429))
+        if decompose:
+            # Claim mode fans out over worker threads anyway; reuse the sync pipeline
+            chunks = iterate_in_threadpool(stream_claims(provider, model, user_input, web_search, ticket=ticket))
+        else:
+            chunks = astream_routed(provider, model, prompt, file_path, mime_type, file_digest, web_search, ticket=ticket)
+        task = asyncio.create_task(aproduce_answer(flight, cache_key, cache_kind, chunks, ticket, file_path, probe))
+        _producers.add(task)
+        task.add_done_callback(_producers.discard)
+    else:
+        remove_upload(file_path) # the leader's copy is the one being analyzed
+
+    async def generate():
+        if not leader:
+            yield "// Identical analysis already in progress. Attaching to it...\n"
+        try:
+            async for chunk in afollow(flight):
+                yield chunk
+        except Exception as e:
+            yield f"\n[SYSTEM ERROR: {str(e)}]"
+
+    return FlightResponse(aformat_stream(generate(), fmt), flight, media_type=STREAM_FORMATS[fmt],
+                          background=BackgroundTask(finish_trace, trace, 200))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    for client in list(_clients.values()):
+        await client.aclose()
+    _clients.clear()
+
+
+app = Starlette(
+    routes=[
+        Route("/process", process, methods=["POST"]),
+        # Everything else (pages, /api/*, /ai-check) stays on Flask
+        Mount("/", WSGIMiddleware(main.app))
+    ],
+    lifespan=lifespan
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    port = int(os.environ.get("PORT", 5001))
+    uvicorn.run(app, host="127.0.0.1", port=port)
@@ -0,0 +1,244 @@
+"""
+Load/benchmark harness for Vectora.
+
+By default it starts bench/mock_provider.py and the Flask app in-process
+(threaded werkzeug server) with every provider base URL pointed at the mock,
+so no real API quota is used. Use --target to drive an already running
+server instead (e.g. gunicorn or `uvicorn asgi:app` started with the mock
+provider environment).
+
+For each scenario it reports req/s, time-to-first-byte and total latency
+percentiles, error count and process memory (in-process mode only).
+
+Run: python bench/benchmark.py --scenarios text,image,pdf,web_search,batch -c 16 -n 200
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mock_provider # noqa: E402
+
+SCENARIOS = ["text", "image", "pdf", "web_search", "batch"]
+
+# Minimal single-page PDF; a random trailer comment makes each copy unique.
+PDF_TEMPLATE = (
+    b"%PDF-1.4\n"
+    b"1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+    b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+    b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>endobj\n"
+    b"trailer<</Root 1 0 R>>\n"
+    b"%%EOF\n"
+)
+
+
+def _claim(repeat):
+    if repeat:
+        return "The moon landing was staged in a film studio."
+    return f"Claim {uuid.uuid4().hex}: the moon landing was staged in a film studio."
+
+
+def _image_bytes(repeat):
+    try:
+        from PIL import Image
+    except ImportError:
+        sys.exit("The image scenario needs Pillow")
+    img = Image.new("RGB", (1600, 1200), (30, 60, 90))
+    if not repeat:
+        img.putpixel((random.randrange(1600), random.randrange(1200)), (255, 0, 0))
+    buf = io.BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
+
+
+def build_request(scenario, repeat=False, batch_size=10):
+    """Returns (method, path, requests kwargs) for one request of a scenario."""
+    if scenario == "text":
+        return "POST", "/process", {"data": {"user_input": _claim(repeat), "provider": "cerebras", "model": "mock-llama"}}
+    if scenario == "web_search":
+        return "POST", "/process", {"data": {"user_input": _claim(repeat), "provider": "gemini",
+                                             "model": "mock-gemini", "web_search": "true"}}
+    if scenario == "image":
+        return "POST", "/process", {
+            "data": {"user_input": "", "provider": "groq", "model": "mock-llama"},
+            "files": {"file": ("photo.png", _image_bytes(repeat), "image/png")}
+        }
+    if scenario == "pdf":
+        pdf = PDF_TEMPLATE if repeat else PDF_TEMPLATE + f"%{uuid.uuid4().hex}\n".encode()
+        return "POST", "/process", {
+            "data": {"user_input": "", "provider": "gemini", "model": "mock-gemini"},
+            "files": {"file": ("doc.pdf", pdf, "application/pdf")}
+        }
+    if scenario == "batch":
+        items = [{"text": _claim(repeat) + f" #{i}"} for i in range(batch_size)]
+        return "POST", "/ai-check/batch", {"json": {"items": items}}
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+def rss_bytes():
+    """Current resident set size of this process (Linux), or None."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def run_scenario(base_url, scenario, requests_total, concurrency, repeat=False, batch_size=10):
+    local = threading.local()
+    ttfbs, latencies, errors = [], [], []
+    lock = threading.Lock()
+
+    def one(_):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        method, path, kwargs = build_request(scenario, repeat, batch_size)
+        start = time.perf_counter()
+        ttfb = None
+        try:
+            with session.request(method, base_url + path, stream=True, timeout=120, **kwargs) as resp:
+                body = bytearray()
+                for chunk in resp.iter_content(chunk_size=None):
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - start
+                    body.extend(chunk)
+                ok = resp.status_code == 200 and b"SYSTEM ERROR" not in body
+        except requests.RequestException as e:
+            ok = False
+            body = str(e).encode()
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if ttfb is not None:
+                ttfbs.append(ttfb)
+            if not ok:
+                errors.append(bytes(body[:200]))
+
+    peak = [rss_bytes() or 0]
+    done = threading.Event()
+
+    def sample_memory():
+        while not done.wait(0.05):
+            peak[0] = max(peak[0], rss_bytes() or 0)
+
+    rss_before = rss_bytes()
+    sampler = threading.Thread(target=sample_memory, daemon=True)
+    sampler.start()
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests_total)))
+    wall = time.perf_counter() - wall_start
+    done.set()
+    sampler.join()
+    rss_after = rss_bytes()
+
+    return {
+        "scenario": scenario,
+        "requests": requests_total,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "sample_error": errors[0].decode("utf-8", "replace") if errors else None,
+        "req_per_sec": requests_total / wall if wall else 0.0,
+        "ttfb_p50_ms": percentile(ttfbs, 0.50) * 1000,
+        "ttfb_p99_ms": percentile(ttfbs, 0.99) * 1000,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "rss_peak_mb": peak[0] / 1e6 if rss_before is not None else None,
+        "rss_delta_mb": (rss_after - rss_before) / 1e6 if rss_before is not None else None
+    }
+
+
+def start_local_stack(mock_config):
+    """Starts the mock provider and the Flask app in this process. Returns base URL."""
+    server, env = mock_provider.start_in_background(config=mock_config)
+    os.environ.update(env)
+    import main # noqa: E402 -- must be imported after the base URL overrides
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR) # no per-request access log
+    app_server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=app_server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{app_server.server_port}"
+
+
+def print_report(results):
+    header = f"{'scenario':<11} {'n':>5} {'c':>4} {'err':>4} {'req/s':>8} {'ttfb50':>8} {'ttfb99':>8} {'lat50':>8} {'lat99':>8} {'rssMB':>8} {'dMB':>7}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        rss = f"{r['rss_peak_mb']:8.1f}" if r["rss_peak_mb"] is not None else f"{'n/a':>8}"
+        delta = f"{r['rss_delta_mb']:7.1f}" if r["rss_delta_mb"] is not None else f"{'n/a':>7}"
+        print(f"{r['scenario']:<11} {r['requests']:>5} {r['concurrency']:>4} {r['errors']:>4} "
+              f"{r['req_per_sec']:8.1f} {r['ttfb_p50_ms']:8.0f} {r['ttfb_p99_ms']:8.0f} "
+              f"{r['latency_p50_ms']:8.0f} {r['latency_p99_ms']:8.0f} {rss} {delta}")
+        if r["sample_error"]:
+            print(f"    first error: {r['sample_error'][:120]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vectora load/benchmark harness")
+    parser.add_argument("--target", help="base URL of a running server (default: start app + mock in-process)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("-n", "--requests", type=int, default=100, help="requests per scenario")
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("--repeat", action="store_true", help="send identical inputs (measures cache hits)")
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--json", help="also write results to this file")
+    # Mock provider knobs (in-process mode)
+    parser.add_argument("--ttft-ms", type=int, default=200)
+    parser.add_argument("--tokens-per-sec", type=float, default=400)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    if args.target:
+        base_url = args.target.rstrip("/")
+    else:
+        config = mock_provider.MockConfig(ttft_ms=args.ttft_ms, tokens_per_sec=args.tokens_per_sec,
+                                          error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate)
+        base_url = start_local_stack(config)
+
+    results = []
+    for scenario in scenarios:
+        print(f"running {scenario} ...", file=sys.stderr)
+        result = run_scenario(base_url, scenario, args.requests, args.concurrency, args.repeat, args.batch_size)
+        if args.target:
+            result["rss_peak_mb"] = result["rss_delta_mb"] = None # client memory says nothing about the server
+        results.append(result)
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""
+Local stand-in for the Gemini, Groq and Cerebras APIs.
+
+Speaks just enough of each protocol for main.py to run end to end without
+real API quota:
+  - Gemini:   GET  /v1beta/models
+              POST /v1beta/models/<model>:streamGenerateContent?alt=sse
+              POST /upload/v1beta/files  (resumable start / upload / query / finalize)
+              POST /v1beta/cachedContents, PATCH/DELETE /v1beta/cachedContents/<id>
+  - OpenAI-compatible chat completions (streaming SSE and blocking JSON):
+              POST /openai/v1/chat/completions   (Groq)
+              POST /v1/chat/completions          (Cerebras)
+              GET  /openai/v1/models, /v1/models
+
+Latency, token rate and error injection are configurable, so load tests can
+model slow or flaky upstreams.
+
+Run: python bench/mock_provider.py --port 8900 --ttft-ms 300 --tokens-per-sec 200
+Then point Vectora at it with the environment printed on startup.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+ANSWER = (
+    "1. **VERDICT**: FALSE\n"
+    "2. **RISK SCORE**: 87%\n"
+    "3. **ANALYSIS**: This is a synthetic answer produced by the Vectora mock provider. "
+    "It follows the fact-check output protocol so downstream parsing can be exercised "
+    "under load without calling a real model. The claim contradicts well documented "
+    "evidence and relies on an appeal to emotion rather than verifiable data.\n"
+    "4. **SOURCES**:\n"
+    "- Example Fact Check: https://example.com/fact-check/mock-claim\n"
+    "- Example Encyclopedia: https://example.org/wiki/Mock_Claim\n"
+)
+
+AI_CHECK_ANSWER = '{"ai_percent": 42, "reason": "Mock analysis"}'
+
+CLAIMS_ANSWER = (
+    '["The moon landing was staged in a film studio.", '
+    '"NASA destroyed the original landing tapes.", '
+    '"No stars are visible in the landing photos."]'
+)
+
+
+def answer_for(prompt_text):
+    """Claim-extraction prompts get a JSON claim list, everything else the canned verdict."""
+    return CLAIMS_ANSWER if "ATOMIC CLAIMS" in prompt_text else ANSWER
+
+
+class MockConfig:
+    def __init__(self, ttft_ms=200, tokens_per_sec=200, answer_tokens=0, error_rate=0.0,
+                 rate_limit_rate=0.0, drop_rate=0.0, upload_ms=100):
+        self.ttft_ms = ttft_ms
+        self.tokens_per_sec = tokens_per_sec
+        self.answer_tokens = answer_tokens # 0 = the canned answer as-is
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.drop_rate = drop_rate
+        self.upload_ms = upload_ms
+
+    def tokens(self, answer=ANSWER):
+        words = re.findall(r"\S+\s*", answer)
+        if self.answer_tokens:
+            words = (words * (self.answer_tokens // len(words) + 1))[:self.answer_tokens]
+        return words
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "VectoraMock/1.0"
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    # --- plumbing ---
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _inject_error(self):
+        """Returns True (after responding) when this request should fail."""
+        roll = random.random()
+        if roll < self.config.rate_limit_rate:
+            self._send_json(429, {"error": {"code": 429, "message": "Mock rate limit"}}, {"Retry-After": "1"})
+            return True
+        if roll < self.config.rate_limit_rate + self.config.error_rate:
+            self._send_json(500, {"error": {"code": 500, "message": "Mock upstream failure"}})
+            return True
+        return False
+
+    def _stream_sse(self, events):
+        """Writes SSE events with chunked encoding, paced by the token rate."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(self.config.ttft_ms / 1000.0)
+        delay = 1.0 / self.config.tokens_per_sec if self.config.tokens_per_sec > 0 else 0
+        drop_at = len(events) // 2 if random.random() < self.config.drop_rate else None
+        try:
+            for i, event in enumerate(events):
+                if i == drop_at:
+                    self.close_connection = True
+                    return # simulate a connection cut mid-stream
+                data = f"data: {event}\n\n".encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+                if delay:
+                    time.sleep(delay)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    # --- routes ---
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/v1beta/models":
+            return self._send_json(200, {"models": [
+                {"name": "models/mock-gemini", "supportedGenerationMethods": ["generateContent"]}
+            ]})
+        if path in ("/v1/models", "/openai/v1/models"):
+            return self._send_json(200, {"data": [{"id": "mock-llama"}]})
+        self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._read_body()
+        if path.endswith(":streamGenerateContent"):
+            return self._gemini_stream(body)
+        if path == "/v1beta/cachedContents":
+            return self._cache_create(body)
+        if path == "/upload/v1beta/files":
+            return self._upload_start(body)
+        if path.startswith("/upload/session/"):
+            return self._upload_chunk(path.rsplit("/", 1)[-1], body)
+        if path.endswith("/chat/completions"):
+            return self._chat_completions(body)
+        self._send_json(404, {"error": "not found"})
+
+    def do_PATCH(self):
+        path = urlparse(self.path).path
+        body = json.loads(self._read_body() or b"{}")
+        name = path[len("/v1beta/"):]
+        with self.server.lock:
+            cache = self.server.caches.get(name)
+            if cache is not None:
+                cache["expires_at"] = time.time() + float(str(body.get("ttl", "3600s")).rstrip("s"))
+        if cache is None:
+            return self._send_json(404, {"error": {"code": 404, "message": "cachedContent not found"}})
+        self._send_json(200, self._cache_info(name, cache))
+
+    def do_DELETE(self):
+        name = urlparse(self.path).path[len("/v1beta/"):]
+        with self.server.lock:
+            found = self.server.caches.pop(name, None) is not None
+        self._send_json(200 if found else 404, {})
+
+    def _cache_info(self, name, cache):
+        return {"name": name, "model": cache["model"],
+                "expireTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(cache["expires_at"]))}
+
+    def _cache_create(self, body):
+        if self._inject_error():
+            return
+        payload = json.loads(body or b"{}")
+        name = f"cachedContents/{uuid.uuid4().hex}"
+        cache = {"model": payload.get("model"),
+                 "expires_at": time.time() + float(str(payload.get("ttl", "3600s")).rstrip("s"))}
+        with self.server.lock:
+            self.server.caches[name] = cache
+        self._send_json(200, self._cache_info(name, cache))
+
+    def _gemini_stream(self, body):
+        if self._inject_error():
+            return
+        payload = json.loads(body or b"{}")
+        if payload.get("cachedContent"):
+            with self.server.lock:
+                cache = self.server.caches.get(payload["cachedContent"])
+            if cache is None or cache["expires_at"] < time.time():
+                return self._send_json(404, {"error": {"code": 404, "message": "cachedContent not found"}})
+        prompt_text = " ".join(p.get("text", "") for c in payload.get("contents", []) for p in c.get("parts", []))
+        tokens = self.config.tokens(answer_for(prompt_text))
+        events = [json.dumps({"candidates": [{"content": {"parts": [{"text": t}], "role": "model"}}]}) for t in tokens]
+        if payload.get("tools"):
+            # Web search: grounding metadata arrives with the final chunk
+            events.append(json.dumps({"candidates": [{
+                "content": {"parts": [{"text": ""}], "role": "model"},
+                "groundingMetadata": {"groundingChunks": [
+                    {"web": {"uri": "https://example.com/grounding/1", "title": "example.com"}}
+                ]}
+            }]}))
+        self._stream_sse(events)
+
+    def _chat_completions(self, body):
+        if self._inject_error():
+            return
+        payload = json.loads(body or b"{}")
+        if not payload.get("stream"):
+            time.sleep(self.config.ttft_ms / 1000.0)
+            return self._send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": AI_CHECK_ANSWER}, "finish_reason": "stop"}]
+            })
+        prompt_text = " ".join(
+            part if isinstance(part, str) else part.get("text", "")
+            for m in payload.get("messages", [])
+            for part in (m["content"] if isinstance(m.get("content"), list) else [m.get("content") or ""])
+        )
+        events = [
+            json.dumps({"id": "chatcmpl-mock", "object": "chat.completion.chunk",
+                        "choices": [{"index": 0, "delta": {"content": t}}]})
+            for t in self.config.tokens(answer_for(prompt_text))
+        ]
+        events.append("[DONE]")
+        self._stream_sse(events)
+
+    def _upload_start(self, body):
+        if self._inject_error():
+            return
+        if self.headers.get("X-Goog-Upload-Command") != "start":
+            return self._send_json(400, {"error": "expected start"})
+        session_id = uuid.uuid4().hex
+        size = int(self.headers.get("X-Goog-Upload-Header-Content-Length") or 0)
+        with self.server.lock:
+            self.server.uploads[session_id] = {"size": size, "received": 0}
+        host = self.headers.get("Host", f"127.0.0.1:{self.server.server_port}")
+        self.send_response(200)
+        self.send_header("X-Goog-Upload-URL", f"http://{host}/upload/session/{session_id}")
+        self.send_header("X-Goog-Upload-Status", "active")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _upload_chunk(self, session_id, body):
+        with self.server.lock:
+            session = self.server.uploads.get(session_id)
+        if session is None:
+            return self._send_json(404, {"error": "unknown upload session"})
+        command = self.headers.get("X-Goog-Upload-Command", "")
+        if command == "query":
+            self.send_response(200)
+            self.send_header("X-Goog-Upload-Size-Received", str(session["received"]))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        offset = int(self.headers.get("X-Goog-Upload-Offset") or 0)
+        if offset != session["received"]:
+            return self._send_json(400, {"error": f"offset {offset} != {session['received']}"})
+        time.sleep(self.config.upload_ms / 1000.0)
+        session["received"] += len(body)
+        if "finalize" not in command:
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        expires = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 48 * 3600))
+        self._send_json(200, {"file": {
+            "name": f"files/{session_id}",
+            "uri": f"http://127.0.0.1:{self.server.server_port}/v1beta/files/{session_id}",
+            "sizeBytes": str(session["received"]),
+            "state": "ACTIVE",
+            "expirationTime": expires
+        }})
+
+
+def make_server(host="127.0.0.1", port=8900, config=None, verbose=False):
+    """Creates (but does not start) a mock provider server."""
+    server = ThreadingHTTPServer((host, port), MockProviderHandler)
+    server.daemon_threads = True
+    server.config = config or MockConfig()
+    server.verbose = verbose
+    server.uploads = {}
+    server.caches = {}
+    server.lock = threading.Lock()
+    return server
+
+
+def start_in_background(host="127.0.0.1", port=0, config=None):
+    """Starts a mock server on a daemon thread. Returns (server, base_env)."""
+    server = make_server(host, port, config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, provider_env(host, server.server_port)
+
+
+def provider_env(host, port):
+    """Environment overrides that point main.py at a mock server."""
+    root = f"http://{host}:{port}"
+    return {
+        "GEMINI_BASE_URL": f"{root}/v1beta",
+        "GEMINI_UPLOAD_URL": f"{root}/upload/v1beta/files",
+        "GROQ_BASE_URL": f"{root}/openai/v1",
+        "CEREBRAS_BASE_URL": f"{root}/v1",
+        "GEMINI_API_KEY": "mock",
+        "GROQ_API_KEY": "mock",
+        "CEREBRAS_API_KEY": "mock"
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Gemini/Groq/Cerebras provider")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--ttft-ms", type=int, default=200, help="delay before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=200)
+    parser.add_argument("--answer-tokens", type=int, default=0, help="answer length (0 = canned answer)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction answered with 429")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of streams cut mid-way")
+    parser.add_argument("--upload-ms", type=int, default=100, help="delay per uploaded chunk")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    config = MockConfig(args.ttft_ms, args.tokens_per_sec, args.answer_tokens, args.error_rate,
+                        args.rate_limit_rate, args.drop_rate, args.upload_ms)
+    server = make_server(args.host, args.port, config, args.verbose)
+    print(f"Mock provider listening on http://{args.host}:{server.server_port}")
+    for key, value in provider_env(args.host, server.server_port).items():
+        print(f"  export {key}={value}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Cold-start profile and regression guard for Vercel-style deployments.
+
+Each sample is a fresh interpreter that imports main (as the serverless
+runtime does on a cold start) and then serves one static page through the
+Flask test client. It reports the median import time and time to the first
+page, and the slowest modules from `python -X importtime`.
+
+It exits non-zero when a heavy module (requests, PIL, pdf2image, ...) is
+loaded by the import or by a static page, or when the median import time
+exceeds --budget-ms. That keeps the AI stack off the cold path.
+
+Run: python bench/startup.py -n 10 --budget-ms 400
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded on first use only; none of these may appear before an AI route runs
+HEAVY_MODULES = ["requests", "urllib3", "PIL", "pdf2image", "httpx"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+after_import = sorted(m for m in {heavy} if m in sys.modules)
+response = main.app.test_client().get({page!r})
+served = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - start) * 1000,
+    "first_page_ms": (served - start) * 1000,
+    "status": response.status_code,
+    "heavy_after_import": after_import,
+    "heavy_after_page": sorted(m for m in {heavy} if m in sys.modules)
+}}))
+"""
+
+
+def sample(page):
+    code = PROBE.format(heavy=HEAVY_MODULES, page=page)
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def import_profile(top):
+    """Slowest modules (cumulative microseconds) from -X importtime."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=ROOT,
+                         capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), int(self_us), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vectora cold-start benchmark")
+    parser.add_argument("-n", "--samples", type=int, default=5)
+    parser.add_argument("--page", default="/", help="static page served after the import")
+    parser.add_argument("--budget-ms", type=float, default=0, help="fail above this median import time (0 = no limit)")
+    parser.add_argument("--top", type=int, default=15, help="slowest imports to list")
+    args = parser.parse_args()
+
+    samples = [sample(args.page) for _ in range(args.samples)]
+    import_ms = statistics.median(s["import_ms"] for s in samples)
+    page_ms = statistics.median(s["first_page_ms"] for s in samples)
+    print(f"import main:     {import_ms:7.1f} ms (median of {len(samples)})")
+    print(f"first {args.page:<9} {page_ms:7.1f} ms (import + first request)")
+
+    print("\nslowest imports (cumulative ms):")
+    for cumulative_us, self_us, name in import_profile(args.top):
+        print(f"  {cumulative_us / 1000:7.1f}  {name}")
+
+    problems = []
+    if any(s["status"] != 200 for s in samples):
+        problems.append(f"{args.page} answered {samples[0]['status']}")
+    for key, when in (("heavy_after_import", "import main"), ("heavy_after_page", f"GET {args.page}")):
+        loaded = sorted({m for s in samples for m in s[key]})
+        if loaded:
+            problems.append(f"{when} loaded {', '.join(loaded)}")
+    if args.budget_ms and import_ms > args.budget_ms:
+        problems.append(f"import time {import_ms:.1f} ms exceeds the {args.budget_ms:.0f} ms budget")
+    for problem in problems:
+        print(f"FAIL: {problem}", file=sys.stderr)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
-// background.js - Standalone service worker for Vectora AI Check Extension
-// ULTRA USELESS CONCEPT OF USING SERVER TO USE A EXTENSION.
-// No backend server required - makes direct API calls to AI providers
+// background.js - Service worker for Vectora AI Check Extension
+// With "Use Vectora API" on (the default), checks go through the Vectora
+// server's /api/extension gateway, which shares one verdict cache across all
+// installs. With it off, the extension calls the providers with your own keys.
 
 // Settings
 let settings = {
+  use_vectora_api: true,
+  server_url: 'https://vectoraai.vercel.app',
   provider: 'gemini',
   cerebras_api_key: '',
   cerebras_model: 'llama-3.3-70b',
@@ -18,6 +21,8 @@ loadSettings();
 
 function loadSettings() {
   chrome.storage.sync.get([
+    'use_vectora_api',
+    'server_url',
     'provider',
     'cerebras_api_key',
     'cerebras_model',
@@ -31,6 +36,11 @@ function loadSettings() {
   });
 }
 
+// The gateway needs no key; direct calls need one for the selected provider
+function hasCredentials() {
+  return settings.use_vectora_api || Boolean(settings[`${settings.provider}_api_key`]);
+}
+
 // Listen for messages from popup and content script
 chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
   if (message.action === 'settingsUpdated') {
@@ -42,8 +52,7 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
   else if (message.action === 'analyzeText') {
     console.log('Text analysis requested:', message.text.substring(0, 50) + '...');
 
-    const apiKey = settings[`${settings.provider}_api_key`];
-    if (!apiKey) {
+    if (!hasCredentials()) {
       const errorMsg = 'Please configure API key in settings';
       sendResponse({ success: false, message: errorMsg });
 
@@ -84,8 +93,7 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
 
   // Handle image analysis from content script
   else if (message.action === 'analyzeImage') {
-    const apiKey = settings[`${settings.provider}_api_key`];
-    if (!apiKey) {
+    if (!hasCredentials()) {
       chrome.tabs.query({ active: true, currentWindow: true }, (tabs) => {
         if (tabs[0]) showNotification(tabs[0].id, 0, 'Please configure API key in settings');
       });
@@ -132,6 +140,12 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
     // Determine capabilities based on provider and model (matching main.py)
     let capabilities = ['text']; // All models support text
 
+    if (settings.use_vectora_api) {
+      // The gateway picks the model server-side and handles images itself
+      sendResponse({ capabilities: ['text', 'image'] });
+      return true;
+    }
+
     if (provider === 'gemini') {
       // Gemini 1.5+ supports everything
       capabilities.push('image', 'web_search');
@@ -179,8 +193,8 @@ async function saveToHistory(url, feature, result) {
       ai_percent: result.ai_percent,
       message: result.message,
       timestamp: Date.now(),
-      provider: settings.provider,
-      model: settings[`${settings.provider}_model`]
+      provider: settings.use_vectora_api ? 'vectora' : settings.provider,
+      model: settings.use_vectora_api ? 'gateway' : settings[`${settings.provider}_model`]
     });
 
     // Keep only last 50 entries
@@ -288,8 +302,7 @@ chrome.contextMenus.onClicked.addListener(async (info, tab) => {
       }
 
       // Check if API key is configured
-      const apiKey = settings[`${settings.provider}_api_key`];
-      if (!apiKey) {
+      if (!hasCredentials()) {
         showNotification(tab.id, 0, 'Please configure API key in extension settings');
         return;
       }
@@ -310,8 +323,7 @@ chrome.contextMenus.onClicked.addListener(async (info, tab) => {
         return;
       }
 
-      const apiKey = settings[`${settings.provider}_api_key`];
-      if (!apiKey) {
+      if (!hasCredentials()) {
         showNotification(tab.id, 0, 'Please configure API key in extension settings');
         return;
       }
@@ -329,8 +341,31 @@ chrome.contextMenus.onClicked.addListener(async (info, tab) => {
   }
 });
 
+// Run a check through the Vectora gateway (kind: 'text', 'image' or 'page')
+async function callVectora(kind, body) {
+  const response = await fetch(`${settings.server_url}/api/extension/${kind}`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(body)
+  });
+
+  const data = await response.json().catch(() => ({}));
+  if (response.status === 429) {
+    throw new Error(`Vectora is busy, try again in ${response.headers.get('Retry-After') || 'a few'}s`);
+  }
+  if (!response.ok) {
+    throw new Error(data.message || `Vectora API error: ${response.status}`);
+  }
+
+  return { ai_percent: data.ai_percent, message: data.message || 'Analysis complete' };
+}
+
 // Analyze text using selected AI provider
 async function analyzeText(text) {
+  if (settings.use_vectora_api) {
+    return callVectora('text', { text });
+  }
+
   const provider = settings.provider;
   const apiKey = settings[`${provider}_api_key`];
   const model = settings[`${provider}_model`];
@@ -371,6 +406,11 @@ Return a percentage 0-100 where:
 
 // Analyze image using selected AI provider
 async function analyzeImage(imageUrl) {
+  if (settings.use_vectora_api) {
+    // Screen captures are data URLs; the server cannot fetch those
+    return callVectora('image', imageUrl.startsWith('data:') ? { image_data: imageUrl } : { image_url: imageUrl });
+  }
+
   const provider = settings.provider;
   const apiKey = settings[`${provider}_api_key`];
   const model = settings[`${provider}_model`];
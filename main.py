@@ -1,20 +1,76 @@
-from flask import Flask, request, jsonify, render_template, Response, stream_with_context
+from flask import Flask, Request, request, jsonify, render_template, Response, stream_with_context
 from flask_cors import CORS
-import requests
 import re
 import sys
 import os
 import json
+import io
+import gzip
+import math
 import base64
+import time
+import hashlib
+import shutil
+import sqlite3
+import tempfile
+import subprocess
+import queue
+import threading
+import uuid
+import weakref
+import mmap
+import random
+import struct
+import functools
+import heapq
+import importlib
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 
-# Optional PDF support
+# Heavy and optional dependencies are imported on first use, so cold starts
+# (and the static pages) never pay for them. bench/startup.py guards this.
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+requests = LazyModule("requests")
+
+@functools.lru_cache(maxsize=None)
+def optional_module(name):
+    """The named module, or None if it is not installed: PDF support
+    (pdf2image) and image preprocessing (PIL.Image / PIL.ImageOps)."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+# Optional cross-process file locking (near-duplicate index appends)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Optional fast JSON decoding for stream chunks
 try:
-    from pdf2image import convert_from_path # type: ignore
-    PDF_SUPPORT = True
+    import orjson # type: ignore
+    json_loads = orjson.loads
 except ImportError:
-    PDF_SUPPORT = False
+    json_loads = json.loads
 
 load_dotenv()
 
@@ -24,18 +80,183 @@ CORS(app)
 # DATA DIRS
 # DATA DIRS
 # In Vercel (Lambda), only /tmp is writable
-UPLOAD_FOLDER = '/tmp/vectora_uploads'
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+UPLOAD_FOLDER = '/tmp/vectora_uploads' # created on first upload
+PAGE_CACHE_DIR = os.path.join(UPLOAD_FOLDER, 'pages')
 
 # ✅ API Keys
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 CEREBRAS_API_KEY = os.getenv("CEREBRAS_API_KEY")
 
-# Base URLs
-GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
-GROQ_BASE_URL = "https://api.groq.com/openai/v1"
-CEREBRAS_BASE_URL = "https://api.cerebras.ai/v1"
+# Base URLs (overridable, e.g. to point at bench/mock_provider.py)
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_UPLOAD_URL = os.getenv("GEMINI_UPLOAD_URL", "https://generativelanguage.googleapis.com/upload/v1beta/files")
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL", "https://api.groq.com/openai/v1")
+CEREBRAS_BASE_URL = os.getenv("CEREBRAS_BASE_URL", "https://api.cerebras.ai/v1")
+
+PROVIDER_KEYS = {"gemini": GEMINI_API_KEY, "groq": GROQ_API_KEY, "cerebras": CEREBRAS_API_KEY}
+
+# HTTP client tuning (shared by every outbound provider call)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.3"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+
+# End-to-end deadlines: every provider call of a request (or job) is cut off
+# once its deadline passes (0 = none). Checks nobody is watching any more
+# (all clients disconnected) are cancelled upstream.
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "120"))
+JOB_DEADLINE = float(os.getenv("JOB_DEADLINE", "900"))
+CANCEL_ON_DISCONNECT = os.getenv("CANCEL_ON_DISCONNECT", "true").lower() == "true"
+
+# /api/models cache: fresh for MODELS_CACHE_TTL, then served stale (and
+# revalidated in the background) for up to MODELS_CACHE_STALE more seconds.
+MODELS_CACHE_TTL = int(os.getenv("MODELS_CACHE_TTL", "600"))
+MODELS_CACHE_STALE = int(os.getenv("MODELS_CACHE_STALE", "86400"))
+
+# Gemini Files API: files live 48h; re-upload a little before that.
+GEMINI_FILE_LIFETIME = 48 * 3600
+GEMINI_FILE_EXPIRY_MARGIN = int(os.getenv("GEMINI_FILE_EXPIRY_MARGIN", "3600"))
+GEMINI_UPLOAD_CHUNK_SIZE = int(os.getenv("GEMINI_UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024))) # multiple of 256 KiB
+GEMINI_UPLOAD_MAX_RESUMES = int(os.getenv("GEMINI_UPLOAD_MAX_RESUMES", "3"))
+
+# Gemini context caching (cachedContents) of the fact-check instruction together
+# with an uploaded document. Only contexts of at least GEMINI_CACHE_MIN_TOKENS
+# (estimated; 4x that for Pro models) are cached, as Gemini rejects smaller
+# ones; the instruction alone never qualifies. Caches are created in the
+# background and used from the next identical (model, document) request on; a
+# failed creation is retried after GEMINI_CACHE_RETRY seconds.
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "true").lower() == "true"
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CACHE_MIN_TOKENS", "1024"))
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", "1800"))
+GEMINI_CACHE_MAX = int(os.getenv("GEMINI_CACHE_MAX", "64"))
+GEMINI_CACHE_RETRY = int(os.getenv("GEMINI_CACHE_RETRY", "3600"))
+
+# PDF rasterization (non-native models such as Groq)
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "5"))
+PDF_DPI = int(os.getenv("PDF_DPI", "150"))
+PDF_JPEG_QUALITY = int(os.getenv("PDF_JPEG_QUALITY", "85"))
+PDF_RENDER_THREADS = int(os.getenv("PDF_RENDER_THREADS", str(min(4, os.cpu_count() or 1))))
+
+# Inline image budgets. IMAGE_MAX_BYTES/IMAGE_REQUEST_BUDGET are measured on
+# the base64 form (Groq rejects base64 image payloads over 4 MB).
+IMAGE_MAX_SIDE = {
+    "groq": int(os.getenv("IMAGE_MAX_SIDE_GROQ", "1536")),
+    "cerebras": int(os.getenv("IMAGE_MAX_SIDE_CEREBRAS", "1024"))
+}
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(2 * 1024 * 1024)))
+IMAGE_REQUEST_BUDGET = int(os.getenv("IMAGE_REQUEST_BUDGET", str(4 * 1024 * 1024)))
+IMAGE_CACHE_BYTES = int(os.getenv("IMAGE_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# Remote media for /ai-check
+MEDIA_FETCH_MAX_BYTES = int(os.getenv("MEDIA_FETCH_MAX_BYTES", str(15 * 1024 * 1024)))
+MEDIA_FETCH_DEADLINE = float(os.getenv("MEDIA_FETCH_DEADLINE", "15"))
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", "256"))
+MEDIA_CACHE_TTL = int(os.getenv("MEDIA_CACHE_TTL", "3600"))
+VIDEO_FRAME_COUNT = int(os.getenv("VIDEO_FRAME_COUNT", "4"))
+VIDEO_SCAN_SECONDS = int(os.getenv("VIDEO_SCAN_SECONDS", "30"))
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+# Scheduler: SCHED_MAX_IN_FLIGHT / SCHED_RPM / SCHED_TPM / SCHED_MAX_QUEUE /
+# SCHED_MAX_WAIT, each overridable per provider (e.g. SCHED_GROQ_RPM=30).
+# RPM/TPM of 0 mean unlimited.
+SCHED_OUTPUT_TOKENS = int(os.getenv("SCHED_OUTPUT_TOKENS", "1024"))
+SCHED_FILE_TOKENS = int(os.getenv("SCHED_FILE_TOKENS", "1500"))
+
+# Uploads: per-file size limit, and how long the sweeper lets stray uploads
+# and cached PDF pages live under UPLOAD_FOLDER.
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+UPLOAD_TTL = int(os.getenv("UPLOAD_TTL", "900"))
+PAGE_CACHE_TTL = int(os.getenv("PAGE_CACHE_TTL", "3600"))
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL", "300"))
+
+# Metrics: requests slower than SLOW_REQUEST_MS are logged to stderr with a
+# per-stage breakdown (0 = off).
+SLOW_REQUEST_MS = int(os.getenv("SLOW_REQUEST_MS", "0"))
+
+# Provider routing: ordered fallback chains ("provider:model,...") per
+# capability, tried after the model the user picked. HEDGE_AFTER_MS > 0 starts
+# the next candidate in parallel when the first has not produced a token yet.
+ROUTE_CHAINS = {
+    "text": os.getenv("ROUTE_TEXT", "gemini:gemini-2.0-flash,groq:openai/gpt-oss-120b,cerebras:llama3.1-8b"),
+    "image": os.getenv("ROUTE_IMAGE", "gemini:gemini-2.0-flash,groq:meta-llama/llama-4-scout-17b-16e-instruct"),
+    "web_search": os.getenv("ROUTE_WEB_SEARCH", "gemini:gemini-2.0-flash,groq:groq/compound")
+}
+ROUTING_FAILOVER = os.getenv("ROUTING_FAILOVER", "true").lower() == "true"
+HEDGE_AFTER_MS = int(os.getenv("HEDGE_AFTER_MS", "0"))
+AI_CHECK_MODELS = [m.strip() for m in os.getenv("AI_CHECK_MODELS", "llama-3.3-70b,llama3.1-8b").split(",") if m.strip()]
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "3"))
+BREAKER_COOLDOWN = int(os.getenv("BREAKER_COOLDOWN", "30"))
+BREAKER_HARD_COOLDOWN = int(os.getenv("BREAKER_HARD_COOLDOWN", "600")) # unknown model / bad key
+
+# /ai-check/batch limits
+AI_CHECK_BATCH_MAX = int(os.getenv("AI_CHECK_BATCH_MAX", "50"))
+AI_CHECK_BATCH_CONCURRENCY = int(os.getenv("AI_CHECK_BATCH_CONCURRENCY", "8"))
+
+# Extension gateway (/api/extension/<kind>): checks per minute per client
+# address, and how much visible page text a page check looks at. The address
+# is taken from X-Forwarded-For only as far as PROXY_HOPS trusted proxies
+# appended it. Without a proxy that header is the client's own claim, so the
+# default is 0, except on Vercel (VERCEL=1), whose edge always sets it.
+PROXY_HOPS = int(os.getenv("PROXY_HOPS", "1" if os.getenv("VERCEL") else "0"))
+EXTENSION_RPM = int(os.getenv("EXTENSION_RPM", "30")) # 0 = unlimited
+EXTENSION_CLIENTS_MAX = int(os.getenv("EXTENSION_CLIENTS_MAX", "10000")) # rate-limit buckets kept (LRU)
+EXTENSION_PAGE_CHARS = int(os.getenv("EXTENSION_PAGE_CHARS", "6000"))
+
+# Gzip for large buffered responses (/api/models, /ai-check/batch, pages).
+# Gateway verdicts are ~100 bytes, which gzip's framing would only grow.
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1024")) # smaller (or streamed) responses go out as is; 0 = off
+
+# Claim decomposition (/process with decompose=true): a fast model splits the
+# input into claims, which are verified concurrently. CLAIM_VERIFY_MODELS is a
+# route list the claims are spread over (default: the model the user picked).
+CLAIM_EXTRACT_MODEL = os.getenv("CLAIM_EXTRACT_MODEL", "cerebras:llama3.1-8b")
+CLAIM_VERIFY_MODELS = os.getenv("CLAIM_VERIFY_MODELS", "")
+CLAIM_MAX = int(os.getenv("CLAIM_MAX", "8"))
+CLAIM_CONCURRENCY = int(os.getenv("CLAIM_CONCURRENCY", "4"))
+
+# Near-duplicate index: answers paraphrased text (MinHash of character
+# 5-grams) and recompressed images (64-bit dHash) with an earlier verdict of
+# the same provider/model. Texts must also agree on negations and numbers, which
+# character shingles barely see. A one-word rewording or an added "BREAKING:"
+# scores about 0.8. Only the first NEAR_DUP_MAX_CHARS of a text are hashed.
+# Stored under NEAR_DUP_DIR and memory-mapped; expires with the verdict TTLs
+# and is compacted past NEAR_DUP_MAX_ENTRIES.
+NEAR_DUP_ENABLED = os.getenv("NEAR_DUP_ENABLED", "true").lower() == "true"
+NEAR_DUP_DIR = os.getenv("NEAR_DUP_DIR", "/tmp/vectora_index")
+NEAR_DUP_TEXT_THRESHOLD = float(os.getenv("NEAR_DUP_TEXT_THRESHOLD", "0.8")) # estimated Jaccard
+NEAR_DUP_IMAGE_DISTANCE = int(os.getenv("NEAR_DUP_IMAGE_DISTANCE", "6")) # differing bits of 64
+NEAR_DUP_MIN_CHARS = int(os.getenv("NEAR_DUP_MIN_CHARS", "40"))
+NEAR_DUP_MAX_CHARS = int(os.getenv("NEAR_DUP_MAX_CHARS", "8192")) # pure-Python MinHash: ~20 ms per KB
+NEAR_DUP_MAX_ENTRIES = int(os.getenv("NEAR_DUP_MAX_ENTRIES", "10000")) # per index
+
+# Job queue (POST /jobs): SQLite-backed, so queued and half-done jobs survive
+# a restart. Job uploads live in JOBS_DIR, outside the upload sweeper's reach.
+JOBS_DB = os.getenv("JOBS_DB", "/tmp/vectora_jobs.sqlite3")
+JOBS_DIR = os.getenv("JOBS_DIR", "/tmp/vectora_jobs")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2")) # per process; 0 = accept jobs, run them elsewhere
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "100")) # queued jobs before POST /jobs answers 429
+# Running jobs heartbeat every JOB_LEASE / 4 seconds; one silent for a whole
+# lease (its worker died) is requeued, at most JOB_MAX_ATTEMPTS times in all.
+# The lease always outlasts JOB_DEADLINE, so a live job is never run twice.
+JOB_LEASE = int(os.getenv("JOB_LEASE", "1200"))
+if JOB_DEADLINE > 0:
+    JOB_LEASE = max(JOB_LEASE, int(JOB_DEADLINE) + 60)
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_TTL = int(os.getenv("JOB_TTL", "86400")) # finished jobs are kept this long
+JOB_FLUSH_MS = int(os.getenv("JOB_FLUSH_MS", "250")) # partial output is persisted at least this often
+
+# Verdict cache: in-memory LRU, plus an optional SQLite tier when
+# VERDICT_CACHE_DB is set (e.g. /tmp/vectora_verdicts.sqlite3).
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", "1024"))
+VERDICT_CACHE_DB = os.getenv("VERDICT_CACHE_DB", "")
+VERDICT_TTL = {
+    "process": int(os.getenv("VERDICT_TTL_PROCESS", "21600")),
+    "web_search": int(os.getenv("VERDICT_TTL_WEB_SEARCH", "3600")), # live search results age quickly
+    "ai_check": int(os.getenv("VERDICT_TTL_AI_CHECK", "86400"))
+}
 
 
 def extract_probability(text):
@@ -44,15 +265,1004 @@ def extract_probability(text):
     if match: return int(match.group(1))
     return None
 
+# --- PROVIDER CLIENTS ---
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(provider):
+    """Returns the pooled keep-alive Session for a provider ("gemini", "groq", "cerebras", "fetch")."""
+    session = _sessions.get(provider)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _sessions.get(provider)
+        if session is None:
+            # Only connection failures are retried: the request never reached the
+            # upstream, so replaying a POST cannot double-bill a generation.
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(
+                total=HTTP_MAX_RETRIES,
+                connect=HTTP_MAX_RETRIES,
+                read=0,
+                status=0,
+                backoff_factor=HTTP_RETRY_BACKOFF,
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[provider] = session
+    return session
+
+def provider_request(provider, method, url, timeout=None, **kwargs):
+    """Sends a request through the provider's pooled session with explicit (connect, read) timeouts."""
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    elif not isinstance(timeout, tuple):
+        timeout = (min(HTTP_CONNECT_TIMEOUT, timeout), timeout)
+    deadline = current_deadline.get()
+    if deadline is not None:
+        deadline.check()
+        remaining = deadline.remaining()
+        if remaining is not None:
+            timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+    resp = get_session(provider).request(method, url, timeout=timeout, **kwargs)
+    if deadline is not None and kwargs.get("stream"):
+        deadline.track(resp)
+    scope = current_cancel_scope.get()
+    if scope is not None and kwargs.get("stream"):
+        scope.track(resp)
+    return resp
+
+# --- DEADLINES ---
+
+class Cancelled(Exception):
+    """The request's deadline passed, or nobody is waiting for its answer any more."""
+
+class Deadline:
+    """End-to-end budget of one request or job, shared by every thread working
+    on it (through current_deadline). cancel() aborts its open upstream
+    streams so the threads reading them stop at once; the deadline watchdog
+    cancels it when time runs out."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds if seconds > 0 else None
+        self.cancelled = None # reason, once cancelled
+        self.responses = weakref.WeakSet()
+        self.wakers = set() # wake() of callers queued for a scheduler slot
+        self.watched = False
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        return None if self.expires is None else max(0.001, self.expires - time.monotonic())
+
+    def check(self):
+        if self.cancelled is None and self.expires is not None and time.monotonic() >= self.expires:
+            self.cancel("deadline")
+        if self.cancelled is not None:
+            raise Cancelled(self.reason())
+
+    def reason(self):
+        if self.cancelled == "deadline":
+            return f"Request deadline of {self.seconds:g}s exceeded"
+        if self.cancelled == "lease":
+            return "Job taken over by another worker"
+        return "Request cancelled: client disconnected"
+
+    def cancel(self, reason="disconnect"):
+        with self.lock:
+            if self.cancelled is not None:
+                return
+            self.cancelled = reason
+            responses = list(self.responses)
+            wakers = list(self.wakers)
+        CANCELLATIONS.inc(reason=reason)
+        for resp in responses:
+            abort_response(resp)
+        for wake in wakers:
+            wake()
+
+    def add_waker(self, wake):
+        """Registers a queued caller's wake() to call on cancel()."""
+        with self.lock:
+            self.wakers.add(wake)
+
+    def remove_waker(self, wake):
+        with self.lock:
+            self.wakers.discard(wake)
+
+    def track(self, resp):
+        """Registers an open upstream stream to abort on cancel()."""
+        with self.lock:
+            if self.cancelled is None:
+                self.responses.add(resp)
+                watch = not self.watched and self.expires is not None
+                self.watched = True
+            else:
+                watch = False
+        if self.cancelled is not None:
+            abort_response(resp)
+        if watch:
+            watch_deadline(self)
+
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+class CancelScope:
+    """Streams of one hedged candidate. set() aborts them, so a loser still
+    waiting for its first token frees its connection and slot at once
+    instead of when that token (or the read timeout) arrives."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.responses = weakref.WeakSet()
+        self.lock = threading.Lock()
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def set(self):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            responses = list(self.responses)
+        for resp in responses:
+            abort_response(resp)
+
+    def track(self, resp):
+        with self.lock:
+            if not self.event.is_set():
+                self.responses.add(resp)
+                return
+        abort_response(resp)
+
+current_cancel_scope = contextvars.ContextVar("current_cancel_scope", default=None)
+
+def start_deadline(seconds):
+    deadline = Deadline(seconds)
+    current_deadline.set(deadline)
+    return deadline
+
+def check_deadline():
+    """Raises Cancelled once the current request is past its deadline or cancelled."""
+    deadline = current_deadline.get()
+    if deadline is not None:
+        deadline.check()
+
+def abort_response(resp):
+    """Unblocks a thread reading a streamed response: shuts the socket down
+    (urllib3 >= 2.3), or closes the response on older versions."""
+    try:
+        resp.raw.shutdown()
+    except (AttributeError, ValueError, RuntimeError, OSError):
+        try:
+            resp.close()
+        except Exception:
+            pass
+
+_deadline_heap = [] # (expires, seq, deadline) of deadlines with open streams
+_deadline_cond = threading.Condition()
+_deadline_seq = 0
+_deadline_watchdog = None
+
+def watch_deadline(deadline):
+    """Has the watchdog cancel the deadline on time, even if its stream stalls."""
+    global _deadline_seq, _deadline_watchdog
+    with _deadline_cond:
+        _deadline_seq += 1
+        heapq.heappush(_deadline_heap, (deadline.expires, _deadline_seq, deadline))
+        _deadline_cond.notify()
+        if _deadline_watchdog is None:
+            _deadline_watchdog = threading.Thread(target=_watch_deadlines, name="deadline-watchdog", daemon=True)
+            _deadline_watchdog.start()
+
+def _watch_deadlines():
+    while True:
+        with _deadline_cond:
+            while not _deadline_heap or _deadline_heap[0][0] > time.monotonic():
+                _deadline_cond.wait(_deadline_heap[0][0] - time.monotonic() if _deadline_heap else None)
+            deadline = heapq.heappop(_deadline_heap)[2]
+        if deadline.cancelled is None and deadline.responses:
+            deadline.cancel("deadline")
+
+# --- METRICS ---
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RATE_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800, 1600)
+
+def _labels_text(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+class Counter:
+    """Monotonic counter with a fixed label set, rendered in Prometheus text format."""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_labels_text(self.labels, key)} {value}")
+        return lines
+
+class Histogram:
+    """Cumulative-bucket histogram with a fixed label set."""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {} # label values -> [count per bucket..., +Inf count, sum]
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        with self.lock:
+            row = self.values.get(key)
+            if row is None:
+                row = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += 1
+            row[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        with self.lock:
+            for key, row in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, row):
+                    lines.append(f"{self.name}_bucket{_labels_text(names, key + (bound,))} {count}")
+                lines.append(f"{self.name}_bucket{_labels_text(names, key + ('+Inf',))} {row[-2]}")
+                lines.append(f"{self.name}_sum{_labels_text(self.labels, key)} {round(row[-1], 6)}")
+                lines.append(f"{self.name}_count{_labels_text(self.labels, key)} {row[-2]}")
+        return lines
+
+_metrics = []
+
+REQUESTS_TOTAL = Counter("vectora_requests_total", "HTTP requests by route and status.", ("route", "status"))
+REQUEST_SECONDS = Histogram("vectora_request_seconds", "Request duration including the streamed body.", ("route",))
+STAGE_SECONDS = Histogram("vectora_stage_seconds", "Time spent in one pipeline stage.", ("stage", "provider", "model"))
+TTFB_SECONDS = Histogram("vectora_ttfb_seconds", "Time from provider call to first answer token.", ("provider", "model"))
+TOKENS_PER_SECOND = Histogram("vectora_stream_tokens_per_second", "Answer throughput after the first token (~4 chars/token).",
+                              ("provider", "model"), RATE_BUCKETS)
+PROVIDER_ERRORS = Counter("vectora_provider_errors_total", "Failed provider calls by error.", ("provider", "model", "error"))
+CACHE_LOOKUPS = Counter("vectora_verdict_cache_lookups_total", "Verdict cache lookups.", ("kind", "result"))
+CONTEXT_CACHE_EVENTS = Counter("vectora_gemini_context_cache_total", "Gemini context cache hits, misses, creations and failures.",
+                               ("event",))
+NEAR_DUP_LOOKUPS = Counter("vectora_near_dup_lookups_total", "Near-duplicate index lookups.", ("index", "result"))
+JOBS_FINISHED = Counter("vectora_jobs_finished_total", "Background jobs by final status.", ("status",))
+CANCELLATIONS = Counter("vectora_cancellations_total", "Requests cut off upstream: client disconnect or deadline.", ("reason",))
+EXTENSION_REQUESTS = Counter("vectora_extension_requests_total", "Extension gateway checks by kind and status.", ("kind", "status"))
+AI_CHECK_PARSE_FALLBACKS = Counter("vectora_ai_check_parse_fallbacks_total", "ai-check answers that needed regex parsing.")
+
+@functools.lru_cache(maxsize=4)
+def _catalog_targets(etag):
+    return {(p, m["id"]) for p, models in _models_cache["models"].items() for m in models}
+
+def metric_labels(provider, model):
+    """(provider, model) label values: anything outside the configured
+    providers, the model catalog and the configured routes becomes "other",
+    so series cannot be created from client input."""
+    if provider and provider not in DEFAULT_MODELS:
+        return "other", "other" if model else ""
+    if model and (provider, model) not in CONFIGURED_TARGETS \
+            and (provider, model) not in _catalog_targets(_models_cache["etag"]):
+        return provider, "other"
+    return provider, model
+
+class Trace:
+    """Per-request stage timings, kept for the slow-request log."""
+
+    def __init__(self, route):
+        self.route = route
+        self.start = time.perf_counter()
+        self.stages = []
+
+    def add(self, stage, seconds, **labels):
+        self.stages.append(dict(labels, stage=stage, ms=round(seconds * 1000, 1)))
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def start_trace(route):
+    trace = Trace(route)
+    current_trace.set(trace)
+    return trace
+
+def finish_trace(trace, status):
+    elapsed = time.perf_counter() - trace.start
+    REQUESTS_TOTAL.inc(route=trace.route, status=status)
+    REQUEST_SECONDS.observe(elapsed, route=trace.route)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        print(json.dumps({"slow_request": trace.route, "status": status, "ms": round(elapsed * 1000, 1),
+                          "stages": trace.stages}), file=sys.stderr)
+
+@contextmanager
+def span(stage, provider="", model=""):
+    """Times a block into vectora_stage_seconds and the current request's trace."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        label_provider, label_model = metric_labels(provider, model)
+        STAGE_SECONDS.observe(elapsed, stage=stage, provider=label_provider, model=label_model)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add(stage, elapsed, provider=provider, model=model)
+
+def timed(stage, provider=""):
+    """Decorator form of span() for whole helper functions."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage, provider):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class StreamMeter:
+    """TTFB, stream time and throughput of one provider stream."""
+
+    def __init__(self, provider, model):
+        self.provider = provider
+        self.model = model
+        self.labels = metric_labels(provider, model)
+        self.start = time.perf_counter()
+        self.first = None
+        self.chars = 0
+
+    def chunk(self, text):
+        if text.startswith("//"):
+            return
+        if self.first is None:
+            self.first = time.perf_counter()
+            TTFB_SECONDS.observe(self.first - self.start, provider=self.labels[0], model=self.labels[1])
+        self.chars += len(text)
+
+    def close(self):
+        end = time.perf_counter()
+        trace = current_trace.get()
+        if self.first is None:
+            return
+        if trace is not None:
+            trace.add("ttfb", self.first - self.start, provider=self.provider, model=self.model)
+            trace.add("stream", end - self.first, provider=self.provider, model=self.model)
+        STAGE_SECONDS.observe(end - self.start, stage="stream", provider=self.labels[0], model=self.labels[1])
+        if end > self.first:
+            TOKENS_PER_SECOND.observe(self.chars / 4 / (end - self.first), provider=self.labels[0], model=self.labels[1])
+
+def render_metrics():
+    """Prometheus text exposition: registered metrics plus live runtime state."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+
+    def gauge(name, help_text, kind, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{_labels_text(tuple(labels), tuple(labels.values()))} {value}")
+
+    with _sse_stats_lock:
+        sse = {p: dict(v) for p, v in sse_stats.items()}
+    gauge("vectora_sse_events_total", "SSE events decoded per provider.", "counter",
+          [({"provider": p}, v["events"]) for p, v in sorted(sse.items())])
+    gauge("vectora_sse_malformed_total", "Undecodable SSE payloads per provider.", "counter",
+          [({"provider": p}, v["malformed"]) for p, v in sorted(sse.items())])
+
+    snapshots = sorted((key, scheduler.snapshot()) for key, scheduler in list(_schedulers.items()))
+    for field, kind in (("in_flight", "gauge"), ("queued", "gauge"), ("admitted", "counter"),
+                        ("rejected", "counter"), ("timed_out", "counter")):
+        name = f"vectora_scheduler_{field}" + ("_total" if kind == "counter" else "")
+        gauge(name, f"Scheduler {field.replace('_', ' ')} per provider key.", kind,
+              [({"scheduler": key}, snap[field]) for key, snap in snapshots])
+
+    now = time.time()
+    with breaker.lock:
+        states = sorted((key, st["open_until"] > now) for key, st in breaker.state.items())
+    gauge("vectora_breaker_open", "1 while a provider/model circuit breaker is open.", "gauge",
+          [({"provider": key[0], "model": key[1]}, int(is_open)) for key, is_open in states])
+
+    gauge("vectora_coalesced_requests_total", "Requests that led or joined an identical in-flight check.", "counter",
+          [({"endpoint": endpoint, "role": role[:-1]}, flights.stats[role])
+           for endpoint, flights in (("process", process_flights), ("ai_check", ai_check_flights))
+           for role in ("leaders", "followers")])
+    gauge("vectora_verdict_cache_entries", "Verdicts held in memory.", "gauge", [({}, len(verdict_cache.entries))])
+    if _job_store is not None:
+        gauge("vectora_jobs", "Jobs in the job store by status.", "gauge",
+              [({"status": status}, count) for status, count in sorted(_job_store.counts().items())])
+    return "\n".join(lines) + "\n"
+
+# --- SCHEDULER ---
+
+class Overloaded(Exception):
+    """Admission refused: the provider's queue is full or the wait ran out."""
+
+    def __init__(self, provider, retry_after):
+        super().__init__(f"{provider} is at capacity, retry in {retry_after}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Classic token bucket; capacity per minute, refilled continuously. 0 = unlimited."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount is available (after refill)."""
+        if not self.capacity:
+            return 0.0
+        amount = min(amount, self.capacity) # oversized requests wait for a full bucket
+        return max(0.0, (amount - self.level) * 60.0 / self.capacity)
+
+    def take(self, amount):
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+class Ticket:
+    """An admitted request's slot; release() is idempotent."""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.provider = scheduler.provider
+        self.released = False
+
+    def release(self):
+        self.scheduler.release(self)
+
+class _Waiter:
+    """A queued caller. wake() may be called from any thread; async waiters
+    get their event set on their own loop."""
+
+    def __init__(self, event, wake):
+        self.event = event
+        self.wake = wake
+
+class ProviderScheduler:
+    """Admission control for one (provider, API key): max in-flight calls plus
+    request and token buckets. Excess callers queue FIFO for at most max_wait
+    seconds (only the head of the queue may be admitted, so nobody jumps it);
+    when max_queue callers are already waiting, new ones are shed. Threads
+    use acquire(), coroutines aacquire(), and both share one queue."""
+
+    def __init__(self, provider, max_in_flight, rpm, tpm, max_queue, max_wait):
+        self.provider = provider
+        self.max_in_flight = max_in_flight
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.waiters = deque()
+        self.lock = threading.Lock()
+        self.stats = {"admitted": 0, "rejected": 0, "timed_out": 0, "wait_total": 0.0, "wait_max": 0.0}
+
+    def _wait_time(self, tokens, now):
+        """0 when a call could start now, else a best guess of the delay."""
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        delay = max(self.requests.wait_time(1), self.tokens.wait_time(tokens), self.paused_until - now)
+        if self.in_flight >= self.max_in_flight:
+            delay = max(delay, 0.05) # woken early by release()
+        return delay
+
+    def _admit(self, tokens, start):
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.in_flight += 1
+        waited = time.monotonic() - start
+        self.stats["admitted"] += 1
+        self.stats["wait_total"] += waited
+        self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+
+    def _wake_head(self):
+        if self.waiters:
+            self.waiters[0].wake()
+
+    def _leave(self, waiter):
+        if waiter in self.waiters:
+            head = self.waiters[0] is waiter
+            self.waiters.remove(waiter)
+            if head:
+                self._wake_head()
+
+    def _limits(self, max_wait, deadline):
+        max_wait = self.max_wait if max_wait is None else max_wait
+        if deadline is not None and deadline.remaining() is not None:
+            max_wait = min(max_wait, deadline.remaining())
+        return max_wait
+
+    def _enter(self, tokens, start, waiter):
+        """Admits at once when nobody is queued and there is capacity (True),
+        else queues waiter (False); Overloaded when the queue is full."""
+        with self.lock:
+            if not self.waiters and self._wait_time(tokens, start) <= 0:
+                self._admit(tokens, start)
+                return True
+            if len(self.waiters) >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise Overloaded(self.provider, self._retry_after(tokens, start))
+            self.waiters.append(waiter)
+            return False
+
+    def _poll(self, tokens, start, until, waiter, deadline):
+        """One check by a queued waiter: None once admitted, else how long to
+        sleep. Leaves the queue and raises on cancellation or timeout."""
+        with self.lock:
+            now = time.monotonic()
+            delay = until - now
+            if self.waiters[0] is waiter:
+                delay = self._wait_time(tokens, now)
+                if delay <= 0:
+                    self.waiters.popleft()
+                    self._admit(tokens, start)
+                    self._wake_head() # the next one may fit too
+                    return None
+            if deadline is not None and deadline.cancelled is not None:
+                self._leave(waiter)
+                raise Cancelled(deadline.reason())
+            if now >= until:
+                self.stats["timed_out"] += 1
+                self._leave(waiter)
+                raise Overloaded(self.provider, self._retry_after(tokens, now))
+            return min(delay, until - now)
+
+    def acquire(self, tokens=0, max_wait=None, deadline=None):
+        start = time.monotonic()
+        until = start + self._limits(max_wait, deadline)
+        event = threading.Event()
+        waiter = _Waiter(event, event.set)
+        if self._enter(tokens, start, waiter):
+            return Ticket(self)
+        if deadline is not None:
+            deadline.add_waker(waiter.wake) # a cancelled caller leaves the queue at once
+        try:
+            while True:
+                delay = self._poll(tokens, start, until, waiter, deadline)
+                if delay is None:
+                    return Ticket(self)
+                event.wait(delay)
+                event.clear()
+        except BaseException:
+            with self.lock:
+                self._leave(waiter)
+            raise
+        finally:
+            if deadline is not None:
+                deadline.remove_waker(waiter.wake)
+
+    async def aacquire(self, tokens=0, max_wait=None, deadline=None):
+        """acquire() for the event loop: waits on an asyncio.Event instead of
+        holding a worker thread."""
+        import asyncio
+        start = time.monotonic()
+        until = start + self._limits(max_wait, deadline)
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = _Waiter(event, lambda: loop.call_soon_threadsafe(event.set))
+        if self._enter(tokens, start, waiter):
+            return Ticket(self)
+        if deadline is not None:
+            deadline.add_waker(waiter.wake)
+        try:
+            while True:
+                delay = self._poll(tokens, start, until, waiter, deadline)
+                if delay is None:
+                    return Ticket(self)
+                try:
+                    await asyncio.wait_for(event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+        except BaseException: # includes task cancellation
+            with self.lock:
+                self._leave(waiter)
+            raise
+        finally:
+            if deadline is not None:
+                deadline.remove_waker(waiter.wake)
+
+    def release(self, ticket):
+        """Frees ticket's slot; releasing the same ticket again does nothing
+        (a cancelled stream may be released by two threads)."""
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self.in_flight -= 1
+            self._wake_head()
+
+    def pause(self, seconds):
+        """Upstream said 429: hold new admissions for its Retry-After."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _retry_after(self, tokens, now):
+        return max(1, int(math.ceil(self._wait_time(tokens, now))))
+
+    def snapshot(self):
+        with self.lock:
+            admitted = self.stats["admitted"]
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "queued": len(self.waiters),
+                "max_queue": self.max_queue,
+                "admitted": admitted,
+                "rejected": self.stats["rejected"],
+                "timed_out": self.stats["timed_out"],
+                "wait_avg_ms": round(self.stats["wait_total"] * 1000 / admitted, 1) if admitted else 0.0,
+                "wait_max_ms": round(self.stats["wait_max"] * 1000, 1)
+            }
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def _sched_setting(provider, name, default):
+    return int(os.getenv(f"SCHED_{provider.upper()}_{name}", os.getenv(f"SCHED_{name}", default)))
+
+def get_scheduler(provider, api_key=None):
+    """Scheduler for a (provider, API key) pair; limits come from
+    SCHED_<PROVIDER>_<SETTING>, falling back to SCHED_<SETTING>."""
+    if api_key is None:
+        api_key = PROVIDER_KEYS.get(provider) or ""
+    key = f"{provider}:{hashlib.sha1(api_key.encode('utf-8')).hexdigest()[:8]}"
+    scheduler = _schedulers.get(key)
+    if scheduler is None:
+        with _schedulers_lock:
+            scheduler = _schedulers.get(key)
+            if scheduler is None:
+                scheduler = ProviderScheduler(
+                    provider,
+                    max_in_flight=_sched_setting(provider, "MAX_IN_FLIGHT", "32"),
+                    rpm=_sched_setting(provider, "RPM", "0"),
+                    tpm=_sched_setting(provider, "TPM", "0"),
+                    max_queue=_sched_setting(provider, "MAX_QUEUE", "64"),
+                    max_wait=_sched_setting(provider, "MAX_WAIT", "10")
+                )
+                _schedulers[key] = scheduler
+    return scheduler
+
+def estimate_tokens(prompt, file_path=None):
+    """Rough token cost used for TPM budgeting: prompt + expected answer (+ attachment)."""
+    return len(prompt) // 4 + SCHED_OUTPUT_TOKENS + (SCHED_FILE_TOKENS if file_path else 0)
+
+def acquire_slot(provider, tokens=0, max_wait=None):
+    """Admits one provider call; waits no longer than the request's deadline allows."""
+    return get_scheduler(provider).acquire(tokens, max_wait, current_deadline.get())
+
+async def aacquire_slot(provider, tokens=0, max_wait=None):
+    """acquire_slot() for coroutines (asgi.py)."""
+    return await get_scheduler(provider).aacquire(tokens, max_wait, current_deadline.get())
+
+# --- SSE DECODING ---
+
+class ProviderError(Exception):
+    """Upstream returned a non-success status instead of a stream."""
+
+    def __init__(self, provider, status, body="", retry_after=None):
+        super().__init__(f"{provider} API error {status}: {body[:200]}")
+        self.provider = provider
+        self.status = status
+        self.retry_after = retry_after
+
+def parse_retry_after(headers):
+    value = headers.get("Retry-After")
+    return float(value) if value and value.replace(".", "", 1).isdigit() else None
+
+# Per-provider decoder counters: events seen, malformed (undecodable) payloads
+sse_stats = {}
+_sse_stats_lock = threading.Lock()
+
+def _count_sse(provider, field):
+    with _sse_stats_lock:
+        stats = sse_stats.setdefault(provider, {"events": 0, "malformed": 0})
+        stats[field] += 1
+
+class SSEDecoder:
+    """Incremental Server-Sent Events decoder working on raw bytes.
+
+    Network chunks are appended to one buffer and split on any line ending
+    (CRLF, LF or CR); consecutive data: lines are joined with newlines and
+    emitted as one event on the blank line that ends it. Payloads stay as
+    bytes, which both orjson and json.loads accept directly.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.data = []
+
+    def feed(self, chunk):
+        """Adds bytes and returns the list of completed event payloads."""
+        self.buffer += chunk
+        events = []
+        start = 0
+        buf = self.buffer
+        while True:
+            lf = buf.find(b"\n", start)
+            cr = buf.find(b"\r", start, lf if lf != -1 else len(buf))
+            if cr == -1:
+                if lf == -1:
+                    break
+                end, start_next = lf, lf + 1
+            elif cr + 1 == len(buf):
+                break # maybe the first half of a CRLF split across chunks
+            else:
+                end, start_next = cr, cr + 2 if buf[cr + 1] == 0x0A else cr + 1
+            self._line(bytes(buf[start:end]), events)
+            start = start_next
+        del buf[:start]
+        return events
+
+    def close(self):
+        """Flushes a trailing event the upstream did not terminate."""
+        events = []
+        if self.buffer:
+            self._line(bytes(self.buffer.rstrip(b"\r")), events)
+            self.buffer.clear()
+        self._line(b"", events)
+        return events
+
+    def _line(self, line, events):
+        if not line:
+            if self.data:
+                events.append(b"\n".join(self.data))
+                self.data = []
+            return
+        if line.startswith(b"data:"):
+            value = line[5:]
+            self.data.append(value[1:] if value.startswith(b" ") else value)
+        # event:, id:, retry: and ":" comments carry nothing we use
+
+def iter_sse_json(resp, provider):
+    """Yields decoded JSON payloads from a streaming provider response.
+
+    Stops at the OpenAI-style [DONE] sentinel. Payloads that fail to decode
+    are counted in sse_stats (and logged) instead of being silently dropped.
+    """
+    if resp.status_code != 200:
+        raise ProviderError(provider, resp.status_code, resp.text, parse_retry_after(resp.headers))
+    decoder = SSEDecoder()
+    try:
+        # chunk_size=None hands over bytes as soon as they arrive
+        for chunk in resp.iter_content(chunk_size=None):
+            check_deadline()
+            for payload in decoder.feed(chunk):
+                done, obj = decode_sse_payload(payload, provider)
+                if done: return
+                if obj is not None: yield obj
+    except requests.exceptions.RequestException:
+        check_deadline() # an aborted stream surfaces as Cancelled, not a provider error
+        raise
+    check_deadline() # an aborted stream can also just end early
+    for payload in decoder.close():
+        done, obj = decode_sse_payload(payload, provider)
+        if done: return
+        if obj is not None: yield obj
+
+def decode_sse_payload(payload, provider):
+    """Returns (done, obj) for one event payload."""
+    payload = payload.strip()
+    if payload == b"[DONE]":
+        return True, None
+    _count_sse(provider, "events")
+    try:
+        return False, json_loads(payload)
+    except ValueError:
+        _count_sse(provider, "malformed")
+        print(f"Malformed {provider} SSE event: {payload[:120]!r}", file=sys.stderr)
+        return False, None
+
+# --- MODEL CATALOG ---
+
+# Cold-start seed: served until the first live fetch succeeds, and kept per
+# provider whenever a refresh for that provider fails.
+GEMINI_FALLBACK_MODELS = [
+    {"id": "gemini-2.0-flash", "capabilities": ["text", "image", "web_search"]},
+    {"id": "gemini-1.5-flash", "capabilities": ["text", "image", "web_search"]},
+    {"id": "gemini-1.5-pro", "capabilities": ["text", "image", "web_search"]}
+]
+
+# Groq (Hardcoded as per user request for specific model set)
+GROQ_MODELS = [
+    # TEXT + IMAGE
+    {"id": "meta-llama/llama-guard-4-12b", "capabilities": ["text", "image"]},
+    {"id": "meta-llama/llama-4-maverick-17b-128e-instruct", "capabilities": ["text", "image"]},
+    {"id": "meta-llama/llama-4-scout-17b-16e-instruct", "capabilities": ["text", "image"]},
+    # TEXT + WEB SEARCH (Compound & OSS)
+    {"id": "openai/gpt-oss-120b", "capabilities": ["text", "web_search"]},
+    {"id": "openai/gpt-oss-20b", "capabilities": ["text", "web_search"]},
+    {"id": "groq/compound", "capabilities": ["text", "web_search"]},
+    {"id": "groq/compound-mini", "capabilities": ["text", "web_search"]},
+    {"id": "openai/gpt-oss-safeguard-20b", "capabilities": ["text", "web_search"]}
+]
+
+CEREBRAS_FALLBACK_MODELS = [
+    {"id": "llama3.1-8b", "capabilities": ["text"]},
+    {"id": "llama3.1-70b", "capabilities": ["text"]}
+]
+
+def fetch_gemini_models():
+    url = f"{GEMINI_BASE_URL}/models"
+    params = {"key": GEMINI_API_KEY}
+    resp = provider_request("gemini", "GET", url, params=params, timeout=10)
+    resp.raise_for_status()
+    models = []
+    for m in resp.json().get("models", []):
+        if "generateContent" in m.get("supportedGenerationMethods", []):
+            name = m["name"].replace("models/", "")
+            models.append({
+                "id": name,
+                "capabilities": ["text", "image", "web_search"] # Gemini 1.5+ generally supports all
+            })
+    return models
+
+def fetch_cerebras_models():
+    url = f"{CEREBRAS_BASE_URL}/models"
+    headers = {"Authorization": f"Bearer {CEREBRAS_API_KEY}"}
+    resp = provider_request("cerebras", "GET", url, headers=headers, timeout=10)
+    resp.raise_for_status()
+    # Cerebras API response format: {"data": [{"id": "..."}, ...]}
+    return [
+        {"id": m["id"], "capabilities": ["text"]} # Assume text-only for inference endpoints
+        for m in resp.json().get("data", [])
+    ]
+
+_models_cache = {
+    "models": {"gemini": GEMINI_FALLBACK_MODELS, "groq": GROQ_MODELS, "cerebras": CEREBRAS_FALLBACK_MODELS},
+    "etag": None,
+    "fetched_at": 0.0,
+    "loaded": False,
+    "refreshing": False
+}
+_models_lock = threading.Lock()
+
+def _models_etag(models):
+    body = json.dumps(models, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(body).hexdigest()
+
+_models_cache["etag"] = _models_etag(_models_cache["models"])
+
+def refresh_models():
+    """Fetches Gemini and Cerebras model lists concurrently and swaps them into the cache."""
+    models = dict(_models_cache["models"])
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = {
+            "gemini": pool.submit(fetch_gemini_models),
+            "cerebras": pool.submit(fetch_cerebras_models)
+        }
+        for provider, future in futures.items():
+            try:
+                models[provider] = future.result()
+            except Exception as e:
+                print(f"Error fetching {provider} models: {e}", file=sys.stderr)
+    models["groq"] = GROQ_MODELS
+
+    with _models_lock:
+        _models_cache["models"] = models
+        _models_cache["etag"] = _models_etag(models)
+        _models_cache["fetched_at"] = time.time()
+        _models_cache["loaded"] = True
+        _models_cache["refreshing"] = False
+
+def _refresh_models_background():
+    try:
+        refresh_models()
+    except Exception as e:
+        print(f"Model catalog refresh failed: {e}", file=sys.stderr)
+        with _models_lock:
+            _models_cache["refreshing"] = False
+
+def get_cached_models():
+    """Returns (models, etag). Fresh entries are served as-is; stale ones are
+    served immediately while a single background thread revalidates them."""
+    if not _models_cache["loaded"]:
+        # First request on this instance: block once so the UI sees live lists.
+        with _models_lock:
+            first = not _models_cache["refreshing"] and not _models_cache["loaded"]
+            if first:
+                _models_cache["refreshing"] = True
+        if first:
+            _refresh_models_background()
+
+    age = time.time() - _models_cache["fetched_at"]
+    if age > MODELS_CACHE_TTL:
+        with _models_lock:
+            start = not _models_cache["refreshing"]
+            if start:
+                _models_cache["refreshing"] = True
+        if start:
+            if age > MODELS_CACHE_TTL + MODELS_CACHE_STALE:
+                _refresh_models_background()
+            else:
+                threading.Thread(target=_refresh_models_background, daemon=True).start()
+
+    with _models_lock:
+        return _models_cache["models"], _models_cache["etag"]
+
 # --- GEMINI HELPERS ---
 
-def upload_to_gemini(file_path, mime_type):
-    """Uploads file to Gemini Files API and returns file_uri."""
+_gemini_files = {} # sha256 -> (file_uri, expires_at)
+_gemini_files_lock = threading.Lock()
+
+def _parse_expiration(value):
+    """Parses Gemini's RFC 3339 expirationTime into a unix timestamp."""
+    try:
+        value = re.sub(r"\.\d+", "", value).replace("Z", "+00:00")
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def lookup_gemini_file(file_digest):
+    """Returns the file_uri of a previous upload of identical bytes, if still alive."""
+    if not file_digest:
+        return None
+    with _gemini_files_lock:
+        entry = _gemini_files.get(file_digest)
+        if not entry:
+            return None
+        file_uri, expires_at = entry
+        if expires_at - GEMINI_FILE_EXPIRY_MARGIN > time.time():
+            return file_uri
+        del _gemini_files[file_digest]
+    return None
+
+def _upload_offset(upload_url):
+    """Asks the resumable session how many bytes it has committed so far."""
+    resp = provider_request("gemini", "POST", upload_url, headers={"X-Goog-Upload-Command": "query"})
+    received = resp.headers.get("X-Goog-Upload-Size-Received")
+    if received is None:
+        raise Exception(f"Upload session lost: {resp.text}")
+    return int(received)
+
+@timed("gemini_upload", "gemini")
+def upload_to_gemini(file_path, mime_type, file_digest=None):
+    """Uploads file to Gemini Files API and returns file_uri.
+
+    Bytes are streamed from disk in GEMINI_UPLOAD_CHUNK_SIZE chunks; a failed
+    chunk resumes from the offset the server reports instead of byte 0.
+    When file_digest is given, identical files are only uploaded once per
+    Gemini file lifetime.
+    """
+    file_uri = lookup_gemini_file(file_digest)
+    if file_uri:
+        return file_uri
+
     file_size = os.path.getsize(file_path)
-    display_name = os.path.basename(file_path)
+    display_name = upload_display_name(file_path)
     
     # 1. Initial Resumable Request
-    url = f"{GEMINI_BASE_URL}/upload/v1beta/files"
     headers = {
         "X-Goog-Upload-Protocol": "resumable",
         "X-Goog-Upload-Command": "start",
@@ -63,391 +1273,2539 @@ def upload_to_gemini(file_path, mime_type):
     params = {"key": GEMINI_API_KEY}
     data = {"file": {"display_name": display_name}}
     
-    req1 = requests.post(url, headers=headers, params=params, json=data)
+    req1 = provider_request("gemini", "POST", GEMINI_UPLOAD_URL, headers=headers, params=params, json=data)
     upload_url = req1.headers.get("X-Goog-Upload-URL")
     
     if not upload_url:
         raise Exception(f"Failed to get upload URL: {req1.text}")
         
-    # 2. Upload Bytes
+    # 2. Upload Bytes (chunked, resumable)
+    offset = 0
+    failures = 0
+    req2 = None
     with open(file_path, "rb") as f:
-        headers2 = {
-            "Content-Length": str(file_size),
-            "X-Goog-Upload-Offset": "0",
-            "X-Goog-Upload-Command": "upload, finalize"
-        }
-        req2 = requests.post(upload_url, headers=headers2, data=f)
+        while True:
+            f.seek(offset)
+            chunk = f.read(GEMINI_UPLOAD_CHUNK_SIZE)
+            last = offset + len(chunk) >= file_size
+            headers2 = {
+                "Content-Length": str(len(chunk)),
+                "X-Goog-Upload-Offset": str(offset),
+                "X-Goog-Upload-Command": "upload, finalize" if last else "upload"
+            }
+            try:
+                req2 = provider_request("gemini", "POST", upload_url, headers=headers2, data=chunk)
+                if req2.status_code >= 500:
+                    raise requests.exceptions.RequestException(f"HTTP {req2.status_code}")
+            except requests.exceptions.RequestException as e:
+                failures += 1
+                if failures > GEMINI_UPLOAD_MAX_RESUMES:
+                    raise Exception(f"File upload failed after {failures} attempts: {e}")
+                time.sleep(HTTP_RETRY_BACKOFF * (2 ** (failures - 1)))
+                offset = _upload_offset(upload_url)
+                continue
+
+            if last or req2.status_code != 200:
+                break
+            offset += len(chunk)
     
     if req2.status_code != 200:
         raise Exception(f"File upload failed: {req2.text}")
         
-    file_info = req2.json()
-    return file_info["file"]["uri"]
+    file_info = req2.json()["file"]
+    file_uri = file_info["uri"]
+    if file_digest:
+        expires_at = _parse_expiration(file_info.get("expirationTime")) or (time.time() + GEMINI_FILE_LIFETIME)
+        with _gemini_files_lock:
+            _gemini_files[file_digest] = (file_uri, expires_at)
+    return file_uri
+
+def gemini_model_path(model):
+    if not model.startswith("models/") and not model.startswith("tunedModels/"):
+         return f"models/{model}"
+    return model
+
+def gemini_stream_request(prompt, model, file_uri=None, mime_type=None, web_search=False, cached_content=None):
+    """Builds (url, params, headers, payload) for a streamGenerateContent call.
+    With cached_content, prompt is only the part not already in the cache."""
+    # Prepare URL
+    model_path = gemini_model_path(model)
+
+    url = f"{GEMINI_BASE_URL}/{model_path}:streamGenerateContent?alt=sse"
+    params = {"key": GEMINI_API_KEY}
+    headers = {"Content-Type": "application/json"}
+
+    # The instruction goes in systemInstruction, as in a context cache
+    system, prompt = (None, prompt) if cached_content else split_instruction(prompt)
+    
+    parts = [{"text": prompt}]
+    if file_uri:
+        parts.insert(0, {"file_data": {"mime_type": mime_type, "file_uri": file_uri}})
+    
+    contents = [{"parts": parts}]
+    
+    tools = []
+    if web_search:
+        tools.append({"googleSearch": {}})
+        
+    payload = {
+        "contents": contents,
+        "generationConfig": {"temperature": 0.1} 
+    }
+    if tools:
+        payload["tools"] = tools
+    if system:
+        payload["systemInstruction"] = {"parts": [{"text": system}]}
+    contents[0]["role"] = "user"
+    if cached_content:
+        payload["cachedContent"] = cached_content
+    return url, params, headers, payload
+
+def gemini_chunk_text(chunk):
+    """Yields the text of one decoded Gemini SSE chunk, then any grounding sources."""
+    cand = chunk.get("candidates", [{}])[0]
+    content = cand.get("content", {}).get("parts", [{}])[0].get("text", "")
+    
+    # Handle Text
+    if content: yield content
+    
+    # Handle Grounding Metadata (Source Links)
+    grounding = cand.get("groundingMetadata", {})
+    chunks = grounding.get("groundingChunks", [])
+    if chunks:
+        links_md = "\n\n**Verified Sources:**\n"
+        found_links = False
+        for c in chunks:
+            web = c.get("web", {})
+            if web:
+                title = web.get("title", "Source")
+                uri = web.get("uri") or web.get("url") # Try both keys
+                if uri and uri.startswith("http"):
+                    links_md += f"- [{title}]({uri})\n"
+                    found_links = True
+        if found_links:
+            # Yield formatted source block
+            yield "\n\n**Verified Sources:**\n" + links_md.replace("- [", "- ").replace("](", ": ").replace(")", "")
+
+def stream_gemini(prompt, model, file_uri=None, mime_type=None, web_search=False, cached_content=None):
+    url, params, headers, payload = gemini_stream_request(prompt, model, file_uri, mime_type, web_search, cached_content)
+
+    # Request
+    with provider_request("gemini", "POST", url, headers=headers, params=params, json=payload, stream=True) as resp:
+        for chunk in iter_sse_json(resp, "gemini"):
+            try:
+                pieces = list(gemini_chunk_text(chunk))
+            except (AttributeError, IndexError, KeyError, TypeError):
+                continue # e.g. usage-only or safety chunks without text parts
+            yield from pieces
+
+# --- GEMINI CONTEXT CACHE ---
+
+class GeminiContextCache:
+    """Tracks cachedContents handles per (model, document digest).
+
+    A handle holds the fact-check instruction (and the document, if any), so
+    repeat requests send only the user's question. Handles are refreshed
+    (TTL extended) when used late in their life, and deleted upstream when
+    evicted from this bounded LRU.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> {"state", "name", "expires_at", "retry_at"}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _stale(entry, now):
+        return entry is None or (entry["state"] == "failed" and entry["retry_at"] <= now) \
+            or (entry["state"] == "ready" and entry["expires_at"] - 60 <= now)
+
+    def lookup(self, model, file_uri=None, mime_type=None, file_digest=None, context_tokens=None):
+        """Returns a ready cachedContents name, or None (starting creation if needed).
+        context_tokens() estimates the context's size; it is only called before
+        a creation, and contexts below the model's minimum are never created."""
+        key = (model, file_digest or "")
+        now = time.time()
+        with self.lock:
+            stale = self._stale(self.entries.get(key), now)
+        # Estimated outside the lock: counting PDF pages reads the whole file
+        too_small = stale and context_tokens is not None \
+            and context_tokens() < gemini_cache_min_tokens(model)
+        with self.lock:
+            entry = self.entries.get(key)
+            if self._stale(entry, now):
+                self.entries[key] = {"state": "too_small" if too_small else "pending"}
+                self.entries.move_to_end(key)
+                self._evict()
+                if too_small:
+                    return None
+                self._spawn(self._create, key, model, file_uri, mime_type)
+                CONTEXT_CACHE_EVENTS.inc(event="miss")
+                return None
+            if entry["state"] != "ready":
+                CONTEXT_CACHE_EVENTS.inc(event="miss")
+                return None
+            self.entries.move_to_end(key)
+            if entry["expires_at"] - now < GEMINI_CACHE_TTL / 4 and not entry.get("refreshing"):
+                entry["refreshing"] = True
+                self._spawn(self._refresh, key, entry["name"])
+            CONTEXT_CACHE_EVENTS.inc(event="hit")
+            return entry["name"]
+
+    def drop(self, model, file_digest=None):
+        """Forgets a handle the API no longer accepts."""
+        with self.lock:
+            entry = self.entries.pop((model, file_digest or ""), None)
+        if entry and entry.get("name"):
+            self._spawn(self._delete, entry["name"])
+
+    def _spawn(self, fn, *args):
+        threading.Thread(target=fn, args=args, daemon=True).start()
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            _, entry = self.entries.popitem(last=False)
+            if entry.get("name"):
+                self._spawn(self._delete, entry["name"])
+
+    def _create(self, key, model, file_uri, mime_type):
+        body = {
+            "model": gemini_model_path(model),
+            "systemInstruction": {"parts": [{"text": FACT_CHECK_PROMPT}]},
+            "ttl": f"{GEMINI_CACHE_TTL}s"
+        }
+        if file_uri:
+            body["contents"] = [{"role": "user", "parts": [{"file_data": {"mime_type": mime_type, "file_uri": file_uri}}]}]
+        try:
+            resp = provider_request("gemini", "POST", f"{GEMINI_BASE_URL}/cachedContents",
+                                    params={"key": GEMINI_API_KEY}, json=body, timeout=30)
+            if resp.status_code != 200:
+                raise ProviderError("gemini", resp.status_code, resp.text)
+            info = resp.json()
+            update = {"state": "ready", "name": info["name"],
+                      "expires_at": _parse_expiration(info.get("expireTime")) or time.time() + GEMINI_CACHE_TTL}
+            CONTEXT_CACHE_EVENTS.inc(event="created")
+        except Exception as e:
+            print(f"Gemini context cache not created for {key[0]}: {e}", file=sys.stderr)
+            update = {"state": "failed", "retry_at": time.time() + GEMINI_CACHE_RETRY}
+            CONTEXT_CACHE_EVENTS.inc(event="failed")
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["state"] == "pending":
+                entry.update(update)
+                return
+        if update.get("name"):
+            self._delete(update["name"]) # evicted while being created
+
+    def _refresh(self, key, name):
+        try:
+            resp = provider_request("gemini", "PATCH", f"{GEMINI_BASE_URL}/{name}",
+                                    params={"key": GEMINI_API_KEY, "updateMask": "ttl"},
+                                    json={"ttl": f"{GEMINI_CACHE_TTL}s"}, timeout=15)
+            expires_at = _parse_expiration(resp.json().get("expireTime")) if resp.status_code == 200 else None
+        except (requests.exceptions.RequestException, ValueError):
+            expires_at = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.get("name") == name:
+                entry["refreshing"] = False
+                if expires_at:
+                    entry["expires_at"] = expires_at
+
+    def _delete(self, name):
+        try:
+            provider_request("gemini", "DELETE", f"{GEMINI_BASE_URL}/{name}", params={"key": GEMINI_API_KEY}, timeout=15)
+        except requests.exceptions.RequestException:
+            pass # it expires on its own
+
+gemini_contexts = GeminiContextCache(GEMINI_CACHE_MAX)
+
+GEMINI_TOKENS_PER_PAGE = 258 # per image, and per PDF page
+
+def gemini_cache_min_tokens(model):
+    return GEMINI_CACHE_MIN_TOKENS * (4 if "pro" in model else 1)
+
+def document_tokens(file_path, mime_type):
+    """Rough Gemini token count of an uploaded document (0 without one)."""
+    if not file_path:
+        return 0
+    if mime_type == "application/pdf":
+        with open(file_path, "rb") as f:
+            pages = len(re.findall(rb"/Type\s*/Page(?!s)", f.read()))
+        return max(1, pages) * GEMINI_TOKENS_PER_PAGE
+    if mime_type and mime_type.startswith("image/"):
+        return GEMINI_TOKENS_PER_PAGE
+    return os.path.getsize(file_path) // 4
+
+def split_instruction(prompt):
+    """(FACT_CHECK_PROMPT, rest of the prompt) for fact-check prompts, else (None, prompt)."""
+    if prompt.startswith(FACT_CHECK_PROMPT):
+        return FACT_CHECK_PROMPT, prompt[len(FACT_CHECK_PROMPT):].strip()
+    return None, prompt
+
+def gemini_context(prompt, model, file_uri=None, mime_type=None, file_digest=None, web_search=False, file_path=None):
+    """Returns (cached_content, delta_prompt) when a context cache covers this
+    request's instruction and document, else (None, prompt)."""
+    system, delta = split_instruction(prompt)
+    # Search tools cannot be combined with a cache built without them
+    if not GEMINI_CONTEXT_CACHE or web_search or system is None:
+        return None, prompt
+    if not file_uri or not file_digest:
+        return None, prompt # the instruction alone is below every model's cache minimum
+    cached_content = gemini_contexts.lookup(
+        model, file_uri, mime_type, file_digest,
+        context_tokens=lambda: len(system) // 4 + document_tokens(file_path, mime_type)
+    )
+    if not cached_content:
+        return None, prompt
+    return cached_content, delta
+
+# --- IMAGE PIPELINE ---
+
+_data_urls = OrderedDict() # (sha256, max_side, max_bytes) -> data URL
+_data_urls_bytes = 0
+_data_urls_lock = threading.Lock()
+
+def shrink_image(data, max_side, max_bytes):
+    """Downscales to max_side and re-encodes as JPEG until the base64 form fits
+    in max_bytes. Re-encoding drops EXIF/XMP metadata. Returns JPEG bytes."""
+    Image, ImageOps = optional_module("PIL.Image"), optional_module("PIL.ImageOps")
+    img = Image.open(io.BytesIO(data))
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    quality = IMAGE_JPEG_QUALITY
+    while True:
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=quality, optimize=True)
+        encoded = buf.getvalue()
+        if len(encoded) * 4 // 3 <= max_bytes or max(img.size) <= 256:
+            return encoded
+        # Trade quality first, then resolution
+        if quality > 55:
+            quality -= 15
+        else:
+            img = img.resize((max(1, img.width * 3 // 4), max(1, img.height * 3 // 4)), Image.LANCZOS)
+
+@timed("image_encode")
+def image_data_url(data, mime_type, provider="groq", max_bytes=None):
+    """Builds the inline data URL for an image, once per unique (image, provider limits).
+
+    Images are reduced to the provider's maximum useful resolution and to
+    max_bytes of base64 (default IMAGE_MAX_BYTES). Without Pillow, or for
+    bytes Pillow cannot decode, the original image is inlined unchanged.
+    """
+    global _data_urls_bytes
+    max_side = IMAGE_MAX_SIDE.get(provider, IMAGE_MAX_SIDE["groq"])
+    max_bytes = max_bytes or IMAGE_MAX_BYTES
+    key = (hashlib.sha256(data).hexdigest(), max_side, max_bytes)
+    with _data_urls_lock:
+        url = _data_urls.get(key)
+        if url:
+            _data_urls.move_to_end(key)
+            return url
+
+    if optional_module("PIL.Image"):
+        try:
+            data = shrink_image(data, max_side, max_bytes)
+            mime_type = "image/jpeg"
+        except Exception as e:
+            print(f"Image preprocessing skipped: {e}", file=sys.stderr)
+    url = f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+    with _data_urls_lock:
+        if key not in _data_urls:
+            _data_urls[key] = url
+            _data_urls_bytes += len(url)
+        while _data_urls_bytes > IMAGE_CACHE_BYTES and _data_urls:
+            _, evicted = _data_urls.popitem(last=False)
+            _data_urls_bytes -= len(evicted)
+    return url
+
+# --- MEDIA FETCH ---
+
+_fetched_media = OrderedDict() # url -> (expires_at, [data URLs])
+_fetched_media_lock = threading.Lock()
+
+MIME_FROM_CONTENT_TYPE = {"image/png": "image/png", "image/gif": "image/gif", "image/webp": "image/webp"}
+
+def _check_media_url(url):
+    # Only plain web URLs: ffmpeg in particular would happily open file:// paths.
+    if not url.lower().startswith(("http://", "https://")):
+        raise Exception(f"Unsupported URL scheme: {url[:40]}")
+
+def decode_data_url(url):
+    """(bytes, mime_type) of a base64 image data URL, e.g. a screen capture
+    posted by the extension. Raises ValueError for anything else."""
+    header, sep, payload = url.partition(",")
+    if not sep or not header.startswith("data:image/") or not header.endswith(";base64"):
+        raise ValueError("Expected a base64 image data URL")
+    if len(payload) * 3 // 4 > MEDIA_FETCH_MAX_BYTES:
+        raise ValueError(f"Image exceeds {MEDIA_FETCH_MAX_BYTES} bytes")
+    return base64.b64decode(payload, validate=True), header[len("data:"):-len(";base64")]
+
+@timed("media_fetch")
+def fetch_image(url):
+    """Streams an image with a hard byte cap. Returns (bytes, mime_type).
+
+    Content-Type and Content-Length are checked before the body is read, and
+    the download is aborted as soon as it passes MEDIA_FETCH_MAX_BYTES or
+    MEDIA_FETCH_DEADLINE seconds.
+    """
+    _check_media_url(url)
+    deadline = time.monotonic() + MEDIA_FETCH_DEADLINE
+    with provider_request("fetch", "GET", url, stream=True, timeout=10) as resp:
+        if resp.status_code != 200:
+            raise Exception(f"Image fetch returned HTTP {resp.status_code}")
+
+        content_type = resp.headers.get("content-type", "").split(";")[0].strip().lower()
+        if content_type and not content_type.startswith("image/") and content_type != "application/octet-stream":
+            raise Exception(f"Not an image: {content_type}")
+        length = resp.headers.get("content-length")
+        if length and length.isdigit() and int(length) > MEDIA_FETCH_MAX_BYTES:
+            raise Exception(f"Image too large: {length} bytes")
+
+        body = bytearray()
+        for chunk in resp.iter_content(64 * 1024):
+            body.extend(chunk)
+            if len(body) > MEDIA_FETCH_MAX_BYTES:
+                raise Exception(f"Image exceeds {MEDIA_FETCH_MAX_BYTES} bytes")
+            if time.monotonic() > deadline:
+                raise Exception("Image download too slow")
+
+    return bytes(body), MIME_FROM_CONTENT_TYPE.get(content_type, "image/jpeg")
+
+@timed("video_frames")
+def extract_video_frames(url):
+    """Samples VIDEO_FRAME_COUNT frames from the first VIDEO_SCAN_SECONDS of a
+    video with ffmpeg, which reads only what it needs instead of the whole file.
+    Returns a list of JPEG byte strings."""
+    _check_media_url(url)
+    if not FFMPEG_PATH:
+        raise Exception("Video analysis requires ffmpeg on the server")
+
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    out_dir = tempfile.mkdtemp(prefix="frames_", dir=UPLOAD_FOLDER)
+    try:
+        cmd = [
+            FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+            "-protocol_whitelist", "http,https,tcp,tls,crypto",
+            "-t", str(VIDEO_SCAN_SECONDS), "-i", url,
+            "-vf", f"fps={VIDEO_FRAME_COUNT}/{VIDEO_SCAN_SECONDS}",
+            "-frames:v", str(VIDEO_FRAME_COUNT), "-q:v", "3",
+            os.path.join(out_dir, "frame_%02d.jpg")
+        ]
+        result = subprocess.run(cmd, capture_output=True, timeout=MEDIA_FETCH_DEADLINE * 2)
+        frames = []
+        for name in sorted(os.listdir(out_dir)):
+            with open(os.path.join(out_dir, name), "rb") as f:
+                frames.append(f.read())
+        if not frames:
+            raise Exception(f"No frames extracted: {result.stderr.decode('utf-8', 'replace')[:200]}")
+        return frames
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+def _cached_media(url, loader):
+    now = time.time()
+    with _fetched_media_lock:
+        entry = _fetched_media.get(url)
+        if entry and entry[0] > now:
+            _fetched_media.move_to_end(url)
+            return entry[1]
+
+    data_urls = loader()
+
+    with _fetched_media_lock:
+        _fetched_media[url] = (now + MEDIA_CACHE_TTL, data_urls)
+        _fetched_media.move_to_end(url)
+        while len(_fetched_media) > MEDIA_CACHE_SIZE:
+            _fetched_media.popitem(last=False)
+    return data_urls
+
+def load_image_url(url, provider="cerebras"):
+    """Returns [data URL] for a remote image, reusing recent downloads of the same URL."""
+    def loader():
+        data, mime_type = fetch_image(url)
+        return [image_data_url(data, mime_type, provider)]
+    return _cached_media(url, loader)
+
+def load_video_frames(url, provider="cerebras"):
+    """Returns data URLs for a handful of representative frames of a remote video."""
+    def loader():
+        frames = extract_video_frames(url)
+        budget = IMAGE_MAX_BYTES // len(frames)
+        return [image_data_url(frame, "image/jpeg", provider, budget) for frame in frames]
+    return _cached_media(url, loader)
+
+# --- GROQ HELPERS ---
+
+def encode_image(image_path, mime_type, provider="groq", max_bytes=None):
+    """Returns a downscaled, metadata-free data URL for an image on disk."""
+    with open(image_path, "rb") as image_file:
+        return image_data_url(image_file.read(), mime_type, provider, max_bytes)
+
+@timed("pdf_convert")
+def convert_doc_to_images(doc_path, doc_digest=None):
+    """Converts PDF to images. Returns list of image paths.
+
+    Only the first PDF_MAX_PAGES pages are rasterized, at PDF_DPI, with poppler
+    writing JPEGs straight to disk across PDF_RENDER_THREADS processes. When
+    doc_digest is given the pages are cached under PAGE_CACHE_DIR so repeat
+    documents skip conversion entirely.
+    """
+    pdf2image = optional_module("pdf2image")
+    if pdf2image is None:
+        raise Exception("System Configuration Error: 'poppler' is not installed or not in PATH. PDF conversion for non-native models (like Groq) requires Poppler. Please install Poppler or use Gemini (native PDF support).")
+
+    cache_dir = os.path.join(PAGE_CACHE_DIR, doc_digest) if doc_digest else None
+    if cache_dir and os.path.isdir(cache_dir):
+        pages = sorted(f for f in os.listdir(cache_dir) if f.endswith(".jpg"))
+        if pages:
+            os.utime(cache_dir) # keeps hot documents away from the sweeper
+            return [os.path.join(cache_dir, f) for f in pages]
+
+    os.makedirs(PAGE_CACHE_DIR, exist_ok=True)
+    out_dir = tempfile.mkdtemp(prefix="render_", dir=PAGE_CACHE_DIR)
+    try:
+        img_paths = pdf2image.convert_from_path(
+            doc_path,
+            dpi=PDF_DPI,
+            first_page=1,
+            last_page=PDF_MAX_PAGES, # Limit pages for API limits
+            output_folder=out_dir,
+            output_file="page",
+            fmt="jpeg",
+            jpegopt={"quality": PDF_JPEG_QUALITY, "optimize": True},
+            thread_count=PDF_RENDER_THREADS,
+            paths_only=True
+        )
+    except Exception as e:
+         shutil.rmtree(out_dir, ignore_errors=True)
+         if "poppler" in str(e).lower() or "not in path" in str(e).lower():
+             raise Exception("System Error: Poppler not found. Please install Poppler to process PDFs with this model, or switch to Gemini.")
+         raise e
+
+    if not cache_dir:
+        return img_paths
+    try:
+        os.rename(out_dir, cache_dir)
+    except OSError:
+        # Another request cached the same document first; use theirs.
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return [os.path.join(cache_dir, os.path.basename(p)) for p in img_paths]
+
+def groq_stream_request(prompt, model, file_path=None, mime_type=None, file_digest=None):
+    """Builds (url, headers, data) for a streaming Groq chat completion.
+    Raises if an attached PDF cannot be converted to page images."""
+    headers = {
+        "Authorization": f"Bearer {GROQ_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    
+    messages = []
+    content_list = [{"type": "text", "text": prompt}]
+    
+    if file_path and mime_type:
+        # Check if model supports vision (managed by frontend selection normally, but backend check is good)
+        # Assuming frontend passes correct model.
+        if mime_type.startswith("image/"):
+            content_list.append({
+                "type": "image_url",
+                "image_url": {"url": encode_image(file_path, mime_type, "groq", IMAGE_REQUEST_BUDGET)}
+            })
+        elif mime_type == "application/pdf":
+            try:
+                img_paths = convert_doc_to_images(file_path, file_digest)
+            except Exception as e:
+                raise Exception(f"PDF Conversion failed - {str(e)}")
+            # Pages share the request budget
+            page_budget = IMAGE_REQUEST_BUDGET // max(1, len(img_paths))
+            for path in img_paths:
+                content_list.append({
+                    "type": "image_url",
+                    "image_url": {"url": encode_image(path, "image/jpeg", "groq", page_budget)}
+                })
+    
+    messages.append({"role": "user", "content": content_list})
+    
+    data = {
+        "model": model, 
+        "messages": messages, 
+        "stream": True,
+        "temperature": 0.2
+    }
+    return f"{GROQ_BASE_URL}/chat/completions", headers, data
+
+def openai_chunk_text(chunk):
+    """Text delta of one decoded OpenAI-compatible (Groq, Cerebras) SSE chunk."""
+    return chunk["choices"][0]["delta"].get("content", "")
+
+def stream_groq(prompt, model, file_path=None, mime_type=None, file_digest=None):
+    try:
+        url, headers, data = groq_stream_request(prompt, model, file_path, mime_type, file_digest)
+    except Exception as e:
+        yield f"[System Error: {str(e)}]"
+        return
+    
+    with provider_request("groq", "POST", url, headers=headers, json=data, stream=True) as resp:
+        for chunk in iter_sse_json(resp, "groq"):
+            try:
+                content = openai_chunk_text(chunk)
+            except (AttributeError, IndexError, KeyError, TypeError):
+                continue # e.g. trailing usage chunk with no choices
+            if content: yield content
+
+# --- CEREBRAS HELPERS ---
+
+def cerebras_stream_request(prompt, model):
+    """Builds (url, headers, data) for a streaming Cerebras chat completion."""
+    headers = {
+        "Authorization": f"Bearer {CEREBRAS_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    data = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": True,
+        "temperature": 0.2
+    }
+    return f"{CEREBRAS_BASE_URL}/chat/completions", headers, data
+
+def stream_cerebras(prompt, model):
+    url, headers, data = cerebras_stream_request(prompt, model)
+    
+    with provider_request("cerebras", "POST", url, headers=headers, json=data, stream=True) as resp:
+        for chunk in iter_sse_json(resp, "cerebras"):
+            try:
+                content = openai_chunk_text(chunk)
+            except (AttributeError, IndexError, KeyError, TypeError):
+                continue # e.g. trailing usage chunk with no choices
+            if content: yield content
+
+
+# --- VERDICT CACHE ---
+
+class VerdictCache:
+    """Two-tier result cache: a bounded in-memory LRU in front of an optional
+    SQLite table. Values are JSON-serializable (stream text or ai-check dicts)."""
+
+    def __init__(self, max_entries, db_path=None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.db = None
+        if db_path:
+            try:
+                self.db = sqlite3.connect(db_path, check_same_thread=False)
+                self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS verdicts ("
+                    "key TEXT PRIMARY KEY, kind TEXT, value TEXT, expires_at REAL)"
+                )
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"Verdict cache disk tier disabled: {e}", file=sys.stderr)
+                self.db = None
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    return entry[1]
+                del self.entries[key]
+            if self.db is None:
+                return None
+            try:
+                row = self.db.execute(
+                    "SELECT value, expires_at FROM verdicts WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error:
+                return None
+            if not row:
+                return None
+            if row[1] <= now:
+                self.db.execute("DELETE FROM verdicts WHERE key = ?", (key,))
+                self.db.commit()
+                return None
+            value = json.loads(row[0])
+            self._remember(key, row[1], value)
+            return value
+
+    def set(self, key, kind, value):
+        expires_at = time.time() + VERDICT_TTL.get(kind, VERDICT_TTL["process"])
+        with self.lock:
+            self._remember(key, expires_at, value)
+            if self.db is not None:
+                try:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO verdicts (key, kind, value, expires_at) VALUES (?, ?, ?, ?)",
+                        (key, kind, json.dumps(value), expires_at)
+                    )
+                    self.db.commit()
+                except sqlite3.Error as e:
+                    print(f"Verdict cache write failed: {e}", file=sys.stderr)
+
+    def _remember(self, key, expires_at, value):
+        self.entries[key] = (expires_at, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+verdict_cache = VerdictCache(VERDICT_CACHE_SIZE, VERDICT_CACHE_DB)
+
+def normalize_input(text):
+    """Case- and whitespace-insensitive form of user text for cache keys."""
+    return " ".join((text or "").split()).casefold()
+
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def verdict_key(provider, model, web_search, user_input, file_digest=None, url=None):
+    """Content address for a check: identical inputs map to the same verdict."""
+    parts = [provider, model, "1" if web_search else "0", normalize_input(user_input), file_digest or "", url or ""]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+def replay_stream(text, chunk_size=256):
+    """Yields a cached answer in chunks so /process keeps its streaming contract."""
+    for i in range(0, len(text), chunk_size):
+        yield text[i:i + chunk_size]
+
+# --- NEAR-DUPLICATE INDEX ---
+
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_PERMS = 64
+_MINHASH_BANDS = 16 # LSH: 16 bands of 4 rows
+_rng = random.Random(20240601) # fixed seed: signatures must match across restarts
+_MINHASH_COEFFS = [(_rng.randrange(1, _MINHASH_PRIME), _rng.randrange(_MINHASH_PRIME)) for _ in range(_MINHASH_PERMS)]
+
+# Words that flip or change a claim while moving only a few shingles
+_POLARITY_WORDS = frozenset(
+    "not no never none nobody nothing neither nor nowhere cannot cant without false untrue "
+    "isnt arent wasnt werent dont doesnt didnt wont wouldnt couldnt shouldnt hasnt havent hadnt".split()
+)
+
+def _signature_text(text):
+    return re.sub(r"[^\w ]+", "", normalize_input(text))
+
+def polarity_terms(text):
+    """Negations and numbers in text, sorted; a text match must agree on them."""
+    return sorted({w for w in _signature_text(text).split() if w in _POLARITY_WORDS or any(c.isdigit() for c in w)})
+
+def text_signature(text):
+    """MinHash of the character 5-grams of normalized text (its first
+    NEAR_DUP_MAX_CHARS), or None if too short."""
+    norm = _signature_text(text)[:NEAR_DUP_MAX_CHARS]
+    if len(norm) < NEAR_DUP_MIN_CHARS:
+        return None
+    hashes = [
+        int.from_bytes(hashlib.blake2b(norm[i:i + 5].encode("utf-8"), digest_size=8).digest(), "little")
+        for i in range(len(norm) - 4)
+    ]
+    hashes = set(hashes)
+    return tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_COEFFS)
+
+def image_signature(source):
+    """64-bit difference hash (path or bytes), or None without Pillow / for undecodable data."""
+    Image = optional_module("PIL.Image")
+    if Image is None:
+        return None
+    try:
+        with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as img:
+            pixels = list(img.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    except Exception:
+        return None
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return (bits,)
+
+def minhash_similarity(a, b):
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+def dhash_similarity(a, b):
+    return 1 - (a[0] ^ b[0]).bit_count() / 64
+
+class NearDupIndex:
+    """Append-only similarity index on disk.
+
+    <name>.sig holds fixed-size records (signature words, then offset and
+    length of the entry's JSON line in <name>.meta) and is memory-mapped;
+    metadata is only read for matches. Appends from several processes are
+    serialized with flock on <name>.lock, and every process picks up new
+    records by remapping when the file has grown. Past max_entries records the
+    writer compacts: expired entries are dropped, the newest half is kept and
+    both files are replaced, which readers notice by the new inode.
+    """
+
+    def __init__(self, name, words, similarity, bands=0, max_entries=NEAR_DUP_MAX_ENTRIES):
+        self.sig_path = os.path.join(NEAR_DUP_DIR, f"{name}.sig")
+        self.meta_path = os.path.join(NEAR_DUP_DIR, f"{name}.meta")
+        self.lock_path = os.path.join(NEAR_DUP_DIR, f"{name}.lock")
+        self.max_entries = max_entries
+        self.words = words
+        self.record = struct.Struct(f"<{words + 2}Q")
+        self.similarity = similarity
+        self.bands = bands
+        self.buckets = {} # (band, values) -> [record numbers], when banded
+        self.count = 0
+        self.inode = None
+        self.map = None
+        self.meta_fd = None
+        self.lock = threading.Lock()
+
+    def _reset(self):
+        if self.map is not None:
+            self.map.close()
+        if self.meta_fd is not None:
+            os.close(self.meta_fd)
+        self.map = self.meta_fd = self.inode = None
+        self.buckets = {}
+        self.count = 0
+
+    def _refresh(self):
+        """Maps records appended since the last call (by any process)."""
+        try:
+            stat = os.stat(self.sig_path)
+        except OSError:
+            return
+        if stat.st_ino != self.inode:
+            self._reset() # first use, or compacted by some process
+            self.inode = stat.st_ino
+        count = stat.st_size // self.record.size
+        if count == self.count:
+            return
+        with open(self.sig_path, "rb") as f:
+            new_map = mmap.mmap(f.fileno(), count * self.record.size, access=mmap.ACCESS_READ)
+        if self.map is not None:
+            self.map.close()
+        self.map = new_map
+        if self.meta_fd is None:
+            self.meta_fd = os.open(self.meta_path, os.O_RDONLY)
+        if self.bands:
+            for i in range(self.count, count):
+                for key in self._band_keys(self._signature(i)):
+                    self.buckets.setdefault(key, []).append(i)
+        self.count = count
+
+    def _band_keys(self, signature):
+        rows = self.words // self.bands
+        return [(b, signature[b * rows:(b + 1) * rows]) for b in range(self.bands)]
+
+    def _signature(self, i):
+        return self.record.unpack_from(self.map, i * self.record.size)[:self.words]
+
+    def _meta(self, i):
+        offset, length = self.record.unpack_from(self.map, i * self.record.size)[self.words:]
+        return json.loads(os.pread(self.meta_fd, length, offset))
+
+    def lookup(self, signature, scope, threshold, terms=None):
+        """Best unexpired entry of this scope (and polarity terms) at or above
+        threshold: (similarity, meta) or None."""
+        now = time.time()
+        with self.lock:
+            self._refresh()
+            if self.bands:
+                candidates = {i for key in self._band_keys(signature) for i in self.buckets.get(key, ())}
+            else:
+                candidates = range(self.count)
+            scored = []
+            for i in candidates:
+                similarity = self.similarity(signature, self._signature(i))
+                if similarity >= threshold:
+                    scored.append((similarity, i))
+            for similarity, i in sorted(scored, reverse=True):
+                meta = self._meta(i)
+                if meta["scope"] == scope and meta["expires_at"] > now and meta.get("terms") == terms:
+                    return similarity, meta
+        return None
+
+    def add(self, signature, meta):
+        line = json.dumps(meta).encode("utf-8") + b"\n"
+        os.makedirs(NEAR_DUP_DIR, exist_ok=True)
+        with self.lock, open(self.lock_path, "ab") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.meta_path, "ab") as meta_file, open(self.sig_path, "ab") as sig_file:
+                    offset = meta_file.seek(0, os.SEEK_END)
+                    meta_file.write(line)
+                    meta_file.flush()
+                    sig_file.write(self.record.pack(*signature, offset, len(line)))
+                    count = sig_file.tell() // self.record.size
+                if count > self.max_entries:
+                    self._compact()
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _compact(self):
+        """Rewrites both files with the newest unexpired half of the entries.
+        Runs under the file lock; meta is replaced before sig, so a reader
+        that sees the new sig inode also opens the new meta."""
+        now = time.time()
+        kept = []
+        with open(self.sig_path, "rb") as sig_file, open(self.meta_path, "rb") as meta_file:
+            records = sig_file.read()
+            for start in range(0, len(records) - self.record.size + 1, self.record.size):
+                fields = self.record.unpack_from(records, start)
+                meta_file.seek(fields[self.words])
+                line = meta_file.read(fields[self.words + 1])
+                try:
+                    if json.loads(line)["expires_at"] > now:
+                        kept.append((fields[:self.words], line))
+                except (ValueError, KeyError):
+                    continue
+        kept = kept[-(self.max_entries // 2):]
+        meta_tmp, sig_tmp = self.meta_path + ".tmp", self.sig_path + ".tmp"
+        with open(meta_tmp, "wb") as meta_file, open(sig_tmp, "wb") as sig_file:
+            for signature, line in kept:
+                sig_file.write(self.record.pack(*signature, meta_file.tell(), len(line)))
+                meta_file.write(line)
+        os.replace(meta_tmp, self.meta_path)
+        os.replace(sig_tmp, self.sig_path)
+        self._reset()
+
+near_dup_indexes = {
+    "text": NearDupIndex("text", _MINHASH_PERMS, minhash_similarity, _MINHASH_BANDS),
+    "image": NearDupIndex("image", 1, dhash_similarity)
+}
+
+class NearDupProbe:
+    """One request's signature: looked up before the providers are called and
+    added to the index once the request has its own verdict."""
+
+    def __init__(self, index, signature, scope, terms=None):
+        self.index = index
+        self.signature = signature
+        self.scope = scope
+        self.terms = terms
+
+    def match(self):
+        """Returns (similarity, earlier verdict) or None."""
+        threshold = NEAR_DUP_TEXT_THRESHOLD if self.index == "text" else 1 - NEAR_DUP_IMAGE_DISTANCE / 64
+        with span("near_dup_lookup"):
+            try:
+                found = near_dup_indexes[self.index].lookup(self.signature, self.scope, threshold, self.terms)
+            except (OSError, ValueError) as e:
+                print(f"Near-duplicate lookup failed: {e}", file=sys.stderr)
+                found = None
+        NEAR_DUP_LOOKUPS.inc(index=self.index, result="hit" if found else "miss")
+        return (found[0], found[1]["value"]) if found else None
+
+    def add(self, key, kind, value):
+        meta = {"scope": self.scope, "key": key, "value": value, "terms": self.terms,
+                "expires_at": time.time() + VERDICT_TTL.get(kind, VERDICT_TTL["process"])}
+        try:
+            near_dup_indexes[self.index].add(self.signature, meta)
+        except OSError as e:
+            print(f"Near-duplicate index write failed: {e}", file=sys.stderr)
+
+def near_dup_probe(scope, text=None, image=None):
+    """Probe for a text or an image (path or bytes); None when not indexable.
+    scope should name the check kind and the provider/model that answers it."""
+    if not NEAR_DUP_ENABLED:
+        return None
+    terms = None
+    if text:
+        index, signature, terms = "text", text_signature(text), polarity_terms(text)
+    elif image is not None:
+        index, signature = "image", image_signature(image)
+    else:
+        return None
+    return NearDupProbe(index, signature, scope, terms) if signature else None
+
+# --- SINGLE FLIGHT ---
+
+class Flight:
+    """One upstream call that identical concurrent requests attach to.
+    Streams publish chunks; plain calls finish with a result."""
+
+    def __init__(self):
+        self.chunks = []
+        self.result = None
+        self.error = None
+        self.done = False
+        self.cond = threading.Condition()
+        self.listeners = [] # called after every change (used by the async followers)
+        self.subscribers = 0 # callers that joined and have not detached yet
+        self.cancelled = False
+        self.cancel_hooks = []
+
+    def _changed(self):
+        self.cond.notify_all()
+        return list(self.listeners)
+
+    def publish(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            listeners = self._changed()
+        for listener in listeners:
+            listener()
+
+    def finish(self, result=None, error=None):
+        with self.cond:
+            self.result = result
+            self.error = error
+            self.done = True
+            listeners = self._changed()
+        for listener in listeners:
+            listener()
+
+    def attach(self):
+        with self.cond:
+            self.subscribers += 1
+
+    def detach(self):
+        """Called when a joined caller stops watching. The last one to leave an
+        unfinished flight cancels it (CANCEL_ON_DISCONNECT)."""
+        with self.cond:
+            self.subscribers -= 1
+            if self.subscribers > 0 or self.done or self.cancelled or not CANCEL_ON_DISCONNECT:
+                return
+            self.cancelled = True
+            hooks = list(self.cancel_hooks)
+        for hook in hooks:
+            hook()
+
+    def on_cancel(self, hook):
+        with self.cond:
+            if not self.cancelled:
+                self.cancel_hooks.append(hook)
+                return
+        hook()
+
+    def read(self, index, timeout=None):
+        """Chunks from index on, waiting for at least one unless finished.
+        Returns (chunks, done)."""
+        with self.cond:
+            if index >= len(self.chunks) and not self.done:
+                self.cond.wait(timeout)
+            return self.chunks[index:], self.done
+
+    def follow(self):
+        """Everything published so far, then the live tail. Raises the producer's error."""
+        index = 0
+        while True:
+            chunks, done = self.read(index)
+            index += len(chunks)
+            yield from chunks
+            if done and index == len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+
+    def wait(self):
+        with self.cond:
+            while not self.done:
+                self.cond.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class SingleFlight:
+    """Registry of in-flight calls by key: the first caller leads, the rest follow."""
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.stats = {"leaders": 0, "followers": 0}
+
+    def join(self, key):
+        """Returns (flight, is_leader). The caller is attached to the flight and
+        must detach() when it stops watching."""
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None and not flight.cancelled:
+                self.stats["followers"] += 1
+                flight.attach()
+                return flight, False
+            flight = self.flights[key] = Flight()
+            self.stats["leaders"] += 1
+            flight.attach()
+            return flight, True
+
+    def forget(self, key, flight):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def call(self, key, fn, *args):
+        """fn(*args) once per key at a time; concurrent callers share its result."""
+        flight, leader = self.join(key)
+        if not leader:
+            try:
+                return flight.wait()
+            finally:
+                flight.detach()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            flight.finish(error=e)
+            raise
+        else:
+            flight.finish(result=result)
+            return result
+        finally:
+            self.forget(key, flight)
+            flight.detach()
+
+process_flights = SingleFlight()
+ai_check_flights = SingleFlight()
+
+# --- UPLOADS ---
+
+class UploadTooLarge(Exception):
+    pass
+
+class UploadFile(io.FileIO):
+    """Uniquely named file under UPLOAD_FOLDER that hashes and size-checks
+    every write. Deleted on close unless save_upload() adopted it."""
+
+    def __init__(self, filename):
+        name = secure_filename(filename or "") or "upload"
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        self.path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4().hex}_{name}")
+        super().__init__(self.path, "xb+")
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.adopted = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > UPLOAD_MAX_BYTES:
+            self.close()
+            raise UploadTooLarge(f"Upload exceeds the {UPLOAD_MAX_BYTES // (1024 * 1024)} MB limit")
+        self.sha256.update(data)
+        return super().write(data)
+
+    def close(self):
+        super().close()
+        if not self.adopted:
+            remove_upload(self.path)
+
+class UploadRequest(Request):
+    """Streams multipart file parts straight into UploadFiles, so /process
+    gets a unique, already hashed file without a second copy."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadFile(filename)
+
+app.request_class = UploadRequest
+app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_BYTES + 1024 * 1024 # + form fields
+if PROXY_HOPS:
+    # remote_addr = the address our own proxies saw, not what the client claims
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+
+def upload_display_name(file_path):
+    """Client's file name, without the unique prefix UploadFile adds."""
+    name = os.path.basename(file_path)
+    return name[33:] if re.match(r"[0-9a-f]{32}_", name) else name
+
+def remove_upload(file_path):
+    if file_path:
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+def save_upload(stream, filename, mimetype=None):
+    """Keeps an uploaded file under UPLOAD_FOLDER. Returns (file_path, mime_type, sha256).
+
+    Files Flask already streamed to disk (UploadFile) are adopted as they are;
+    other streams are copied once, hashed on the way. The caller owns the file
+    and must remove_upload() it when done (the sweeper catches leftovers)."""
+    if isinstance(stream, UploadFile):
+        upload = stream
+    else:
+        upload = UploadFile(filename)
+        try:
+            for block in iter(lambda: stream.read(1024 * 1024), b""):
+                upload.write(block)
+        except Exception:
+            upload.close()
+            raise
+    upload.adopted = True
+    upload.close()
+    start_sweeper()
+
+    filename = filename.lower()
+    mime_type = mimetype or "application/octet-stream"
+    if filename.endswith(".pdf"): mime_type = "application/pdf"
+    if filename.endswith(".jpg") or filename.endswith(".jpeg"): mime_type = "image/jpeg"
+    if filename.endswith(".png"): mime_type = "image/png"
+    return upload.path, mime_type, upload.sha256.hexdigest()
+
+def sweep_uploads():
+    """Removes uploads and temp dirs older than UPLOAD_TTL, and cached PDF
+    pages not used for PAGE_CACHE_TTL."""
+    now = time.time()
+    for folder, max_age in ((UPLOAD_FOLDER, UPLOAD_TTL), (PAGE_CACHE_DIR, PAGE_CACHE_TTL)):
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.path == PAGE_CACHE_DIR:
+                continue
+            # Half-rendered page dirs are temp files, not cache entries
+            age = UPLOAD_TTL if entry.name.startswith("render_") else max_age
+            try:
+                if now - entry.stat().st_mtime < age:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+_sweeper_started = False
+
+def start_sweeper():
+    """Starts the background sweeper once, on first use."""
+    global _sweeper_started
+    if _sweeper_started or SWEEP_INTERVAL <= 0:
+        return
+    _sweeper_started = True
+
+    def loop():
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            sweep_uploads()
+
+    threading.Thread(target=loop, daemon=True).start()
+
+# --- FACT-CHECK PIPELINE ---
+
+# DETAILED SYSTEM PROMPT
+FACT_CHECK_PROMPT = (
+    "You are Vectora, an elite fact-checking AI Agent. "
+    "Your mission is to analyze the provided input (text, image, or document) "
+    "and verify its truthfulness with high precision.\n\n"
+    "## OUTPUT PROTOCOL:\n"
+    "1. **VERDICT**: [TRUE / FALSE / MISLEADING / SATIRE / UNVERIFIED]\n"
+    "2. **RISK SCORE**: [0-100%] (Probability of Misinformation)\n"
+    "3. **ANALYSIS**: Provide a crisp, evidence-based explanation. "
+    "Cite known facts and point out logical fallacies or manipulation tactics.\n"
+    "4. **SOURCES**: List credible sources with their direct **URL links** to verify your claims. \n"
+    "   - **FORMAT**: Use the format `- Source Name: https://full.url.here` (Do NOT use markdown links like `[text](url)`). \n"
+    "   - **CRITICAL**: Only list sources if you have a VALID, non-empty URL. \n"
+    "   - **VERIFICATION**: Ensure every link provided is a valid, accessible URL.\n\n"
+    "Maintain an objective, professional, and authoritative tone."
+)
+
+DEFAULT_MODELS = {"gemini": "gemini-2.0-flash", "groq": "llama3-70b-8192", "cerebras": "llama3.1-70b"}
+
+class UnknownModel(ValueError):
+    """A client asked for a provider or model that is not in the catalog."""
+
+def resolve_model(provider, model):
+    """Checks a client's provider/model choice ("" = the provider's default)
+    against the catalog. Scheduler, breaker and metric keys are built from
+    these values, so anything else is refused rather than rerouted."""
+    if provider not in DEFAULT_MODELS:
+        raise UnknownModel(f"Unknown provider {provider[:40]!r}")
+    if not model or model == DEFAULT_MODELS[provider]:
+        return DEFAULT_MODELS[provider]
+    models, _ = get_cached_models()
+    if model not in {m["id"] for m in models.get(provider, [])}:
+        raise UnknownModel(f"Unknown {provider} model {model[:80]!r}")
+    return model
+
+def build_prompt(user_input):
+    if user_input:
+        return f"{FACT_CHECK_PROMPT}\n\n[USER INPUT]: {user_input}"
+    return f"{FACT_CHECK_PROMPT}\n\n(No text input. Analyze the attached file)"
+
+def stream_fact_check(provider, model, prompt, file_path=None, mime_type=None, file_digest=None, web_search=False, ticket=None):
+    """Runs one fact-check against a provider, yielding "//" status lines and answer text.
+    Holds a scheduler slot (the given ticket, or one acquired here) until the stream ends."""
+    if ticket is None:
+        ticket = acquire_slot(provider, estimate_tokens(prompt, file_path))
+    meter = StreamMeter(provider, model)
+    chunks = _stream_provider(provider, model, prompt, file_path, mime_type, file_digest, web_search)
+    try:
+        for chunk in chunks:
+            meter.chunk(chunk)
+            yield chunk
+    finally:
+        chunks.close()
+        meter.close()
+        ticket.release()
+
+def _stream_provider(provider, model, prompt, file_path, mime_type, file_digest, web_search):
+    if provider == "gemini":
+        file_uri = None
+        if file_path:
+            file_uri = lookup_gemini_file(file_digest)
+            if file_uri:
+                yield f"// {upload_display_name(file_path)} already in Google Vault. Skipping upload...\n"
+            else:
+                yield f"// Uploading {upload_display_name(file_path)} to Google Vault...\n"
+                file_uri = upload_to_gemini(file_path, mime_type, file_digest)
+
+        cached_content, delta = gemini_context(prompt, model, file_uri, mime_type, file_digest, web_search, file_path)
+        if cached_content:
+            try:
+                yield from stream_gemini(delta, model, None, mime_type, web_search, cached_content)
+                return
+            except ProviderError as e:
+                if e.status not in (400, 403, 404):
+                    raise
+                gemini_contexts.drop(model, file_digest) # expired or rejected: send the full request
+        yield from stream_gemini(prompt, model, file_uri, mime_type, web_search)
+
+    elif provider == "groq":
+        if file_path:
+            yield f"// Processing Image Data for Groq...\n"
+        yield from stream_groq(prompt, model, file_path, mime_type, file_digest)
+
+    elif provider == "cerebras":
+        # Cerebras is Text-Only currently for standard inference
+        if file_path:
+            yield f"// WARNING: Cerebras provider supports TEXT ONLY. File ignored.\n"
+        yield from stream_cerebras(prompt, model)
+
+# --- ROUTING ---
+
+class CircuitBreaker:
+    """Per (provider, model) breaker. Opens after BREAKER_THRESHOLD consecutive
+    failures (or at once on 401/403/404, which retrying will not fix) and lets
+    a single probe through once the cooldown has passed.
+
+    available() only looks; allow() is called when a call actually starts and
+    claims the probe of a half-open breaker. Every allowed call must end in
+    exactly one success(), failure() or release()."""
+
+    def __init__(self):
+        self.state = {} # key -> {"failures", "open_until", "probing"}
+        self.lock = threading.Lock()
+
+    def available(self, key):
+        with self.lock:
+            st = self.state.get(key)
+            return not st or st["open_until"] == 0 or (time.time() >= st["open_until"] and not st["probing"])
+
+    def allow(self, key):
+        with self.lock:
+            st = self.state.get(key)
+            if not st or st["open_until"] == 0:
+                return True
+            if time.time() < st["open_until"] or st["probing"]:
+                return False
+            st["probing"] = True # half-open: this caller is the probe
+            return True
+
+    def success(self, key):
+        with self.lock:
+            self.state.pop(key, None)
+
+    def release(self, key):
+        """Ends a call that says nothing about the provider (cancelled, or
+        refused by our own admission control): frees the probe, if it held it."""
+        with self.lock:
+            st = self.state.get(key)
+            if st:
+                st["probing"] = False
+
+    def failure(self, key, error=None):
+        if isinstance(error, (Overloaded, Cancelled)):
+            self.release(key) # not an upstream fault
+            return
+        status = getattr(error, "status", None)
+        label_provider, label_model = metric_labels(*key)
+        PROVIDER_ERRORS.inc(provider=label_provider, model=label_model,
+                            error=status or (type(error).__name__ if error is not None else "unknown"))
+        if status == 429:
+            get_scheduler(key[0]).pause(getattr(error, "retry_after", None) or 1)
+        with self.lock:
+            st = self.state.setdefault(key, {"failures": 0, "open_until": 0, "probing": False})
+            st["failures"] += 1
+            if status in (401, 403, 404):
+                st["open_until"] = time.time() + BREAKER_HARD_COOLDOWN
+            elif st["failures"] >= BREAKER_THRESHOLD or st["probing"]:
+                st["open_until"] = time.time() + BREAKER_COOLDOWN
+            st["probing"] = False
+
+breaker = CircuitBreaker()
+
+def parse_route(spec):
+    chain = []
+    for entry in spec.split(","):
+        provider, _, model = entry.strip().partition(":")
+        if provider and model:
+            chain.append((provider, model))
+    return chain
+
+ROUTES = {capability: parse_route(spec) for capability, spec in ROUTE_CHAINS.items()}
+
+# Server-side (provider, model) choices, always labelled by name in metrics
+CONFIGURED_TARGETS = set(DEFAULT_MODELS.items()) | {c for chain in ROUTES.values() for c in chain} \
+    | set(parse_route(f"{CLAIM_EXTRACT_MODEL},{CLAIM_VERIFY_MODELS}")) | {("cerebras", m) for m in AI_CHECK_MODELS}
+
+# Status line before an answer that came from a fallback model
+FALLBACK_NOTE = "// Answered by fallback model "
+
+def route_candidates(provider, model, file_path=None, web_search=False):
+    """Requested (provider, model) first, then the capability's fallback chain,
+    minus anything whose breaker is open. Never returns an empty list.
+    Nothing is claimed here; callers allow() a candidate when they start it."""
+    capability = "web_search" if web_search else ("image" if file_path else "text")
+    chain = [(provider, model)]
+    if ROUTING_FAILOVER:
+        chain += [c for c in ROUTES.get(capability, []) if c != (provider, model)]
+    healthy = [c for c in chain if breaker.available(c)]
+    return healthy or chain[:1]
+
+def _pump(index, chunks, out, cancel):
+    """Worker: forwards one candidate's chunks into the shared queue. Its
+    upstream streams register with cancel, which aborts them."""
+    current_cancel_scope.set(cancel)
+    try:
+        for chunk in chunks:
+            if cancel.is_set():
+                break
+            out.put((index, "chunk", chunk))
+        out.put((index, "done", None))
+    except Exception as e:
+        out.put((index, "error", e))
+    finally:
+        chunks.close() # releases the scheduler slot of a cancelled loser
+
+class RoutedCall:
+    """Routing decisions of one stream_routed call, shared by the thread and
+    asyncio versions; they only start and stop candidate workers.
+
+    Candidates come from route_candidates(). A candidate that errors (or
+    ends empty) before its first answer token is recorded against its
+    breaker and the next one takes over. With hedge_ms, the next candidate
+    is also started when the current one has been silent that long; the
+    first to produce a token wins and the others are stopped. Once a
+    candidate is streaming its answer there is no switching. A pre-admitted
+    ticket is handed to the first candidate when it is on the same provider.
+    When a fallback model wins, its answer is preceded by a FALLBACK_NOTE
+    status line so it is not cached as the requested model's verdict.
+
+    start(index, provider, model, ticket) runs a candidate's stream_fact_check
+    and reports its events to handle(); stop(index) cancels it (idempotent).
+    """
+
+    def __init__(self, provider, model, file_path, web_search, hedge_ms, ticket, start, stop):
+        self.requested = (provider, model)
+        self.hedge_ms = HEDGE_AFTER_MS if hedge_ms is None else hedge_ms
+        self.candidates = route_candidates(provider, model, file_path, web_search)
+        if ticket is not None and self.candidates[0][0] != ticket.provider:
+            ticket.release()
+            ticket = None
+        self.ticket = ticket
+        self.start = start
+        self.stop = stop
+        self.next_index = 0
+        self.active = set()
+        self.failed = set()
+        self.allowed = set() # started candidates holding a breaker allow()
+        self.settled = set() # ... whose outcome has been reported
+        self.winner = None
+        self.hedged = False
+        self.last_error = None
+
+    def launch(self):
+        index = self.next_index
+        self.next_index += 1
+        if breaker.allow(self.candidates[index]):
+            self.allowed.add(index)
+        self.active.add(index)
+        self.start(index, *self.candidates[index], self.ticket if index == 0 else None)
+
+    def hedge_timeout(self):
+        """Seconds to wait for the next event before hedging, or None."""
+        if self.winner is None and not self.hedged and self.hedge_ms > 0 and self.next_index < len(self.candidates):
+            return self.hedge_ms / 1000.0
+        return None
+
+    def hedge(self):
+        self.hedged = True
+        prov, mdl = self.candidates[self.next_index]
+        self.launch()
+        return f"// No response yet. Hedging with {prov}/{mdl}...\n"
+
+    def _fail(self, index, error):
+        self.failed.add(index)
+        self.settled.add(index)
+        self.stop(index)
+        breaker.failure(self.candidates[index], error)
+        self.last_error = error
+
+    def handle(self, index, kind, value):
+        """Applies one worker event ("chunk", "error" or "done"); returns the
+        chunks to pass on. Raises the error that ends the call."""
+        if index in self.failed or (self.winner is not None and index != self.winner):
+            if kind != "chunk":
+                self.active.discard(index)
+            return []
+        out = []
+        if kind == "chunk":
+            if value.startswith("//"):
+                return [value]
+            if self.winner is None:
+                if value.startswith("[System Error"):
+                    self._fail(index, Exception(value.strip("[] \n")))
+                    self.active.discard(index)
+                else:
+                    self.winner = index
+                    self.settled.add(index)
+                    breaker.success(self.candidates[index])
+                    for other in range(self.next_index):
+                        if other != index:
+                            self.stop(other)
+                    self.active = {index}
+                    if self.candidates[index] != self.requested:
+                        out.append(f"{FALLBACK_NOTE}{self.candidates[index][0]}/{self.candidates[index][1]}.\n")
+            if self.winner == index:
+                out.append(value)
+                return out
+        elif kind == "error":
+            self.active.discard(index)
+            if isinstance(value, Cancelled):
+                raise value
+            if index == self.winner:
+                breaker.failure(self.candidates[index], value)
+                raise value
+            self._fail(index, value)
+        else: # done
+            self.active.discard(index)
+            if index == self.winner:
+                return out
+            self._fail(index, Exception(f"{self.candidates[index][0]} returned an empty response"))
+
+        # A pre-answer failure: move down the chain if nothing else is running
+        if self.winner is None and not self.active:
+            if self.next_index >= len(self.candidates):
+                raise self.last_error
+            prov, mdl = self.candidates[self.next_index]
+            out.append(f"// {self.candidates[index][0]}/{self.candidates[index][1]} unavailable. Switching to {prov}/{mdl}...\n")
+            self.launch()
+        return out
+
+    def close(self):
+        for index in range(self.next_index):
+            self.stop(index)
+        for index in self.allowed - self.settled: # stopped losers, Cancelled, abandoned streams
+            breaker.release(self.candidates[index])
+
+def stream_routed(provider, model, prompt, file_path=None, mime_type=None, file_digest=None, web_search=False, hedge_ms=None, ticket=None):
+    """stream_fact_check with failover and optional hedging (see RoutedCall),
+    one worker thread per started candidate."""
+    out = queue.Queue()
+    cancels = {}
+
+    def start(index, prov, mdl, ticket):
+        cancels[index] = CancelScope()
+        chunks = stream_fact_check(prov, mdl, prompt, file_path, mime_type, file_digest, web_search, ticket=ticket)
+        threading.Thread(target=contextvars.copy_context().run, args=(_pump, index, chunks, out, cancels[index]), daemon=True).start()
+
+    def stop(index):
+        if index in cancels:
+            cancels[index].set()
+
+    call = RoutedCall(provider, model, file_path, web_search, hedge_ms, ticket, start, stop)
+    try:
+        call.launch()
+        while call.active:
+            try:
+                event = out.get(timeout=call.hedge_timeout())
+            except queue.Empty:
+                yield call.hedge()
+                continue
+            yield from call.handle(*event)
+    finally:
+        call.close()
+
+def overloaded_response(error):
+    response = jsonify({"reply": f"System Busy: {error}", "retry_after": error.retry_after})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+def remember_answer(cache_key, cache_kind, output, probe=None):
+    """Caches a finished answer (answer chunks only, no status lines), and
+    indexes it for near-duplicates when a probe is given.
+    Only complete, error-free answers are worth replaying."""
+    text = "".join(output)
+    if text.strip() and "[System Error" not in text:
+        verdict_cache.set(cache_key, cache_kind, text)
+        if probe is not None:
+            probe.add(cache_key, cache_kind, text)
+
+def near_dup_response(match, fmt="text"):
+    similarity, text = match
+    def replay():
+        yield f"// Near-duplicate of an already verified item ({similarity:.0%} similar). Replaying its verdict...\n"
+        yield from replay_stream(text)
+    response = Response(stream_with_context(format_stream(replay(), fmt)), content_type=STREAM_FORMATS[fmt])
+    response.headers["X-Vectora-Match"] = f"{similarity:.2f}"
+    return response
+
+class AnswerRecord:
+    """What a produced stream leaves for the verdict cache: its answer chunks,
+    and whether a fallback model wrote them."""
+
+    def __init__(self):
+        self.output = []
+        self.fallback = False
+
+    def add(self, chunk):
+        if not chunk.startswith("//"):
+            self.output.append(chunk)
+        elif chunk.startswith(FALLBACK_NOTE):
+            self.fallback = True
+
+    def remember(self, cache_key, cache_kind, probe=None):
+        if not self.fallback: # another model's answer is not this key's verdict
+            remember_answer(cache_key, cache_kind, self.output, probe)
+
+def end_production(flight, cache_key, ticket, file_path):
+    ticket.release()
+    process_flights.forget(cache_key, flight)
+    remove_upload(file_path)
+
+def produce_answer(flight, cache_key, cache_kind, chunks, ticket, file_path=None, probe=None):
+    """Runs a fact-check stream into a flight (on its own thread, so it outlives
+    any one client), caching the answer before followers are let go."""
+    record = AnswerRecord()
+    deadline = current_deadline.get()
+    if deadline is not None:
+        flight.on_cancel(deadline.cancel) # last client gone: stop the upstream call
+    try:
+        for chunk in chunks:
+            record.add(chunk)
+            flight.publish(chunk)
+        if deadline is not None and deadline.cancelled is not None:
+            raise Cancelled(deadline.reason()) # never cache an answer cut short
+    except Exception as e:
+        flight.finish(error=e)
+    else:
+        record.remember(cache_key, cache_kind, probe)
+        flight.finish()
+    finally:
+        chunks.close()
+        end_production(flight, cache_key, ticket, file_path)
+
+# --- CLAIM DECOMPOSITION ---
+
+CLAIM_EXTRACT_PROMPT = (
+    "Split the text below into its independent, checkable factual claims (ATOMIC CLAIMS). "
+    "Rewrite each claim so it stands on its own (no pronouns pointing outside it), "
+    "skip opinions, questions and greetings, and merge duplicates. "
+    "Respond with a JSON array of strings ONLY (no markdown, no extra text), "
+    "at most {max_claims} items.\n\n[TEXT]: {text}"
+)
+
+VERDICTS = ("TRUE", "FALSE", "MISLEADING", "SATIRE", "UNVERIFIED")
+
+def complete_routed(provider, model, prompt, web_search=False):
+    """Runs a routed stream to completion and returns the answer text."""
+    return "".join(c for c in stream_routed(provider, model, prompt, web_search=web_search) if not c.startswith("//"))
+
+def extract_claims(text):
+    """Atomic claims in text, via the fast CLAIM_EXTRACT_MODEL. [] if it gives no usable list."""
+    provider, _, model = CLAIM_EXTRACT_MODEL.partition(":")
+    answer = complete_routed(provider, model, CLAIM_EXTRACT_PROMPT.format(max_claims=CLAIM_MAX, text=text))
+    start, end = answer.find("["), answer.rfind("]")
+    try:
+        items = json.loads(answer[start:end + 1]) if start != -1 else []
+    except json.JSONDecodeError:
+        return []
+    claims, seen = [], set()
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, str) and item.strip() and normalize_input(item) not in seen:
+            seen.add(normalize_input(item))
+            claims.append(item.strip())
+    return claims[:CLAIM_MAX]
+
+def parse_verdict(text):
+    """Pulls VERDICT / RISK SCORE / ANALYSIS / SOURCES out of an output-protocol answer."""
+    verdict = re.search(r"VERDICT\W*(" + "|".join(VERDICTS) + r")", text, re.IGNORECASE)
+    risk = re.search(r"RISK SCORE\W*([^\n]*)", text, re.IGNORECASE)
+    analysis = re.search(r"ANALYSIS\**:?\**\s*(.*?)(?=\n\s*(?:\d\.\s*)?\**SOURCES|\Z)", text, re.IGNORECASE | re.DOTALL)
+    sources = text[text.upper().rfind("SOURCES"):] if "SOURCES" in text.upper() else ""
+    return {
+        "verdict": verdict.group(1).upper() if verdict else "UNVERIFIED",
+        "risk": extract_probability(risk.group(1)) if risk else None,
+        "analysis": analysis.group(1).strip() if analysis else text.strip(),
+        "sources": re.findall(r"^\s*[-*]\s*(.+?https?://\S+)", sources, re.MULTILINE)
+    }
+
+def aggregate_verdicts(claims, results):
+    """Overall answer in the output protocol. Unanimous claims keep their verdict,
+    any false or misleading claim makes a mixed text MISLEADING, and the
+    riskiest claim sets the risk score."""
+    known = [r["verdict"] for r in results if r["verdict"] != "UNVERIFIED"]
+    if not known:
+        verdict = "UNVERIFIED"
+    elif len(set(known)) == 1 and len(known) == len(results):
+        verdict = known[0]
+    elif any(v in ("FALSE", "MISLEADING") for v in known):
+        verdict = "MISLEADING"
+    else:
+        verdict = "UNVERIFIED"
+    risks = [r["risk"] for r in results if r["risk"] is not None]
+    risk = max(risks) if risks else 50
+    counts = ", ".join(f"{n} {v}" for v in VERDICTS for n in [sum(r["verdict"] == v for r in results)] if n)
+    riskiest = max(range(len(results)), key=lambda i: results[i]["risk"] or 0)
+    sources = list(OrderedDict.fromkeys(s for r in results for s in r["sources"]))
+    return (
+        "\n---\n"
+        f"1. **VERDICT**: {verdict}\n"
+        f"2. **RISK SCORE**: {risk}%\n"
+        f"3. **ANALYSIS**: Checked {len(claims)} independent claims ({counts}). "
+        f"Highest risk: claim {riskiest + 1}, \"{claims[riskiest].rstrip('.')}\".\n"
+        "4. **SOURCES**:\n" + "".join(f"- {s}\n" for s in sources)
+    )
+
+def verify_claim(claim, provider, model, web_search=False):
+    return parse_verdict(complete_routed(provider, model, build_prompt(claim), web_search))
+
+def stream_claims(provider, model, user_input, web_search=False, ticket=None):
+    """Decomposed fact-check: extracts atomic claims, verifies them concurrently
+    (CLAIM_CONCURRENCY at a time, spread over CLAIM_VERIFY_MODELS), streams each
+    claim's verdict as it lands, then the aggregated verdict."""
+    if ticket is not None:
+        ticket.release() # every sub-call is admitted on its own
+    yield "// Extracting individual claims...\n"
+    claims = extract_claims(user_input)
+    if len(claims) < 2:
+        yield "// No separate claims found. Running a standard analysis...\n"
+        yield from stream_routed(provider, model, build_prompt(user_input), web_search=web_search)
+        return
+
+    yield f"// {len(claims)} claims found. Verifying them in parallel...\n"
+    targets = parse_route(CLAIM_VERIFY_MODELS) or [(provider, model)]
+    results = [None] * len(claims)
+    pool = ThreadPoolExecutor(max_workers=min(CLAIM_CONCURRENCY, len(claims)))
+    futures = {
+        pool.submit(contextvars.copy_context().run, verify_claim, claim, *targets[i % len(targets)], web_search): i
+        for i, claim in enumerate(claims)
+    }
+    try:
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                print(f"Claim verification failed: {e}", file=sys.stderr)
+                results[i] = {"verdict": "UNVERIFIED", "risk": None, "analysis": "Could not be verified right now.", "sources": []}
+            risk = f"{results[i]['risk']}%" if results[i]["risk"] is not None else "n/a"
+            yield (f"**Claim {i + 1}:** {claims[i]}\n"
+                   f"- **VERDICT**: {results[i]['verdict']} | **RISK SCORE**: {risk}\n"
+                   f"- {results[i]['analysis']}\n\n")
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    yield aggregate_verdicts(claims, results)
+
+# --- VERDICT EVENTS ---
+
+STREAM_FORMATS = {"text": "text/plain", "ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+class VerdictStreamParser:
+    """Incremental reader of output-protocol answers. feed() takes stream chunks
+    and returns events as soon as they can be told apart: status lines, answer
+    text, the verdict, the risk score and each source URL. Per-claim verdicts
+    (claim mode) carry the claim number. close() adds a final "done" event with
+    the parse_verdict() summary of the whole answer."""
+
+    VERDICT_RE = re.compile(r"VERDICT\W*(" + "|".join(VERDICTS) + r")\b", re.IGNORECASE)
+    RISK_RE = re.compile(r"RISK SCORE\W*(\d{1,3}) ?%", re.IGNORECASE)
+    CLAIM_RE = re.compile(r"\s*\**Claim (\d+):", re.IGNORECASE)
+    LINK_RE = re.compile(r"\[([^\]]*)\]\((https?://[^\s)]+)\)")
+    URL_RE = re.compile(r"https?://[^\s)\]>]+")
+
+    def __init__(self):
+        self.text = []
+        self.line = ""
+        self.claim = None # claim number the current lines belong to
+        self.seen = set() # (claim, field) already reported
+        self.in_sources = False
+
+    def feed(self, chunk):
+        if chunk.startswith("//"):
+            return [{"type": "status", "text": chunk.strip("/ \n")}]
+        events = [{"type": "text", "text": chunk}]
+        self.text.append(chunk)
+        self.line += chunk
+        while "\n" in self.line:
+            line, self.line = self.line.split("\n", 1)
+            events.extend(self._scan(line, complete=True))
+        events.extend(self._scan(self.line, complete=False))
+        return events
+
+    def close(self):
+        events = self._scan(self.line, complete=True)
+        self.line = ""
+        return events + [dict(parse_verdict("".join(self.text)), type="done")]
+
+    def _event(self, kind, key=None, **fields):
+        key = (self.claim, key or kind)
+        if key in self.seen:
+            return []
+        self.seen.add(key)
+        event = {"type": kind, **fields}
+        if self.claim is not None:
+            event["claim"] = self.claim
+        return [event]
+
+    def _scan(self, line, complete):
+        if complete:
+            claim = self.CLAIM_RE.match(line)
+            if claim:
+                self.claim = int(claim.group(1))
+                return []
+            if re.match(r"\s*\d\.\s", line):
+                self.claim = None # numbered protocol items: the overall answer
+        events = []
+        verdict = self.VERDICT_RE.search(line)
+        if verdict:
+            events += self._event("verdict", verdict=verdict.group(1).upper())
+        risk = self.RISK_RE.search(line)
+        if risk:
+            events += self._event("risk", risk=min(int(risk.group(1)), 100))
+        if not complete:
+            return events
+        if re.match(r"\s*(?:\d\.\s*)?\**SOURCES", line, re.IGNORECASE):
+            self.in_sources = True
+        elif self.in_sources:
+            # Markdown links despite the protocol: [title](url)
+            for title, url in self.LINK_RE.findall(line):
+                url = url.rstrip(".,;")
+                events += self._event("source", key=url, url=url, title=title.strip() or url)
+            rest = self.LINK_RE.sub("", line)
+            for url in self.URL_RE.findall(rest):
+                url = url.rstrip(".,;")
+                title = rest.split(url)[0].strip(" -*:\t") or url
+                events += self._event("source", key=url, url=url, title=title)
+        return events
+
+def encode_event(event, fmt):
+    return json.dumps(event) + "\n" if fmt == "ndjson" else sse_event(event, event=event["type"])
+
+def format_stream(chunks, fmt="text"):
+    """/process output in the requested format: the plain text stream, or
+    VerdictStreamParser events as NDJSON lines or SSE."""
+    if fmt not in ("ndjson", "sse"):
+        yield from chunks
+        return
+    parser = VerdictStreamParser()
+    try:
+        for chunk in chunks:
+            for event in parser.feed(chunk):
+                yield encode_event(event, fmt)
+        for event in parser.close():
+            yield encode_event(event, fmt)
+    finally:
+        chunks.close()
+
+def sse_event(data, event=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+# --- JOB QUEUE ---
 
-def stream_gemini(prompt, model, file_uri=None, mime_type=None, web_search=False):
-    # Prepare URL
-    if not model.startswith("models/") and not model.startswith("tunedModels/"):
-         model_path = f"models/{model}"
-    else:
-         model_path = model
+class LeaseLost(Exception):
+    """The job was requeued (or given up) while this worker was running it."""
 
-    url = f"{GEMINI_BASE_URL}/{model_path}:streamGenerateContent?alt=sse"
-    params = {"key": GEMINI_API_KEY}
-    headers = {"Content-Type": "application/json"}
-    
-    parts = [{"text": prompt}]
-    if file_uri:
-        parts.insert(0, {"file_data": {"mime_type": mime_type, "file_uri": file_uri}})
-    
-    contents = [{"parts": parts}]
-    
-    tools = []
-    if web_search:
-        tools.append({"googleSearch": {}})
-        
-    payload = {
-        "contents": contents,
-        "generationConfig": {"temperature": 0.1} 
-    }
-    if tools:
-        payload["tools"] = tools
+class JobStore:
+    """Jobs and their streamed output in SQLite (WAL, so every process and
+    worker thread can share one file). Output is stored as numbered chunks;
+    a chunk's number is the SSE event id clients resume from.
 
-    # Request
-    with requests.post(url, headers=headers, params=params, json=payload, stream=True) as resp:
-        for line in resp.iter_lines():
-            if line:
-                decoded_line = line.decode('utf-8')
-                if decoded_line.startswith("data:"):
-                    json_str = decoded_line[5:].strip()
-                    try:
-                        chunk = json.loads(json_str)
-                        cand = chunk.get("candidates", [{}])[0]
-                        content = cand.get("content", {}).get("parts", [{}])[0].get("text", "")
-                        
-                        # Handle Text
-                        if content: yield content
-                        
-                        # Handle Grounding Metadata (Source Links)
-                        grounding = cand.get("groundingMetadata", {})
-                        chunks = grounding.get("groundingChunks", [])
-                        if chunks:
-                            links_md = "\n\n**Verified Sources:**\n"
-                            found_links = False
-                            for c in chunks:
-                                web = c.get("web", {})
-                                if web:
-                                    title = web.get("title", "Source")
-                                    uri = web.get("uri") or web.get("url") # Try both keys
-                                    if uri and uri.startswith("http"):
-                                        links_md += f"- [{title}]({uri})\n"
-                                        found_links = True
-                            if found_links:
-                                # Yield formatted source block
-                                yield "\n\n**Verified Sources:**\n" + links_md.replace("- [", "- ").replace("](", ": ").replace(")", "")
-                    except Exception as e:
-                        pass
+    A running job belongs to the attempt that claimed it: writes made with
+    an older attempt number are refused (LeaseLost)."""
 
-# --- GROQ HELPERS ---
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition() # new chunks or jobs in this process
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT, priority INTEGER, params TEXT, attempts INTEGER DEFAULT 0, "
+            "chunks INTEGER DEFAULT 0, result TEXT, error TEXT, "
+            "created_at REAL, started_at REAL, heartbeat REAL, finished_at REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, created_at)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS job_chunks (job_id TEXT, seq INTEGER, text TEXT, PRIMARY KEY (job_id, seq))"
+        )
+        self.db.commit()
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    def _notify(self):
+        with self.changed:
+            self.changed.notify_all()
 
-def convert_doc_to_images(doc_path):
-    """Converts PDF to images. Returns list of image paths."""
-    if not PDF_SUPPORT:
-        raise Exception("System Configuration Error: 'poppler' is not installed or not in PATH. PDF conversion for non-native models (like Groq) requires Poppler. Please install Poppler or use Gemini (native PDF support).")
-    
+    def submit(self, params, priority=0):
+        """Queues a job and returns its id; Overloaded when JOB_QUEUE_MAX are waiting."""
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            queued = self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= JOB_QUEUE_MAX:
+                raise Overloaded("job queue", 30)
+            self.db.execute(
+                "INSERT INTO jobs (id, status, priority, params, created_at) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, priority, json.dumps(params), time.time())
+            )
+            self.db.commit()
+        self._notify()
+        return job_id
+
+    def claim(self):
+        """Takes the next job (highest priority, then oldest), requeueing jobs
+        whose worker stopped heartbeating; one that has already been started
+        JOB_MAX_ATTEMPTS times (it keeps killing its worker) fails instead.
+        Returns the job dict or None."""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE") # serializes claims across processes
+            try:
+                stale = now - JOB_LEASE
+                abandoned = self.db.execute(
+                    "SELECT id, params FROM jobs WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+                    (stale, JOB_MAX_ATTEMPTS)
+                ).fetchall()
+                self.db.execute(
+                    "UPDATE jobs SET status = 'error', error = ?, finished_at = ? "
+                    "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+                    (f"Gave up after {JOB_MAX_ATTEMPTS} attempts: the worker stopped each time", now, stale, JOB_MAX_ATTEMPTS)
+                )
+                self.db.execute(
+                    "UPDATE jobs SET status = 'queued' WHERE status = 'running' AND heartbeat < ?", (stale,)
+                )
+                row = self.db.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' ORDER BY priority DESC, created_at LIMIT 1"
+                ).fetchone()
+                if row:
+                    self.db.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?, heartbeat = ? "
+                        "WHERE id = ?", (now, now, row[0])
+                    )
+                self.db.commit()
+            except sqlite3.Error:
+                self.db.rollback()
+                raise
+        for _, params in abandoned:
+            JOBS_FINISHED.inc(status="error")
+            remove_upload(json.loads(params)["file_path"])
+        return self.get(row[0]) if row else None
+
+    def _owned(self, job_id, attempt, sets, values):
+        """UPDATE of a job this attempt still runs (not committed); LeaseLost otherwise."""
+        cursor = self.db.execute(
+            f"UPDATE jobs SET {sets} WHERE id = ? AND status = 'running' AND attempts = ?", (*values, job_id, attempt)
+        )
+        if cursor.rowcount == 0:
+            self.db.rollback()
+            raise LeaseLost(job_id)
+
+    def heartbeat(self, job_id, attempt):
+        """Renews the job's lease."""
+        with self.lock:
+            self._owned(job_id, attempt, "heartbeat = ?", (time.time(),))
+            self.db.commit()
+
+    def append(self, job_id, attempt, start, texts):
+        """Stores chunks start.. and renews the job's lease."""
+        with self.lock:
+            self._owned(job_id, attempt, "chunks = ?, heartbeat = ?", (start + len(texts), time.time()))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO job_chunks (job_id, seq, text) VALUES (?, ?, ?)",
+                [(job_id, start + i, text) for i, text in enumerate(texts)]
+            )
+            self.db.commit()
+        self._notify()
+
+    def finish(self, job_id, attempt, status, result=None, error=None):
+        with self.lock:
+            self._owned(job_id, attempt, "status = ?, result = ?, error = ?, finished_at = ?",
+                        (status, result, error, time.time()))
+            self.db.commit()
+        JOBS_FINISHED.inc(status=status)
+        self._notify()
+
+    def get(self, job_id):
+        with self.lock:
+            cursor = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            job = dict(zip((c[0] for c in cursor.description), row))
+            if job["status"] == "queued":
+                job["position"] = self.db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND "
+                    "(priority > ? OR (priority = ? AND created_at < ?))",
+                    (job["priority"], job["priority"], job["created_at"])
+                ).fetchone()[0]
+        job["params"] = json.loads(job["params"])
+        return job
+
+    def read(self, job_id, offset):
+        """Chunks from seq offset on, as (seq, text) pairs."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT seq, text FROM job_chunks WHERE job_id = ? AND seq >= ? ORDER BY seq", (job_id, offset)
+            ).fetchall()
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def purge(self):
+        """Drops finished jobs older than JOB_TTL."""
+        with self.lock:
+            cutoff = time.time() - JOB_TTL
+            self.db.execute(
+                "DELETE FROM job_chunks WHERE job_id IN "
+                "(SELECT id FROM jobs WHERE status IN ('done', 'error') AND finished_at < ?)", (cutoff,)
+            )
+            self.db.execute("DELETE FROM jobs WHERE status IN ('done', 'error') AND finished_at < ?", (cutoff,))
+            self.db.commit()
+
+_job_store = None
+_job_store_lock = threading.Lock()
+_job_workers_started = False
+
+def get_job_store():
+    """Opens the job store on first use."""
+    global _job_store
+    with _job_store_lock:
+        if _job_store is None:
+            os.makedirs(JOBS_DIR, exist_ok=True)
+            _job_store = JobStore(JOBS_DB)
+        return _job_store
+
+def start_job_workers():
+    """Starts this process's JOB_WORKERS on first use of the job API; jobs
+    recovered from a previous run are picked up from then on."""
+    global _job_workers_started
+    store = get_job_store()
+    with _job_store_lock:
+        if _job_workers_started or JOB_WORKERS <= 0:
+            return store
+        _job_workers_started = True
+    for n in range(JOB_WORKERS):
+        threading.Thread(target=job_worker, args=(store,), name=f"job-worker-{n}", daemon=True).start()
+    return store
+
+def job_worker(store):
+    last_purge = 0
+    while True:
+        if time.time() - last_purge > 60:
+            last_purge = time.time()
+            store.purge()
+        try:
+            job = store.claim()
+        except sqlite3.Error as e:
+            print(f"Job claim failed: {e}", file=sys.stderr)
+            job = None
+        if job is None:
+            with store.changed:
+                store.changed.wait(2) # other processes may queue jobs too
+            continue
+        contextvars.copy_context().run(run_job, store, job)
+
+def keep_job_alive(store, job, deadline, stop):
+    """Heartbeats a running job until stop is set, so silent phases (uploads,
+    PDF conversion, a slow first token) keep the lease. If another worker
+    has taken the job over, the run is cancelled."""
+    while not stop.wait(JOB_LEASE / 4):
+        try:
+            store.heartbeat(job["id"], job["attempts"])
+        except LeaseLost:
+            deadline.cancel("lease")
+            return
+        except sqlite3.Error as e:
+            print(f"Job {job['id']} heartbeat failed: {e}", file=sys.stderr)
+
+def run_job(store, job):
+    """Runs one job, persisting its output every JOB_FLUSH_MS. Its upload is
+    removed only by the attempt that finishes the job."""
+    deadline = start_deadline(JOB_DEADLINE)
+    attempt = job["attempts"]
+    seq = job["chunks"] # a requeued job keeps what it already streamed
+    pending = ["// Worker restarted. Running the analysis again...\n"] if attempt > 1 else []
+    output = []
+    last_flush = time.monotonic()
+    stop = threading.Event()
+    threading.Thread(target=keep_job_alive, args=(store, job, deadline, stop), daemon=True).start()
+    chunks = job_chunks(job["params"])
     try:
-        images = convert_from_path(doc_path)
+        for chunk in chunks:
+            pending.append(chunk)
+            if not chunk.startswith("//"):
+                output.append(chunk)
+            if time.monotonic() - last_flush >= JOB_FLUSH_MS / 1000:
+                store.append(job["id"], attempt, seq, pending)
+                seq += len(pending)
+                pending = []
+                last_flush = time.monotonic()
+        if pending:
+            store.append(job["id"], attempt, seq, pending)
+        store.finish(job["id"], attempt, "done", result="".join(output))
+    except LeaseLost:
+        print(f"Job {job['id']} was taken over by another worker; stopping attempt {attempt}", file=sys.stderr)
+        return
     except Exception as e:
-         if "poppler" in str(e).lower() or "not in path" in str(e).lower():
-             raise Exception("System Error: Poppler not found. Please install Poppler to process PDFs with this model, or switch to Gemini.")
-         raise e
+        print(f"Job {job['id']} failed: {e}", file=sys.stderr)
+        try:
+            if pending:
+                store.append(job["id"], attempt, seq, pending)
+            store.finish(job["id"], attempt, "error", error=str(e))
+        except LeaseLost:
+            return
+        except sqlite3.Error as db_error:
+            print(f"Job {job['id']} could not be marked failed: {db_error}", file=sys.stderr)
+    finally:
+        stop.set()
+        chunks.close()
+    remove_upload(job["params"]["file_path"])
 
-    img_paths = []
-    base = os.path.splitext(doc_path)[0]
-    for i, img in enumerate(images):
-        path = f"{base}_page_{i}.jpg"
-        img.save(path, 'JPEG')
-        img_paths.append(path)
-        if i >= 4: break # Limit to first 5 pages for API limits
-    return img_paths
+def job_chunks(params):
+    """The /process pipeline for a queued job: cache, near-duplicates, then the
+    shared flight. Waits for scheduler capacity instead of answering 429.
+    The upload is left in place; run_job removes it once the job is finished."""
+    provider, model, user_input = params["provider"], params["model"], params["user_input"]
+    file_path, mime_type, file_digest = params["file_path"], params["mime_type"], params["file_digest"]
+    web_search, decompose = params["web_search"], params["decompose"]
+    cache_kind, cache_key = params["cache_kind"], params["cache_key"]
+    cached = verdict_cache.get(cache_key)
+    CACHE_LOOKUPS.inc(kind=cache_kind, result="miss" if cached is None else "hit")
+    if cached is not None:
+        yield "// Cached verdict found. Replaying analysis...\n"
+        yield from replay_stream(cached)
+        return
 
-def stream_groq(prompt, model, file_path=None, mime_type=None):
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    messages = []
-    content_list = [{"type": "text", "text": prompt}]
-    
-    if file_path and mime_type:
-        # Check if model supports vision (managed by frontend selection normally, but backend check is good)
-        # Assuming frontend passes correct model.
-        if mime_type.startswith("image/"):
-            b64_img = encode_image(file_path)
-            content_list.append({
-                "type": "image_url",
-                "image_url": {"url": f"data:{mime_type};base64,{b64_img}"}
-            })
-        elif mime_type == "application/pdf":
-            try:
-                img_paths = convert_doc_to_images(file_path)
-                for path in img_paths:
-                    b64 = encode_image(path)
-                    content_list.append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{b64}"}
-                    })
-            except Exception as e:
-                yield f"[System Error: PDF Conversion failed - {str(e)}]"
-                return
-    
-    messages.append({"role": "user", "content": content_list})
-    
-    data = {
-        "model": model, 
-        "messages": messages, 
-        "stream": True,
-        "temperature": 0.2
-    }
-    
-    with requests.post(f"{GROQ_BASE_URL}/chat/completions", headers=headers, json=data, stream=True) as resp:
-        for line in resp.iter_lines():
-            if line:
-                decoded_line = line.decode('utf-8')
-                if decoded_line.startswith("data:"):
-                    json_str = decoded_line[5:].strip()
-                    if json_str == "[DONE]": break
-                    try:
-                        chunk = json.loads(json_str)
-                        content = chunk["choices"][0]["delta"].get("content", "")
-                        if content: yield content
-                    except:
-                        pass
+    probe = near_dup_probe(
+        f"{cache_kind}{'#claims' if decompose else ''}:{provider}/{model}",
+        text=user_input if not file_path else None,
+        image=file_path if file_path and mime_type.startswith("image/") and not user_input else None
+    )
+    match = probe.match() if probe else None
+    if match:
+        yield f"// Near-duplicate of an already verified item ({match[0]:.0%} similar). Replaying its verdict...\n"
+        yield from replay_stream(match[1])
+        return
 
-# --- CEREBRAS HELPERS ---
+    prompt = build_prompt(user_input)
+    flight, leader = process_flights.join(cache_key)
+    if leader:
+        try:
+            while True:
+                try:
+                    ticket = acquire_slot(provider, estimate_tokens(prompt, file_path))
+                    break
+                except Overloaded as e:
+                    yield f"// {provider} is busy. Waiting {e.retry_after}s for capacity...\n"
+                    time.sleep(e.retry_after)
+                    check_deadline()
+        except BaseException as e:
+            flight.finish(error=e if isinstance(e, Exception) else Cancelled("Job stopped"))
+            process_flights.forget(cache_key, flight)
+            flight.detach()
+            raise
+        if decompose:
+            chunks = stream_claims(provider, model, user_input, web_search, ticket=ticket)
+        else:
+            chunks = stream_routed(provider, model, prompt, file_path, mime_type, file_digest, web_search, ticket=ticket)
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(produce_answer, flight, cache_key, cache_kind, chunks, ticket, None, probe),
+            daemon=True
+        ).start()
+    else:
+        yield "// Identical analysis already in progress. Attaching to it...\n"
+    try:
+        yield from flight.follow()
+    finally:
+        flight.detach()
 
-def stream_cerebras(prompt, model):
-    headers = {
-        "Authorization": f"Bearer {CEREBRAS_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "model": model,
-        "messages": [{"role": "user", "content": prompt}],
-        "stream": True,
-        "temperature": 0.2
+def job_view(job):
+    """Public JSON form of a job."""
+    view = {
+        "id": job["id"],
+        "status": job["status"],
+        "priority": job["priority"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "chunks": job["chunks"],
+        "stream": f"/jobs/{job['id']}/stream"
     }
-    
-    with requests.post(f"{CEREBRAS_BASE_URL}/chat/completions", headers=headers, json=data, stream=True) as resp:
-        for line in resp.iter_lines():
-            if line:
-                decoded_line = line.decode('utf-8')
-                if decoded_line.startswith("data:"):
-                    json_str = decoded_line[5:].strip()
-                    if json_str == "[DONE]": break
-                    try:
-                        chunk = json.loads(json_str)
-                        content = chunk["choices"][0]["delta"].get("content", "")
-                        if content: yield content
-                    except:
-                        pass
-
+    if job["status"] == "queued":
+        view["position"] = job["position"]
+    if job["status"] == "done":
+        view["result"] = job["result"]
+    if job["status"] == "error":
+        view["error"] = job["error"]
+    return view
 
 # --- ROUTES ---
 
+@app.before_request
+def begin_request_trace():
+    start_trace(request.url_rule.rule if request.url_rule else "unmatched")
+    start_deadline(REQUEST_DEADLINE)
+
+@app.after_request
+def end_request_trace(response):
+    trace = current_trace.get()
+    if trace is not None:
+        # Streamed bodies finish after this hook; the close callback sees the whole request
+        response.call_on_close(lambda: finish_trace(trace, response.status_code))
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Gzips buffered text and JSON responses of GZIP_MIN_BYTES or more for
+    clients that accept it. Streamed bodies are left alone: gzip would hold
+    tokens back until a block fills."""
+    if (not GZIP_MIN_BYTES or response.is_streamed or response.direct_passthrough
+            or response.status_code != 200 or "Content-Encoding" in response.headers
+            or "gzip" not in request.headers.get("Accept-Encoding", "").lower()):
+        return response
+    mimetype = response.mimetype or ""
+    if not (mimetype.startswith("text/") or mimetype.endswith(("json", "javascript", "xml"))):
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=6))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # Same content, different bytes; If-None-Match compares weakly, so 304s still work
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus scrape endpoint."""
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+_pages = {}
+
+def static_page(template):
+    """Renders a page template once per process and serves the cached HTML
+    (with an ETag); the pages take no request context."""
+    page = _pages.get(template)
+    if page is None:
+        html = render_template(template).encode("utf-8")
+        page = _pages[template] = (html, hashlib.sha256(html).hexdigest()[:16])
+    response = Response(page[0], content_type="text/html; charset=utf-8")
+    response.set_etag(page[1])
+    return response.make_conditional(request)
+
 @app.route("/")
-def home(): return render_template("home.html")
+def home(): return static_page("home.html")
 
 @app.route("/check")
-def check(): return render_template("check.html")
+def check(): return static_page("check.html")
 
 @app.route("/extension")
-def extension_page(): return render_template("extension.html")
+def extension_page(): return static_page("extension.html")
 
 @app.route('/about')
-def about_page(): return render_template('about.html')
+def about_page(): return static_page('about.html')
 
 @app.route('/contact')
-def contact_page(): return render_template('contact.html')
+def contact_page(): return static_page('contact.html')
 
 @app.route('/guide')
-def guide_page(): return render_template('guide.html')
+def guide_page(): return static_page('guide.html')
 
 @app.route("/api/models", methods=["GET"])
 def get_models():
-    """Fetch available models with capabilities."""
-    models = {"gemini": [], "groq": [], "cerebras": []}
-    
-    # 1. Gemini
-    try:
-        url = f"{GEMINI_BASE_URL}/models"
-        params = {"key": GEMINI_API_KEY}
-        resp = requests.get(url, params=params)
-        if resp.status_code == 200:
-            data = resp.json()
-            for m in data.get("models", []):
-                if "generateContent" in m.get("supportedGenerationMethods", []):
-                    name = m["name"].replace("models/", "")
-                    models["gemini"].append({
-                        "id": name,
-                        "capabilities": ["text", "image", "web_search"] # Gemini 1.5+ generally supports all
-                    })
-    except Exception as e:
-        print(f"Error fetching Gemini models: {e}", file=sys.stderr)
-        models["gemini"] = [
-            {"id": "gemini-2.0-flash", "capabilities": ["text", "image", "web_search"]},
-            {"id": "gemini-1.5-flash", "capabilities": ["text", "image", "web_search"]},
-            {"id": "gemini-1.5-pro", "capabilities": ["text", "image", "web_search"]}
-        ]
-
-    # 2. Groq (Hardcoded as per user request for specific model set)
-    models["groq"] = [
-        # TEXT + IMAGE
-        {"id": "meta-llama/llama-guard-4-12b", "capabilities": ["text", "image"]},
-        {"id": "meta-llama/llama-4-maverick-17b-128e-instruct", "capabilities": ["text", "image"]},
-        {"id": "meta-llama/llama-4-scout-17b-16e-instruct", "capabilities": ["text", "image"]},
-        # TEXT + WEB SEARCH (Compound & OSS)
-        {"id": "openai/gpt-oss-120b", "capabilities": ["text", "web_search"]},
-        {"id": "openai/gpt-oss-20b", "capabilities": ["text", "web_search"]},
-        {"id": "groq/compound", "capabilities": ["text", "web_search"]},
-        {"id": "groq/compound-mini", "capabilities": ["text", "web_search"]},
-        {"id": "openai/gpt-oss-safeguard-20b", "capabilities": ["text", "web_search"]}
-    ]
-
-    # 3. Cerebras (Live Fetch)
-    try:
-        url = f"{CEREBRAS_BASE_URL}/models"
-        headers = {"Authorization": f"Bearer {CEREBRAS_API_KEY}"}
-        resp = requests.get(url, headers=headers)
-        if resp.status_code == 200:
-            data = resp.json()
-            # Cerebras API response format: {"data": [{"id": "..."}, ...]}
-            for m in data.get("data", []):
-                models["cerebras"].append({
-                    "id": m["id"],
-                    "capabilities": ["text"] # Assume text-only for inference endpoints
-                })
-    except Exception as e:
-        print(f"Error fetching Cerebras models: {e}", file=sys.stderr)
-        # Fallback if fetch fails
-        models["cerebras"] = [
-            {"id": "llama3.1-8b", "capabilities": ["text"]},
-            {"id": "llama3.1-70b", "capabilities": ["text"]}
-        ]
-    
-    return jsonify(models)
+    """Fetch available models with capabilities (served from the TTL cache)."""
+    models, etag = get_cached_models()
+    response = jsonify(models)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"public, max-age={MODELS_CACHE_TTL}, stale-while-revalidate={MODELS_CACHE_STALE}"
+    return response.make_conditional(request)
 
 
 @app.route("/process", methods=["POST"])
 def process():
+    file_path = None
     try:
         user_input = request.form.get("user_input", "").strip()
         provider = request.form.get("provider", "gemini")
-        model = request.form.get("model", "")
+        try:
+            model = resolve_model(provider, request.form.get("model", ""))
+        except UnknownModel as e:
+            return jsonify({"reply": f"System Error: {e}"}), 400
         web_search = request.form.get("web_search") == "true"
+        decompose = request.form.get("decompose") == "true"
+        fmt = request.form.get("format", "text")
+        if fmt not in STREAM_FORMATS:
+            fmt = "text"
         
         # Files
         file = request.files.get("file")
-        file_path = None
         mime_type = None
+        file_digest = None
         
         if file and file.filename:
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            file.save(file_path)
-            mime_type = file.mimetype or "application/octet-stream"
-            if filename.lower().endswith(".pdf"): mime_type = "application/pdf"
-            if filename.lower().endswith(".jpg") or filename.lower().endswith(".jpeg"): mime_type = "image/jpeg"
-            if filename.lower().endswith(".png"): mime_type = "image/png"
-
-        if not model:
-            if provider == "gemini": model = "gemini-2.0-flash"
-            elif provider == "groq": model = "llama3-70b-8192"
-            else: model = "llama3.1-70b"
-
-        # DETAILED SYSTEM PROMPT
-        sys_prompt = (
-            "You are Vectora, an elite fact-checking AI Agent. "
-            "Your mission is to analyze the provided input (text, image, or document) "
-            "and verify its truthfulness with high precision.\n\n"
-            "## OUTPUT PROTOCOL:\n"
-            "1. **VERDICT**: [TRUE / FALSE / MISLEADING / SATIRE / UNVERIFIED]\n"
-            "2. **RISK SCORE**: [0-100%] (Probability of Misinformation)\n"
-            "3. **ANALYSIS**: Provide a crisp, evidence-based explanation. "
-            "Cite known facts and point out logical fallacies or manipulation tactics.\n"
-            "4. **SOURCES**: List credible sources with their direct **URL links** to verify your claims. \n"
-            "   - **FORMAT**: Use the format `- Source Name: https://full.url.here` (Do NOT use markdown links like `[text](url)`). \n"
-            "   - **CRITICAL**: Only list sources if you have a VALID, non-empty URL. \n"
-            "   - **VERIFICATION**: Ensure every link provided is a valid, accessible URL.\n\n"
-            "Maintain an objective, professional, and authoritative tone."
+            file_path, mime_type, file_digest = save_upload(file.stream, file.filename, file.mimetype)
+
+        prompt = build_prompt(user_input)
+
+        # Claim mode works on text; attachments take the standard path
+        decompose = decompose and bool(user_input) and not file_path
+        cache_kind = "web_search" if web_search else "process"
+        cache_key = verdict_key(provider, model + ("#claims" if decompose else ""), web_search, user_input, file_digest=file_digest)
+
+        cached = verdict_cache.get(cache_key)
+        CACHE_LOOKUPS.inc(kind=cache_kind, result="miss" if cached is None else "hit")
+        if cached is not None:
+            remove_upload(file_path)
+            def replay():
+                yield "// Cached verdict found. Replaying analysis...\n"
+                yield from replay_stream(cached)
+            return Response(stream_with_context(format_stream(replay(), fmt)), content_type=STREAM_FORMATS[fmt])
+
+        # Paraphrase or recompressed image of something already verified
+        probe = near_dup_probe(
+            f"{cache_kind}{'#claims' if decompose else ''}:{provider}/{model}",
+            text=user_input if not file_path else None,
+            image=file_path if file_path and mime_type.startswith("image/") and not user_input else None
         )
-        
-        if user_input:
-            prompt = f"{sys_prompt}\n\n[USER INPUT]: {user_input}"
+        match = probe.match() if probe else None
+        if match:
+            remove_upload(file_path)
+            return near_dup_response(match, fmt)
+
+        # Identical check already running: attach to it instead of calling upstream again
+        flight, leader = process_flights.join(cache_key)
+        if leader:
+            # Admission control: shed load here, while a real status can still be sent
+            try:
+                ticket = acquire_slot(provider, estimate_tokens(prompt, file_path))
+            except Overloaded as e:
+                flight.finish(error=e)
+                process_flights.forget(cache_key, flight)
+                flight.detach()
+                remove_upload(file_path)
+                return overloaded_response(e)
+            if decompose:
+                chunks = stream_claims(provider, model, user_input, web_search, ticket=ticket)
+            else:
+                chunks = stream_routed(provider, model, prompt, file_path, mime_type, file_digest, web_search, ticket=ticket)
+            threading.Thread(
+                target=contextvars.copy_context().run, # keeps this request's trace
+                args=(produce_answer, flight, cache_key, cache_kind, chunks, ticket, file_path, probe),
+                daemon=True
+            ).start()
         else:
-            prompt = f"{sys_prompt}\n\n(No text input. Analyze the attached file)"
+            remove_upload(file_path) # the leader's copy is the one being analyzed
 
         def generate():
+            if not leader:
+                yield "// Identical analysis already in progress. Attaching to it...\n"
             try:
-                if provider == "gemini":
-                    file_uri = None
-                    if file_path:
-                        yield f"// Uploading {os.path.basename(file_path)} to Google Vault...\n"
-                        file_uri = upload_to_gemini(file_path, mime_type)
-                    
-                    yield from stream_gemini(prompt, model, file_uri, mime_type, web_search)
-                
-                elif provider == "groq":
-                    if file_path:
-                        yield f"// Processing Image Data for Groq...\n"
-                    yield from stream_groq(prompt, model, file_path, mime_type)
-                    
-                elif provider == "cerebras":
-                    # Cerebras is Text-Only currently for standard inference
-                    if file_path:
-                        yield f"// WARNING: Cerebras provider supports TEXT ONLY. File ignored.\n"
-                    yield from stream_cerebras(prompt, model)
-                
+                yield from flight.follow()
             except Exception as e:
                 yield f"\n[SYSTEM ERROR: {str(e)}]"
-            finally:
-                pass
 
-        return Response(stream_with_context(generate()), content_type='text/plain')
+        response = Response(stream_with_context(format_stream(generate(), fmt)), content_type=STREAM_FORMATS[fmt])
+        response.call_on_close(flight.detach) # also runs when the client disconnects mid-stream
+        return response
 
+    except (UploadTooLarge, RequestEntityTooLarge) as e:
+        remove_upload(file_path)
+        return jsonify({"reply": f"System Error: {getattr(e, 'description', e)}"}), 413
     except Exception as e:
+        remove_upload(file_path)
         print("Flask exception in /process:", e, file=sys.stderr)
         return jsonify({"reply": f"System Error: {e}"}), 500
 
 
-@app.route('/ai-check', methods=['POST'])
-def ai_check():
-    """
-    Endpoint for the extension to check AI authenticity.
-    Accepts: { "text": "...", "image_url": "...", "video_url": "..." }
-    Returns: { "ai_percent": 0-100, "message": "..." }
-    Uses Cerebras API (OpenAI-compatible) for analysis.
-    """
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """Queues a /process-style check (same form fields, plus an optional
+    priority from -10 to 10, higher first) and returns its id at once."""
+    file_path = None
     try:
-        data = request.get_json() or {}
-        text_content = data.get('text', '').strip()
-        image_url = data.get('image_url', '').strip()
-        video_url = data.get('video_url', '').strip()
-        
-        if not (text_content or image_url or video_url):
-            return jsonify({"ai_percent": 0, "message": "No content provided"}), 400
-        
-        if not CEREBRAS_API_KEY:
-            return jsonify({"ai_percent": 50, "message": "Cerebras API not configured"}), 500
-        
-        # Build specific prompt for AI detection
-        if text_content:
-            system_msg = "You are an AI detection expert. Analyze content and respond with JSON only."
-            user_msg = f"""Analyze this text and determine the likelihood it was generated by AI.
+        user_input = request.form.get("user_input", "").strip()
+        provider = request.form.get("provider", "gemini")
+        try:
+            model = resolve_model(provider, request.form.get("model", ""))
+        except UnknownModel as e:
+            return jsonify({"error": str(e)}), 400
+        web_search = request.form.get("web_search") == "true"
+        decompose = request.form.get("decompose") == "true"
+        try:
+            priority = max(-10, min(10, int(request.form.get("priority", "0"))))
+        except ValueError:
+            return jsonify({"error": "priority must be an integer"}), 400
+
+        file = request.files.get("file")
+        mime_type = None
+        file_digest = None
+        if file and file.filename:
+            upload_path, mime_type, file_digest = save_upload(file.stream, file.filename, file.mimetype)
+            os.makedirs(JOBS_DIR, exist_ok=True)
+            file_path = os.path.join(JOBS_DIR, os.path.basename(upload_path))
+            shutil.move(upload_path, file_path) # the job may wait longer than UPLOAD_TTL
+        if not user_input and not file_path:
+            return jsonify({"error": "user_input or file required"}), 400
+
+        decompose = decompose and bool(user_input) and not file_path
+        cache_kind = "web_search" if web_search else "process"
+        params = {
+            "provider": provider, "model": model, "user_input": user_input, "web_search": web_search,
+            "decompose": decompose, "file_path": file_path, "mime_type": mime_type, "file_digest": file_digest,
+            "cache_kind": cache_kind,
+            "cache_key": verdict_key(provider, model + ("#claims" if decompose else ""), web_search, user_input,
+                                     file_digest=file_digest)
+        }
+        store = start_job_workers()
+        try:
+            job_id = store.submit(params, priority)
+        except Overloaded as e:
+            remove_upload(file_path)
+            return overloaded_response(e)
+        response = jsonify(job_view(store.get(job_id)))
+        response.status_code = 202
+        response.headers["Location"] = f"/jobs/{job_id}"
+        return response
+
+    except (UploadTooLarge, RequestEntityTooLarge) as e:
+        remove_upload(file_path)
+        return jsonify({"error": f"{getattr(e, 'description', e)}"}), 413
+    except Exception as e:
+        remove_upload(file_path)
+        print("Flask exception in /jobs:", e, file=sys.stderr)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = start_job_workers().get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job_view(job))
+
+@app.route("/jobs/<job_id>/stream", methods=["GET"])
+def stream_job(job_id):
+    """Job output as SSE. Each chunk is an event whose id is its sequence number;
+    reconnect with Last-Event-ID (or ?offset=N) to resume after it."""
+    store = start_job_workers()
+    if store.get(job_id) is None:
+        return jsonify({"error": "Unknown job"}), 404
+    last_event_id = request.headers.get("Last-Event-ID")
+    try:
+        if "offset" in request.args:
+            offset = int(request.args["offset"])
+        else:
+            offset = int(last_event_id) + 1 if last_event_id else 0
+    except ValueError:
+        return jsonify({"error": "offset must be an integer"}), 400
+
+    def generate():
+        nonlocal offset
+        idle = 0
+        while True:
+            job = store.get(job_id)
+            for seq, text in store.read(job_id, offset):
+                yield sse_event({"text": text}, event_id=seq)
+                offset = seq + 1
+                idle = 0
+            if job is None or job["status"] in ("done", "error"):
+                yield sse_event(job_view(job) if job else {"error": "Unknown job"}, event="end")
+                return
+            with store.changed:
+                store.changed.wait(1)
+            idle += 1
+            if idle >= 15:
+                idle = 0
+                yield ": keep-alive\n\n"
+
+    response = Response(generate(), content_type="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+def complete_ai_check(messages):
+    """Calls Cerebras (OpenAI-compatible) for an ai-check, walking AI_CHECK_MODELS
+    and skipping models whose breaker is open. Returns the first 200 response,
+    or the last failed one."""
+    url = f"{CEREBRAS_BASE_URL}/chat/completions"
+    headers = {
+        "Authorization": f"Bearer {CEREBRAS_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    models = [m for m in AI_CHECK_MODELS if breaker.available(("cerebras", m))] or AI_CHECK_MODELS[:1]
+    resp = None
+    error = None
+    for model in models:
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": 0.3,
+            "max_tokens": 256
+        }
+        probing = breaker.allow(("cerebras", model))
+        try:
+            ticket = acquire_slot("cerebras", len(json.dumps(messages)) // 4 + 256)
+            try:
+                resp = provider_request("cerebras", "POST", url, headers=headers, json=payload, timeout=15)
+            finally:
+                ticket.release()
+        except requests.exceptions.RequestException as e:
+            breaker.failure(("cerebras", model), e)
+            error = e
+            continue
+        except BaseException:
+            if probing:
+                breaker.release(("cerebras", model)) # Overloaded / Cancelled
+            raise
+        if resp.status_code == 200:
+            breaker.success(("cerebras", model))
+            return resp
+        print(f"Cerebras API error ({model}): {resp.status_code} - {resp.text}", file=sys.stderr)
+        breaker.failure(("cerebras", model), ProviderError("cerebras", resp.status_code, resp.text, parse_retry_after(resp.headers)))
+    if resp is None:
+        raise error
+    return resp
+
+def analyze_content(text_content, image_url, video_url, cache_key, probe=None, image_upload=None):
+    """Builds the AI-detection request for one item, calls the model and caches the verdict.
+    image_upload is (bytes, mime_type) for an image sent inline instead of by URL.
+    Images are looked up in the near-duplicate index once downloaded. Only a
+    verdict on content the model actually saw, parsed from its JSON, is cached."""
+    cacheable = True
+    # Build specific prompt for AI detection
+    if text_content:
+        system_msg = "You are an AI detection expert. Analyze content and respond with JSON only."
+        user_msg = f"""Analyze this text and determine the likelihood it was generated by AI.
 
 Text to analyze:
 {text_content}
@@ -462,139 +3820,294 @@ Return a percentage 0-100 where:
 - 41-60%: Mixed or unclear
 - 61-80%: Likely AI-generated
 - 81-100%: Almost certainly AI-generated"""
-            
-            messages = [{"role": "user", "content": user_msg}]
-            
-        else:
-            # For images: download, base64-encode, and send as vision request
-            system_msg = "You are an AI detection expert. Analyze images and respond with JSON only."
-            base_msg = """Analyze this image and determine the likelihood it was AI-generated.
+        
+        messages = [{"role": "user", "content": user_msg}]
+        
+    else:
+        # For images: download, base64-encode, and send as vision request
+        system_msg = "You are an AI detection expert. Analyze images and respond with JSON only."
+        base_msg = """Analyze this image and determine the likelihood it was AI-generated.
 
 Respond with a JSON object ONLY (no markdown, no extra text):
 {"ai_percent": <0-100>, "reason": "<brief explanation>"}
 
 Consider: artifacts, unnatural patterns, weird textures, impossible physics, watermarks, tool signs.
 Return 0-100 where 0=clearly real, 100=certainly AI-generated."""
-            
-            image_data = None
-            mime_type = "image/jpeg"
-            try:
-                # Download image from URL
-                img_resp = requests.get(image_url or video_url, timeout=10)
-                if img_resp.status_code == 200:
-                    image_data = base64.b64encode(img_resp.content).decode('utf-8')
-                    # Guess mime type from content-type header
-                    content_type = img_resp.headers.get('content-type', 'image/jpeg')
-                    if 'png' in content_type.lower():
-                        mime_type = "image/png"
-                    elif 'gif' in content_type.lower():
-                        mime_type = "image/gif"
-                    elif 'webp' in content_type.lower():
-                        mime_type = "image/webp"
-            except Exception as e:
-                print(f"Failed to download image: {e}", file=sys.stderr)
-            
-            if image_data:
-                messages = [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": base_msg},
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": f"data:{mime_type};base64,{image_data}"}
-                            }
-                        ]
-                    }
-                ]
+        
+        image_data = []
+        try:
+            if image_upload:
+                image_data = [image_data_url(*image_upload, provider="cerebras")]
+            elif image_url:
+                image_data = load_image_url(image_url)
             else:
-                # Fallback if image download fails
-                messages = [
-                    {
-                        "role": "user",
-                        "content": base_msg + f"\n\nNote: Could not download image from {image_url or video_url}"
-                    }
-                ]
+                image_data = load_video_frames(video_url)
+                base_msg += f"\n\nThe {len(image_data)} images are frames sampled from one video; judge the video as a whole."
+        except Exception as e:
+            print(f"Failed to download image: {e}", file=sys.stderr)
+
+        if (image_url or image_upload) and image_data:
+            probe = near_dup_probe("ai_check", image=base64.b64decode(image_data[0].split(",", 1)[1]))
+            match = probe.match() if probe else None
+            if match:
+                return dict(match[1], near_duplicate={"similarity": round(match[0], 2)}), 200
         
-        # Call Cerebras API (OpenAI-compatible)
-        url = "https://api.cerebras.ai/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {CEREBRAS_API_KEY}",
-            "Content-Type": "application/json"
-        }
+        if image_data:
+            messages = [
+                {
+                    "role": "user",
+                    "content": [{"type": "text", "text": base_msg}] + [
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": data_url}
+                        }
+                        for data_url in image_data
+                    ]
+                }
+            ]
+        else:
+            # Fallback if image download fails; a blind guess, so never cached
+            cacheable = False
+            messages = [
+                {
+                    "role": "user",
+                    "content": base_msg + f"\n\nNote: Could not download image from {image_url or video_url}"
+                }
+            ]
+    
+    try:
+        with span("ai_check_call", "cerebras"):
+            resp = complete_ai_check(messages)
         
-        payload = {
-            "model": "llama-3-70b-instruct",  # Cerebras model
-            "messages": messages,
-            "temperature": 0.3,
-            "max_tokens": 256
-        }
+        if resp.status_code != 200:
+            return {"ai_percent": 50, "message": "Analysis service temporarily unavailable"}, 200
         
+        result = resp.json()
+        text_response = result.get("choices", [{}])[0].get("message", {}).get("content", "")
+        
+        if not text_response:
+            return {"ai_percent": 50, "message": "No analysis returned"}, 200
+        
+        # Clean up markdown code blocks if present
+        text_response = text_response.replace("```json", "").replace("```", "").strip()
+        
+        # Extract JSON from response
         try:
-            resp = requests.post(url, headers=headers, json=payload, timeout=15)
-            
-            if resp.status_code != 200:
-                print(f"Cerebras API error: {resp.status_code} - {resp.text}", file=sys.stderr)
-                return jsonify({"ai_percent": 50, "message": "Analysis service temporarily unavailable"}), 200
-            
-            result = resp.json()
-            text_response = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-            
-            if not text_response:
-                return jsonify({"ai_percent": 50, "message": "No analysis returned"}), 200
-            
-            # Clean up markdown code blocks if present
-            text_response = text_response.replace("```json", "").replace("```", "").strip()
-            
-            # Extract JSON from response
+            import re
+            json_match = re.search(r'\{.*?\}', text_response, re.DOTALL)
+            if json_match:
+                json_str = json_match.group()
+                analysis = json.loads(json_str)
+            else:
+                # Try direct parse if it's pure JSON
+                analysis = json.loads(text_response)
+            cacheable = cacheable and "ai_percent" in analysis
+            ai_percent = int(analysis.get("ai_percent", 50))
+            reason = analysis.get("reason", "Analysis complete")
+        except json.JSONDecodeError as je:
+            # Fallback: extract percentage and reason from text
+            AI_CHECK_PARSE_FALLBACKS.inc()
+            cacheable = False
+            percent_match = re.search(r'"ai_percent"\s*:\s*(\d+)', text_response)
+            ai_percent = int(percent_match.group(1)) if percent_match else 50
+            reason_match = re.search(r'"reason"\s*:\s*"([^"]*)"', text_response)
+            reason = reason_match.group(1) if reason_match else "Unable to parse full response"
+        
+        # Ensure percentage is valid
+        ai_percent = min(100, max(0, ai_percent))
+        
+        verdict = {
+            "ai_percent": ai_percent,
+            "message": reason
+        }
+        if cacheable:
+            verdict_cache.set(cache_key, "ai_check", verdict)
+            if probe is not None:
+                probe.add(cache_key, "ai_check", verdict)
+        return verdict, 200
+    
+    except Overloaded as e:
+        return {"ai_percent": 50, "message": "Analysis service busy, retry later", "retry_after": e.retry_after}, 429
+    except requests.exceptions.Timeout:
+        return {"ai_percent": 50, "message": "Analysis timeout"}, 200
+    except Exception as api_error:
+        print(f"API call error: {str(api_error)}", file=sys.stderr)
+        return {"ai_percent": 50, "message": "Analysis service error"}, 200
+
+
+def check_ai_content(data):
+    """
+    Runs one AI-authenticity check.
+    Accepts: { "text": "...", "image_url": "...", "image_data": "data:image/...", "video_url": "..." }
+    Returns: ({ "ai_percent": 0-100, "message": "..." }, http_status)
+    Uses Cerebras API (OpenAI-compatible) for analysis.
+    """
+    try:
+        text_content = data.get('text', '').strip()
+        image_url = data.get('image_url', '').strip()
+        video_url = data.get('video_url', '').strip()
+        image_upload = None
+        if not text_content and data.get('image_data'):
             try:
-                import re
-                json_match = re.search(r'\{.*?\}', text_response, re.DOTALL)
-                if json_match:
-                    json_str = json_match.group()
-                    analysis = json.loads(json_str)
-                    ai_percent = int(analysis.get("ai_percent", 50))
-                    reason = analysis.get("reason", "Analysis complete")
-                else:
-                    # Try direct parse if it's pure JSON
-                    analysis = json.loads(text_response)
-                    ai_percent = int(analysis.get("ai_percent", 50))
-                    reason = analysis.get("reason", "Analysis complete")
-            except json.JSONDecodeError as je:
-                # Fallback: extract percentage and reason from text
-                percent_match = re.search(r'"ai_percent"\s*:\s*(\d+)', text_response)
-                ai_percent = int(percent_match.group(1)) if percent_match else 50
-                reason_match = re.search(r'"reason"\s*:\s*"([^"]*)"', text_response)
-                reason = reason_match.group(1) if reason_match else "Unable to parse full response"
-            
-            # Ensure percentage is valid
-            ai_percent = min(100, max(0, ai_percent))
-            
-            return jsonify({
-                "ai_percent": ai_percent,
-                "message": reason
-            }), 200
+                image_upload = decode_data_url(data['image_data'].strip())
+            except ValueError as e:
+                return {"ai_percent": 0, "message": str(e)}, 400
+        
+        if not (text_content or image_url or video_url or image_upload):
+            return {"ai_percent": 0, "message": "No content provided"}, 400
         
-        except requests.exceptions.Timeout:
-            return jsonify({"ai_percent": 50, "message": "Analysis timeout"}), 200
-        except Exception as api_error:
-            print(f"API call error: {str(api_error)}", file=sys.stderr)
-            return jsonify({"ai_percent": 50, "message": "Analysis service error"}), 200
+        if not CEREBRAS_API_KEY:
+            return {"ai_percent": 50, "message": "Cerebras API not configured"}, 500
+
+        upload_digest = hashlib.sha256(image_upload[0]).hexdigest() if image_upload else None
+        cache_key = verdict_key("cerebras", "ai-check", False, text_content, file_digest=upload_digest,
+                                url=None if text_content or image_upload else (image_url or video_url))
+        cached = verdict_cache.get(cache_key)
+        CACHE_LOOKUPS.inc(kind="ai_check", result="miss" if cached is None else "hit")
+        if cached is not None:
+            return cached, 200
+        
+        # Reworded text that was already checked
+        probe = near_dup_probe("ai_check", text=text_content)
+        match = probe.match() if probe else None
+        if match:
+            return dict(match[1], near_duplicate={"similarity": round(match[0], 2)}), 200
+
+        # Identical item already being analyzed: share its verdict
+        return ai_check_flights.call(cache_key, analyze_content, text_content, image_url, video_url, cache_key, probe, image_upload)
     
     except Exception as e:
         print(f"AI check error: {str(e)}", file=sys.stderr)
-        return jsonify({"ai_percent": 50, "message": f"Error: {str(e)[:50]}"}), 200
-
-
-# Extension API endpoint - Return API keys for extension use
-@app.route("/api/extension/keys", methods=["GET"])
-def get_extension_keys():
-    """Return API keys for Chrome extension (so users don't need to manually enter)"""
-    return jsonify({
-        "gemini_api_key": GEMINI_API_KEY,
-        "groq_api_key": GROQ_API_KEY,
-        "cerebras_api_key": CEREBRAS_API_KEY
-    })
+        return {"ai_percent": 50, "message": f"Error: {str(e)[:50]}"}, 200
+
+
+@app.route('/ai-check', methods=['POST'])
+def ai_check():
+    """
+    Endpoint for the extension to check AI authenticity.
+    Accepts: { "text": "...", "image_url": "...", "image_data": "data:image/...", "video_url": "..." }
+    Returns: { "ai_percent": 0-100, "message": "..." }
+    """
+    return ai_check_response(*check_ai_content(request.get_json(silent=True) or {}))
+
+def ai_check_response(result, status):
+    response = jsonify(result)
+    response.status_code = status
+    if "retry_after" in result:
+        response.headers["Retry-After"] = str(result["retry_after"])
+    return response
+
+
+@app.route('/ai-check/batch', methods=['POST'])
+def ai_check_batch():
+    """
+    Batch variant of /ai-check for pages with many items.
+    Accepts: { "items": [{ "text" | "image_url" | "video_url": "..." }, ...] }
+    Identical items are checked once; distinct ones run concurrently (up to
+    AI_CHECK_BATCH_CONCURRENCY per request).
+    Returns: { "results": [{ "index": i, "ai_percent": ..., "message": ... }, ...] }
+    or, with ?stream=1 / Accept: application/x-ndjson, one NDJSON line per item
+    in completion order.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Expected a non-empty 'items' list"}), 400
+    if len(items) > AI_CHECK_BATCH_MAX:
+        return jsonify({"error": f"At most {AI_CHECK_BATCH_MAX} items per batch"}), 413
+
+    # Dedupe: one check per distinct item, fanned back out to every index
+    groups = OrderedDict()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            item = {}
+        signature = json.dumps(
+            [item.get(k) or "" for k in ("text", "image_url", "image_data", "video_url")]
+        )
+        groups.setdefault(signature, (item, []))[1].append(index)
+
+    stream = request.args.get("stream") == "1" or "application/x-ndjson" in request.headers.get("Accept", "")
+    pool = ThreadPoolExecutor(max_workers=min(AI_CHECK_BATCH_CONCURRENCY, len(groups)))
+    futures = {pool.submit(contextvars.copy_context().run, check_ai_content, item): indexes
+               for item, indexes in groups.values()}
+
+    def results_as_completed():
+        try:
+            for future in as_completed(futures):
+                result, status = future.result()
+                for index in futures[future]:
+                    yield dict(result, index=index, status=status)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    if stream:
+        def generate():
+            for result in results_as_completed():
+                yield json.dumps(result) + "\n"
+        return Response(stream_with_context(generate()), content_type='application/x-ndjson')
+
+    results = sorted(results_as_completed(), key=lambda r: r["index"])
+    return jsonify({"results": results}), 200
+
+
+@app.route("/api/scheduler", methods=["GET"])
+def scheduler_status():
+    """Queue depth, in-flight calls and admission wait times per provider key."""
+    return jsonify({key: scheduler.snapshot() for key, scheduler in list(_schedulers.items())})
+
+
+# --- EXTENSION GATEWAY ---
+
+_extension_clients = OrderedDict() # client address -> TokenBucket
+_extension_clients_lock = threading.Lock()
+
+def extension_rate_limit(client):
+    """Seconds until client may run another check (0 = now); EXTENSION_RPM per client."""
+    if not EXTENSION_RPM:
+        return 0
+    now = time.monotonic()
+    with _extension_clients_lock:
+        bucket = _extension_clients.get(client)
+        if bucket is None:
+            bucket = _extension_clients[client] = TokenBucket(EXTENSION_RPM)
+            while len(_extension_clients) > EXTENSION_CLIENTS_MAX:
+                _extension_clients.popitem(last=False)
+        _extension_clients.move_to_end(client)
+        bucket.refill(now)
+        wait = bucket.wait_time(1)
+        if not wait:
+            bucket.take(1)
+    return math.ceil(wait)
+
+@app.route("/api/extension/<any(text, image, page):kind>", methods=["POST"])
+def extension_check(kind):
+    """
+    Gateway for the browser extension: the /ai-check pipeline run server-side,
+    so every install shares the verdict cache, provider connection pools and
+    scheduler instead of calling the providers with its own keys.
+    Accepts: text  { "text": "..." }
+             image { "image_url": "https://..." } or { "image_data": "data:image/png;base64,..." }
+             page  { "text": "<visible page text>", "url": "..." }
+    Returns: { "ai_percent": 0-100, "message": "..." }, or 429 with Retry-After
+    once the client is over EXTENSION_RPM.
+    """
+    data = request.get_json(silent=True) or {}
+    retry_after = extension_rate_limit(request.remote_addr or "")
+    if retry_after:
+        EXTENSION_REQUESTS.inc(kind=kind, status=429)
+        return ai_check_response({"ai_percent": 0, "message": "Too many checks, try again shortly",
+                                  "retry_after": retry_after}, 429)
+
+    if kind == "image":
+        item = {"image_url": data.get("image_url") or "", "image_data": data.get("image_data") or ""}
+    elif kind == "page":
+        # Whitespace differs between extractions of the same page; keep the cache key stable
+        item = {"text": " ".join(str(data.get("text") or "").split())[:EXTENSION_PAGE_CHARS]}
+    else:
+        item = {"text": data.get("text") or ""}
+    result, status = check_ai_content(item)
+    EXTENSION_REQUESTS.inc(kind=kind, status=status)
+    return ai_check_response(result, status)
 
 
 if __name__ == "__main__":